@@ -0,0 +1,793 @@
+"""Native implementation of pit-free Canopy Height Models.
+
+These functions implement the pit-free algorithm of Khosravipour et al. (2014)
+using NumPy and SciPy rather than LAStools, so that Canopy Height Models can
+be produced without wine and without writing intermediate files. They are
+used by `useLAStools.pitfree` when called with `backend='numpy'`.
+"""
+import glob
+import os
+import shutil
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.windows import Window
+from scipy.spatial import Delaunay, cKDTree
+
+from pyFIRS.io import read_header
+from pyFIRS.io import read_points as read_las_points
+from pyFIRS.utils import (atomic_output, available_memory, listlike,
+                          merge_rasters, parse_coords_from_tileid)
+
+METERS_PER_FOOT = 0.3048
+NODATA = -9999.0
+
+# memory used to triangulate each point in memory, by las2dem or by scipy:
+# the point itself plus about two triangles, each with three vertices and
+# three neighbors, and the working space of the triangulation
+TIN_BYTES_PER_POINT = 100
+
+# fraction of a cell by which rasters folded into a composite may be offset
+# from its grid or differ from its resolution, such as from the rounding of
+# the coordinates in a .hdr file
+ALIGN_TOLERANCE = 1e-3
+
+
+def pitfree_params(units,
+                   zmax,
+                   xy_res=None,
+                   z_res=None,
+                   splat_radius=None,
+                   max_TIN_edge=None):
+    """Fills in the default parameters of a pit-free CHM for the units of a
+    point cloud, and computes the heights of the CHM layers.
+
+    Parameters
+    ----------
+    units : string
+        'm' for meters or 'ft' for feet
+    zmax : numeric
+        maximum normalized height of the point cloud
+    xy_res, z_res, splat_radius, max_TIN_edge : numeric (optional)
+        as described for `useLAStools.pitfree`, defaults are used for any not
+        provided
+
+    Returns
+    -------
+    xy_res, z_res, splat_radius, max_TIN_edge : numeric
+        parameters with defaults filled in. max_TIN_edge is always in meters.
+    hts : list
+        heights above ground of the bottom of each CHM layer
+    """
+    if units.lower() in ('m', 'meter', 'meters'):
+        xy_res = xy_res or 0.33333
+        z_res = z_res or 5.0
+        splat_radius = splat_radius or 0.1
+        max_TIN_edge = max_TIN_edge or 1.0
+        hts = [0.0, 2.0] + np.arange(5.0, zmax, z_res).tolist()
+    elif units.lower() in ('f', 'ft', 'feet'):
+        xy_res = xy_res or 1.0
+        z_res = z_res or 15.0
+        splat_radius = splat_radius or 0.3
+        # blast2dem converts from meters to feet, so we use the same value
+        # for meters or feet
+        max_TIN_edge = max_TIN_edge or 1.0
+        hts = [0.0, 6.56168] + np.arange(16.4042, zmax, z_res).tolist()
+    else:
+        raise ValueError('{} is not recognized units'.format(units))
+
+    return xy_res, z_res, splat_radius, max_TIN_edge, hts
+
+
+def select_layers(z, hts, min_points):
+    """Skips CHM layers which are supported by few points.
+
+    A height histogram of the splatted points is computed with a band for
+    each layer, from the height of the layer up to the height of the next
+    one. A layer whose band holds fewer than `min_points` points is merged
+    into the layer below it, which already contains those points, saving a
+    full TIN and raster pass. The lowest layer is always kept.
+
+    The CHM is not compared against one made from every layer, so no bound
+    is placed on how much it changes. Where the points of a skipped band
+    would have covered a pit in the layer below, that pit may remain.
+    `min_points` is the only control over this trade-off, and should be
+    kept small relative to the number of points in a tile.
+
+    Parameters
+    ----------
+    z : array
+        normalized heights of the splatted points
+    hts : list
+        heights above ground of the bottom of each CHM layer, in ascending
+        order, as returned by `pitfree_params`
+    min_points : int
+        fewest points a layer's band needs to be kept
+
+    Returns
+    -------
+    hts : list
+        heights of the layers to rasterize
+    """
+    bands = np.searchsorted(hts, np.asarray(z), side='right') - 1
+    counts = np.bincount(bands[bands >= 0], minlength=len(hts))
+    return [ht for i, ht in enumerate(hts)
+            if i == 0 or counts[i] >= min_points]
+
+
+def res_tag(res):
+    "Formats a resolution for use in file names, such as 0p5 for 0.5"
+    return '{:g}'.format(res).replace('.', 'p')
+
+
+def tin_memory(point_count):
+    """Estimates the memory needed to triangulate points in memory.
+
+    Applies to any stage building a TIN of all its points at once, such as
+    las2dem, las2tin or `rasterize_tin`, but not to blast2dem, which streams
+    points through the triangulation.
+
+    Parameters
+    ----------
+    point_count : int
+        number of points to triangulate, such as the `point_count` from the
+        header of a LAS/LAZ file read with `pyFIRS.io.read_header`
+
+    Returns
+    -------
+    nbytes : int
+        estimated bytes of memory
+    """
+    return int(point_count) * TIN_BYTES_PER_POINT
+
+
+def tin_fits(point_count, workers=1, memory=None):
+    """Whether TINs of a number of points fit in memory when made by several
+    workers at once.
+
+    Parameters
+    ----------
+    point_count : int
+        number of points each worker triangulates
+    workers : int
+        number of TINs made at the same time
+    memory : int (optional)
+        bytes of memory shared by the workers. Defaults to the memory
+        currently available. If this cannot be determined, the TINs are
+        assumed to fit.
+    """
+    if memory is None:
+        memory = available_memory()
+    if memory is None:
+        return True
+    return tin_memory(point_count) <= memory / workers
+
+
+def read_points(lasfile):
+    """Reads the coordinates and classification of points in a LAS/LAZ file.
+
+    Only these dimensions are decoded, using `pyFIRS.io.read_points`, and
+    coordinates are left as the integers stored in the file.
+
+    Returns
+    -------
+    X, Y, Z : arrays
+        stored integer coordinates of each point. Y is expressed in units of
+        the x scale, which is only computed if the file scales y differently.
+    classification : array
+        classification code of each point
+    header : LasHeader
+        header of the file, holding the scale, offset and coordinate
+        reference system of the points
+    """
+    header = read_header(lasfile)
+    points = read_las_points(lasfile,
+                             fields=['x', 'y', 'z', 'classification'])
+    X, Y, Z = points.array['X'], points.array['Y'], points.array['Z']
+    if header.scale[1] != header.scale[0]:
+        Y = np.round(Y * (header.scale[1] / header.scale[0])).astype(np.int64)
+    return X, Y, Z, points['classification'], header
+
+
+def grid_units(transform, scale, offset):
+    """Expresses the transform of a grid in the units of the integer
+    coordinates read by `read_points`, so points can be rasterized onto it
+    without being scaled.
+
+    Parameters
+    ----------
+    transform : Affine
+        transform of a north-up grid, as returned by make_grid
+    scale, offset : tuples
+        scale factors and offsets of the coordinates of a LAS/LAZ file
+    """
+    unit = scale[0]
+    return Affine(transform.a / unit, 0.0, (transform.c - offset[0]) / unit,
+                  0.0, transform.e / unit, (transform.f - offset[1]) / unit)
+
+
+def normalize_heights(x, y, z, classification, ground_class=2):
+    """Converts elevations to heights above ground.
+
+    The ground surface is a TIN of the ground points, and points beyond the
+    extent of the TIN take the elevation of their nearest ground point.
+
+    Returns
+    -------
+    heights : array
+        height of each point above the ground surface
+    """
+    ground = classification == ground_class
+    if ground.sum() < 3:
+        raise ValueError('At least three ground points are needed to '
+                         'normalize heights')
+    gx, gy, gz = x[ground], y[ground], z[ground]
+
+    tri = Delaunay(np.column_stack((gx, gy)))
+    ground_z = interpolate_tin(tri, gz, x, y)
+    outside = np.isnan(ground_z)
+    if outside.any():
+        _, nearest = cKDTree(np.column_stack((gx, gy))).query(
+            np.column_stack((x[outside], y[outside])))
+        ground_z[outside] = gz[nearest]
+
+    return z - ground_z
+
+
+def splat_highest(x, y, z, radius, step, origin=(0, 0)):
+    """Replicates each point around a circle and keeps the highest point in
+    each cell of a grid.
+
+    Equivalent to `lasthin -highest -subcircle radius -step step`. Each point
+    is copied eight times at `radius` around its original location, and only
+    the highest of the original and copied points falling within each cell
+    is kept. Cells are aligned to multiples of step from origin, so
+    neighboring tiles and sub-tiles are thinned alike where they overlap.
+    With a radius of 0, the points are only thinned, as by
+    `lasthin -highest -step step`.
+
+    Coordinates may be the integers stored in a LAS/LAZ file, with radius,
+    step and origin in the same units. The copies are then placed at the
+    nearest integer position, as lasthin would store them, the points kept
+    remain integers, and cells are found with integer arithmetic when step
+    and origin are whole numbers.
+
+    Returns
+    -------
+    x, y, z : arrays
+        coordinates of the highest point in each occupied cell
+    """
+    angles = np.arange(8) * np.pi / 4 if radius else []
+    offsets = [(0.0, 0.0)] + [(radius * np.cos(a), radius * np.sin(a))
+                              for a in angles]
+
+    integer = np.issubdtype(x.dtype, np.integer)
+    if integer:
+        offsets = [(int(round(dx)), int(round(dy))) for dx, dy in offsets]
+        radius = int(np.ceil(radius))
+        if float(step).is_integer() and \
+                all(float(v).is_integer() for v in origin):
+            step, origin = int(step), [int(v) for v in origin]
+    x0 = origin[0] + np.floor((x.min() - radius - origin[0]) / step) * step
+    y0 = origin[1] + np.floor((y.min() - radius - origin[1]) / step) * step
+    if isinstance(step, int):
+        x0, y0 = int(x0), int(y0)
+    ncols = int(np.ceil((x.max() + radius - x0) / step)) + 1
+
+    # highest point found so far in each cell
+    cells_kept = np.empty(0, dtype=np.int64)
+    z_kept = np.empty(0, dtype=z.dtype)
+    x_kept = np.empty(0, dtype=x.dtype)
+    y_kept = np.empty(0, dtype=y.dtype)
+    for dx, dy in offsets:
+        sx, sy = x + dx, y + dy
+        cols = ((sx - x0) // step).astype(np.int64)
+        rows = ((sy - y0) // step).astype(np.int64)
+        cells = np.concatenate((cells_kept, rows * ncols + cols))
+        zs = np.concatenate((z_kept, z))
+        xs = np.concatenate((x_kept, sx))
+        ys = np.concatenate((y_kept, sy))
+
+        # sort by cell, then by descending height, keep first in each cell.
+        # Ties are broken by position, so the point kept does not depend on
+        # the order the points were found in.
+        order = np.lexsort((ys, xs, -zs, cells))
+        cells = cells[order]
+        first = np.ones(len(cells), dtype=bool)
+        first[1:] = cells[1:] != cells[:-1]
+        keep = order[first]
+        cells_kept, z_kept = cells[first], zs[keep]
+        x_kept, y_kept = xs[keep], ys[keep]
+
+    return x_kept, y_kept, z_kept
+
+
+def max_edge_lengths(tri):
+    "Computes the length of the longest edge of each triangle in a TIN"
+    pts = tri.points[tri.simplices]  # (ntri, 3, 2)
+    edges = pts - np.roll(pts, 1, axis=1)
+    return np.sqrt((edges**2).sum(axis=2)).max(axis=1)
+
+
+def interpolate_tin(tri, values, px, py, kill=None, edges=None):
+    """Interpolates values at points from a TIN using barycentric weights.
+
+    Parameters
+    ----------
+    tri : scipy.spatial.Delaunay
+        triangulation of the points holding values
+    values : array
+        value at each vertex of the triangulation
+    px, py : arrays
+        coordinates of the points to interpolate to
+    kill : numeric (optional)
+        triangles with an edge longer than this are treated as gaps
+    edges : array (optional)
+        precomputed result of max_edge_lengths(tri)
+
+    Returns
+    -------
+    interpolated : array
+        interpolated values, NaN where points fall outside the TIN or within
+        killed triangles
+    """
+    p = np.column_stack((px, py))
+
+    # find_simplex walks from the triangle containing the previous point, so
+    # querying points in spatial order (in bands a few triangles tall) is much
+    # faster than querying them in arbitrary order
+    lo, hi = tri.min_bound, tri.max_bound
+    band = 4 * np.sqrt(np.prod(hi - lo) / len(tri.points)) or 1.0
+    order = np.lexsort((p[:, 0], np.floor((p[:, 1] - lo[1]) / band)))
+    simplex = np.empty(len(p), dtype=np.intp)
+    simplex[order] = tri.find_simplex(p[order])
+    valid = simplex >= 0
+    if kill is not None:
+        if edges is None:
+            edges = max_edge_lengths(tri)
+        valid[valid] = edges[simplex[valid]] <= kill
+
+    out = np.full(len(p), np.nan)
+    s = simplex[valid]
+    T = tri.transform[s]
+    b = np.einsum('ijk,ik->ij', T[:, :2], p[valid] - T[:, 2])
+    weights = np.column_stack((b, 1 - b.sum(axis=1)))
+    out[valid] = (weights * values[tri.simplices[s]]).sum(axis=1)
+    return out
+
+
+def make_grid(xmin, ymin, xmax, ymax, res):
+    """Defines a raster grid aligned to multiples of res which covers bounds.
+
+    Returns
+    -------
+    transform : Affine
+        transform of the grid, as used by rasterio
+    shape : tuple
+        number of rows and columns in the grid
+    """
+    x0 = float(np.floor(xmin / res) * res)
+    y1 = float(np.ceil(ymax / res) * res)
+    ncols = max(1, int(np.ceil((xmax - x0) / res)))
+    nrows = max(1, int(np.ceil((y1 - ymin) / res)))
+    return Affine(res, 0.0, x0, 0.0, -res, y1), (nrows, ncols)
+
+
+def rasterize_tin(x, y, z, transform, shape, kill=None, block_rows=256,
+                  tri=None):
+    """Rasterizes a TIN of points onto a grid, sampling at cell centers.
+
+    Parameters
+    ----------
+    x, y, z : arrays
+        points to triangulate
+    transform, shape
+        grid to rasterize onto, as returned by make_grid
+    kill : numeric (optional)
+        triangles with an edge longer than this are left as gaps
+    block_rows : int
+        number of rows interpolated at a time, which limits memory use
+    tri : Delaunay (optional)
+        triangulation of the points, if already made, so that a TIN can be
+        rasterized onto several grids while only being triangulated once
+
+    Returns
+    -------
+    raster : array
+        interpolated values, NaN where there is no data
+    """
+    raster = np.full(shape, np.nan, dtype=np.float32)
+    if len(x) < 3:
+        return raster
+
+    if tri is None:
+        tri = Delaunay(np.column_stack((x, y)))
+    edges = max_edge_lengths(tri) if kill is not None else None
+
+    res = transform.a
+    x0, y1 = transform.c, transform.f
+    cols = np.arange(shape[1])
+    xs = x0 + (cols + 0.5) * res
+
+    # only cells within the extent of the points can hold values
+    first_row = max(0, int((y1 - y.max()) // res))
+    last_row = min(shape[0], int(np.ceil((y1 - y.min()) / res)))
+    for start in range(first_row, last_row, block_rows):
+        stop = min(start + block_rows, last_row)
+        ys = y1 - (np.arange(start, stop) + 0.5) * res
+        px, py = np.meshgrid(xs, ys)
+        raster[start:stop] = interpolate_tin(
+            tri, z, px.ravel(), py.ravel(), kill=kill,
+            edges=edges).reshape(px.shape)
+
+    return raster
+
+
+class MaxCompositor(object):
+    """Composites rasters by keeping the maximum value of each cell.
+
+    The composite is held in a memory-mapped file, so rasters larger than
+    memory can be composited, and each raster can be folded in (and its file
+    deleted) as soon as it is produced, rather than keeping every layer of a
+    CHM on disk until all of them are finished.
+
+    Parameters
+    ----------
+    path : string, path to file
+        file to hold the memory-mapped composite, removed by close()
+    transform, shape
+        grid of the composite, as returned by make_grid. Rasters folded in
+        must have the same resolution and be aligned to the grid, but may
+        cover any part of it.
+    """
+
+    def __init__(self, path, transform, shape):
+        self.path = path
+        self.transform = transform
+        self.shape = shape
+        self.crs = None
+        self.data = np.memmap(path, dtype=np.float32, mode='w+', shape=shape)
+        self.data[:] = np.nan
+
+    def fold(self, raster, transform):
+        """Folds a raster into the composite.
+
+        Parameters
+        ----------
+        raster : array
+            values to composite, with NaN where there is no data
+        transform : Affine
+            transform of the raster, which must have the resolution of the
+            composite and be aligned to its cells
+
+        Raises
+        ------
+        ValueError
+            if the raster has a different resolution or rotation, or is
+            offset from the cells of the composite by more than
+            ALIGN_TOLERANCE of a cell
+        """
+        res = self.transform.a
+        if transform.b or transform.d or \
+                abs(transform.a - res) > ALIGN_TOLERANCE * res or \
+                abs(transform.e - self.transform.e) > ALIGN_TOLERANCE * res:
+            raise ValueError(
+                'Cannot fold a raster with cells of {} x {} into a composite '
+                'with cells of {} x {}'.format(transform.a, -transform.e,
+                                               res, -self.transform.e))
+        rows = (self.transform.f - transform.f) / res
+        cols = (transform.c - self.transform.c) / res
+        row_off, col_off = int(round(rows)), int(round(cols))
+        if abs(rows - row_off) > ALIGN_TOLERANCE or \
+                abs(cols - col_off) > ALIGN_TOLERANCE:
+            raise ValueError(
+                'Cannot fold a raster offset by ({:.4f}, {:.4f}) cells, which '
+                'is not aligned to the cells of the composite'.format(
+                    cols, rows))
+
+        # the part of the raster which overlaps the composite
+        r0, c0 = max(0, -row_off), max(0, -col_off)
+        r1 = min(raster.shape[0], self.shape[0] - row_off)
+        c1 = min(raster.shape[1], self.shape[1] - col_off)
+        if r1 <= r0 or c1 <= c0:
+            return
+        window = self.data[r0 + row_off:r1 + row_off,
+                           c0 + col_off:c1 + col_off]
+        np.fmax(window, raster[r0:r1, c0:c1], out=window)
+
+    def fold_file(self, path, delete=True):
+        """Folds a raster file into the composite.
+
+        Parameters
+        ----------
+        path : string, path to file
+            raster to fold in
+        delete : bool
+            whether to delete the raster, along with any files sharing its
+            name (such as the .hdr of a .bil), once it is folded in
+        """
+        with rasterio.open(path) as src:
+            raster = src.read(1, masked=True).astype(np.float32).filled(np.nan)
+            transform = src.transform
+            self.crs = self.crs or src.crs
+        self.fold(raster, transform)
+
+        if delete:
+            stem = os.path.splitext(path)[0]
+            for sidecar in glob.glob(glob.escape(stem) + '.*'):
+                os.remove(sidecar)
+
+    def write(self, outfile, driver='EHdr', block_rows=256):
+        """Writes the composite to a raster file, a block of rows at a time
+        so that the composite is never held in memory at once."""
+        with atomic_output(outfile) as tmp:
+            with rasterio.open(tmp, 'w', driver=driver, width=self.shape[1],
+                               height=self.shape[0], count=1,
+                               dtype='float32', crs=self.crs,
+                               transform=self.transform,
+                               nodata=NODATA) as dst:
+                for start in range(0, self.shape[0], block_rows):
+                    stop = min(start + block_rows, self.shape[0])
+                    block = np.array(self.data[start:stop])
+                    block[np.isnan(block)] = NODATA
+                    dst.write(block, 1, window=Window(
+                        0, start, self.shape[1], stop - start))
+
+    def close(self):
+        "Releases and removes the memory-mapped file"
+        del self.data
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def pitfree(lasfile,
+            outdir,
+            units,
+            xy_res=None,
+            z_res=None,
+            splat_radius=None,
+            max_TIN_edge=None,
+            min_layer_points=None,
+            bounds=None,
+            buffer=None):
+    """Creates a pit-free Canopy Height Model from a lidar point cloud using
+    NumPy and SciPy.
+
+    Follows the same steps as `useLAStools.pitfree`, holding everything in
+    memory rather than writing intermediate files. Points are normalized to
+    heights above a TIN of the ground points, keeping unclassified, ground and
+    high vegetation points (classes 1, 2 and 5) at least -0.1 above ground. A
+    ground layer is rasterized from points within 0.1 of the ground. The
+    points are then splatted and thinned to the highest point in each cell of
+    half the CHM resolution, and for each layer height, the splatted points
+    above it are triangulated and rasterized, dropping triangles with edges
+    longer than max_TIN_edge. The CHM is the running maximum of the layers.
+    When several resolutions are given, the points are splatted once for the
+    finest of them and thinned again for each coarser one.
+
+    Parameters are the same as for `useLAStools.pitfree`, with the
+    addition of:
+
+    bounds : tuple (optional)
+        (xmin, ymin, xmax, ymax) extent of the CHM. Defaults to the tile
+        bounding box of a tile written by lastile, trimming its buffer as the
+        `use_tile_bb` option of LAStools does, otherwise to the extent of the
+        points.
+    buffer : numeric (optional)
+        if given along with bounds, only points within this distance of
+        bounds are used, such as when a sub-tile of a larger tile is made.
+
+    Returns
+    -------
+    outfile : string, path to file
+        the CHM, written to outdir as {basename}_chm_pitfree.bil, or a list
+        of CHMs named {basename}_chm_pitfree_{xy_res}.bil if a list of
+        resolutions was given. If no ground or vegetation points are left
+        (e.g., over open water), the CHM is nodata throughout its bounds, and
+        a ValueError is raised if neither bounds nor a tile bounding box
+        give its extent.
+    """
+    basename = os.path.basename(lasfile).split('.')[0]
+
+    # points are kept in the integer units stored in the file, taking half
+    # the memory of real-world coordinates, and are splatted, binned and
+    # triangulated in those units. Heights are in units of the z scale, so
+    # they are kept at the precision of the file, as lasheight would store
+    # them, and points at the same height (e.g., ground points) are thinned
+    # alike in every tile or sub-tile holding them.
+    X, Y, Z, classification, header = read_points(lasfile)
+    unit, zscale = header.scale[0], header.scale[2]
+    ox, oy = header.offset[:2]
+    if bounds is not None and buffer is not None:
+        xmin, ymin, xmax, ymax = bounds
+        near = (X >= (xmin - buffer - ox) / unit) & \
+            (X <= (xmax + buffer - ox) / unit) & \
+            (Y >= (ymin - buffer - oy) / unit) & \
+            (Y <= (ymax + buffer - oy) / unit)
+        X, Y, Z, classification = (X[near], Y[near], Z[near],
+                                   classification[near])
+
+    # a tile or sub-tile may hold no ground or vegetation points, such as
+    # over open water, in which case its CHM is empty
+    keep = np.isin(classification, (1, 2, 5))
+    heights = Z
+    if keep.any():
+        heights = np.round(normalize_heights(X, Y, Z, classification))
+        heights = heights.astype(Z.dtype)
+        keep &= heights >= -0.1 / zscale
+    X, Y, heights = X[keep], Y[keep], heights[keep]
+    empty = not len(heights)
+
+    resolutions = list(xy_res) if listlike(xy_res) else [xy_res]
+    zmax = 0.0 if empty else heights.max() * zscale
+    params = [pitfree_params(units, zmax, res, z_res, splat_radius,
+                             max_TIN_edge)
+              for res in resolutions]
+    resolutions = [res for res, _, _, _, _ in params]
+    _, z_res, splat_radius, max_TIN_edge, hts = params[0]
+    kill = max_TIN_edge
+    if units.lower() in ('f', 'ft', 'feet'):
+        kill = max_TIN_edge / METERS_PER_FOOT
+    kill = kill / unit
+    hts = [ht / zscale for ht in hts]
+
+    if bounds is None:
+        if empty and header.tile_bbox is None:
+            raise ValueError('{} has no ground or vegetation points to make '
+                             'a CHM from'.format(lasfile))
+        bounds = header.tile_bbox or (X.min() * unit + ox, Y.min() * unit + oy,
+                                      X.max() * unit + ox, Y.max() * unit + oy)
+    grids = [make_grid(*bounds, res=res) for res in resolutions]
+
+    # the points are splatted once, for the finest resolution, and the
+    # splatted points are thinned again to half of each coarser resolution.
+    # The highest point in a cell is the highest of the points kept in the
+    # finer cells it holds, so where a resolution is a multiple of the finest,
+    # its points are those a run at that resolution alone would splat. Cells
+    # are aligned to multiples of the step in real-world coordinates.
+    if not empty:
+        low = heights <= 0.1 / zscale
+        origin = (-ox / unit, -oy / unit)
+        step = min(resolutions) / 2.0
+        sx, sy, sz = splat_highest(X, Y, heights, splat_radius / unit,
+                                   step / unit, origin=origin)
+
+    chms = []
+    for res, (transform, shape) in zip(resolutions, grids):
+        if empty:
+            chms.append(np.full(shape, np.nan, dtype=np.float32))
+            continue
+        units_transform = grid_units(transform, header.scale, header.offset)
+        # the ground layer provides the minimum value of the CHM
+        chm = rasterize_tin(X[low], Y[low], heights[low], units_transform,
+                            shape)
+        if res / 2.0 == step:
+            cx, cy, cz = sx, sy, sz
+        else:
+            cx, cy, cz = splat_highest(sx, sy, sz, 0, res / 2.0 / unit,
+                                       origin=origin)
+        layer_hts = hts
+        if min_layer_points:
+            layer_hts = select_layers(cz, hts, min_layer_points)
+        for ht in layer_hts:
+            above = cz >= ht
+            layer = rasterize_tin(cx[above], cy[above], cz[above],
+                                  units_transform, shape, kill=kill)
+            np.fmax(chm, layer, out=chm)
+        chm *= zscale
+        chms.append(chm)
+
+    os.makedirs(outdir, exist_ok=True)
+    outfiles = []
+    for res, chm, (transform, shape) in zip(resolutions, chms, grids):
+        chm[np.isnan(chm)] = NODATA
+        suffix = '_' + res_tag(res) if len(resolutions) > 1 else ''
+        outfile = os.path.join(
+            outdir, basename + '_chm_pitfree{}.bil'.format(suffix))
+        with atomic_output(outfile) as tmp:
+            with rasterio.open(tmp, 'w', driver='EHdr', width=shape[1],
+                               height=shape[0], count=1, dtype='float32',
+                               crs=header.crs, transform=transform,
+                               nodata=NODATA) as dst:
+                dst.write(chm, 1)
+        outfiles.append(outfile)
+
+    if listlike(xy_res):
+        return outfiles
+    return outfile
+
+
+def pitfree_tile(tile_id, src_dir, outdir, units, subtile=None, buffer=0,
+                 **kwargs):
+    """Creates a pit-free CHM for a tile of an acquisition, as a stage run by
+    `pyFIRS.executors.map_tiles`.
+
+    The point cloud of the tile is read from {src_dir}/{tile_id}.laz and the
+    CHM of the tile, excluding any buffer around it, is written to outdir as
+    {tile_id}_chm_pitfree.bil. When map_tiles
+    splits the tile, each sub-tile is made from the points within `buffer` of
+    it, written to outdir/subtiles/{subtile}, and combined by
+    `merge_pitfree_tile`.
+
+    Parameters
+    ----------
+    tile_id : string
+        tile to process, following the naming convention {LLX}_{LLY}_{LENGTH}
+    src_dir, outdir : string, path to directory
+        directories holding the point clouds of the tiles, and where CHMs are
+        written
+    subtile : string (optional)
+        sub-tile of the tile to process, as passed by map_tiles
+    buffer : numeric (optional)
+        distance by which the points used for a sub-tile extend beyond it
+    units, kwargs : optional
+        passed to `pitfree`
+
+    Returns
+    -------
+    outfile : string or list, path(s) to file
+        CHM(s) made for the tile or sub-tile, as returned by `pitfree`
+    """
+    lasfile = os.path.join(src_dir, tile_id + '.laz')
+    if subtile is None:
+        llx, lly, length = parse_coords_from_tileid(tile_id)
+        return pitfree(lasfile, outdir, units,
+                       bounds=(llx, lly, llx + length, lly + length), **kwargs)
+
+    llx, lly, length = parse_coords_from_tileid(subtile)
+    return pitfree(lasfile, os.path.join(outdir, 'subtiles', subtile), units,
+                   bounds=(llx, lly, llx + length, lly + length),
+                   buffer=buffer, **kwargs)
+
+
+def merge_pitfree_tile(tile_id, sub_ids, outdir, xy_res=None, **kwargs):
+    """Merges the CHMs made by `pitfree_tile` for the sub-tiles of a tile into
+    the CHM of the tile, and removes them.
+
+    Parameters
+    ----------
+    tile_id : string
+        tile whose sub-tiles are merged
+    sub_ids : list-like
+        sub-tiles of the tile, as passed by map_tiles
+    outdir : string, path to directory
+        directory the CHMs were written to by `pitfree_tile`
+    xy_res : numeric or list-like of numerics (optional)
+        resolution(s) the CHMs were made at, as passed to `pitfree_tile`
+    kwargs : optional
+        other arguments of `pitfree_tile`, which are ignored
+
+    Returns
+    -------
+    outfile : string or list, path(s) to file
+        merged CHM(s), named as `pitfree` would name the CHM(s) of the tile
+    """
+    suffixes = [''] if not listlike(xy_res) else [
+        '_' + res_tag(res) for res in xy_res]
+    llx, lly, length = parse_coords_from_tileid(tile_id)
+    outfiles = []
+    for suffix in suffixes:
+        name = tile_id + '_chm_pitfree{}.bil'.format(suffix)
+        outfile = os.path.join(outdir, name)
+        merge_rasters([os.path.join(outdir, 'subtiles', sub_id, name)
+                       for sub_id in sub_ids], outfile,
+                      bounds=(llx, lly, llx + length, lly + length))
+        outfiles.append(outfile)
+    for sub_id in sub_ids:
+        shutil.rmtree(os.path.join(outdir, 'subtiles', sub_id))
+    try:
+        os.rmdir(os.path.join(outdir, 'subtiles'))
+    except OSError:  # sub-tiles of other tiles remain
+        pass
+
+    if listlike(xy_res):
+        return outfiles
+    return outfile
@@ -0,0 +1,303 @@
+"""Command line interface for running pyFIRS pipelines without a notebook.
+
+A pipeline is declared in a JSON configuration file listing the stages to run
+over an acquisition. Each stage names a function, given as
+"module:function", which is executed for every tile as
+function(tile_id, **kwargs), just as in the notebooks using map_tiles::
+
+    {
+        "workdir": "/storage/lidar/portland-metro_2014",
+        "executor": "processes",
+        "tiles": "interim/retiled/*.laz",
+        "stages": [
+            {"name": "normalize",
+             "function": "pipeline:normalize",
+             "memory": "2GB"},
+            {"name": "chm",
+             "function": "pipeline:make_chm",
+             "kwargs": {"resolution": 0.75, "odir": "processed/chm"},
+             "speculate": true}
+        ]
+    }
+
+Tiles are either a list of tile_ids or a glob pattern, relative to workdir,
+of files named after their tile_id. A stage may override the tiles, executor,
+and kwargs of the pipeline. Stages are run from workdir, so relative paths in
+their kwargs, such as the odir above, are relative to workdir wherever pyfirs
+is run from. The directory containing the configuration file
+is added to the module search path, so stage functions can be kept in a
+module alongside it.
+
+Progress is recorded with TileLeases in a state directory, so a run which is
+interrupted resumes where it stopped, skipping the tiles already finished,
+and several nodes can run the same pipeline against a shared acquisition at
+once. Passing --fresh forgets the finished tiles to process every tile
+again, and is refused while any node holds a live lease on a tile.
+
+The --memory budget only limits the workers of stages declaring the memory
+each of their tiles uses, as "memory" above. Stages which do not declare it
+run with --workers (or all cores) regardless of the budget. With the dask
+executor, the budget is also divided among the workers of its cluster as the
+memory limit of each.
+
+Exit status is 0 if every tile of every stage succeeded, 1 if any tile
+failed (later stages are not run), 2 for invalid arguments or configuration,
+and 130 if interrupted.
+"""
+import argparse
+import glob
+import importlib
+import json
+import os
+import re
+import shutil
+import sys
+
+from pyFIRS.executors import EXECUTORS, get_executor, map_tiles
+from pyFIRS.leases import TileLeases
+from pyFIRS.utils import fname
+
+EXIT_OK, EXIT_FAILED, EXIT_CONFIG, EXIT_INTERRUPTED = 0, 1, 2, 130
+
+UNITS = {'': 1, 'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40}
+
+
+class ConfigError(ValueError):
+    "Raised when a pipeline configuration is invalid"
+    pass
+
+
+def parse_size(size):
+    """Parses a size such as '16GB' or '512M' into a number of bytes.
+
+    Binary units are used, so '1GB' is 2**30 bytes.
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.match(r'^\s*([\d.]+)\s*([kmgt]?)i?b?\s*$', str(size).lower())
+    if match is None:
+        raise ValueError('Could not interpret {} as a size'.format(size))
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def load_config(path):
+    """Reads and validates a pipeline configuration file.
+
+    Returns
+    -------
+    config : dict
+        configuration with workdir resolved to an absolute path
+    """
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError('Could not read {}: {}'.format(path, e))
+
+    config_dir = os.path.dirname(os.path.abspath(path))
+    config['workdir'] = os.path.join(config_dir, config.get('workdir', '.'))
+    config.setdefault('name', fname(path))
+
+    stages = config.get('stages')
+    if not stages:
+        raise ConfigError('{} does not declare any stages'.format(path))
+    names = [stage.get('name') for stage in stages]
+    if None in names or len(set(names)) < len(names):
+        raise ConfigError('Every stage needs a unique name')
+    for stage in stages:
+        if ':' not in stage.get('function', ''):
+            raise ConfigError(
+                'Stage {} needs a function given as "module:function"'.format(
+                    stage['name']))
+        if stage.get('tiles', config.get('tiles')) is None:
+            raise ConfigError('No tiles declared for stage {}'.format(
+                stage['name']))
+        kwargs = dict(config.get('kwargs', {}), **stage.get('kwargs', {}))
+        if stage.get('speculate') and 'odir' not in kwargs:
+            raise ConfigError(
+                'Stage {} needs an "odir" in its kwargs to be run '
+                'speculatively'.format(stage['name']))
+        executor = stage.get('executor', config.get('executor', 'threads'))
+        if executor not in EXECUTORS:
+            raise ConfigError('{} is not a recognized executor'.format(
+                executor))
+
+    if config_dir not in sys.path:
+        sys.path.insert(0, config_dir)
+    return config
+
+
+def resolve_function(spec):
+    "Imports a function given as 'module:function'"
+    module_name, func_name = spec.split(':', 1)
+    try:
+        return getattr(importlib.import_module(module_name), func_name)
+    except (ImportError, AttributeError) as e:
+        raise ConfigError('Could not import {}: {}'.format(spec, e))
+
+
+def resolve_tiles(tiles, workdir):
+    """Lists the tile_ids to process, from either a list of tile_ids or a
+    glob pattern matching files named after their tile_id."""
+    if isinstance(tiles, str):
+        paths = glob.glob(os.path.join(workdir, tiles))
+        return sorted(set(fname(path) for path in paths))
+    return list(tiles)
+
+
+def stage_workers(stage, workers, memory):
+    """Number of workers to run a stage with, limited so the memory each tile
+    is expected to use fits within the memory budget."""
+    if memory and stage.get('memory'):
+        fits = max(1, memory // parse_size(stage['memory']))
+        workers = min(workers, fits) if workers else fits
+    return workers
+
+
+def run_stage(stage, config, args, state_dir):
+    """Processes the tiles of a stage which are not already done.
+
+    Returns
+    -------
+    failed : OrderedDict
+        exception raised by each tile which failed
+    """
+    func = resolve_function(stage['function'])
+    tile_ids = resolve_tiles(stage.get('tiles', config['tiles']),
+                             config['workdir'])
+    kwargs = dict(config.get('kwargs', {}), **stage.get('kwargs', {}))
+    kind = stage.get('executor', config.get('executor', 'threads'))
+    workers = stage_workers(stage, args.workers, args.memory)
+
+    executor_kws = {}
+    if kind == 'dask' and args.memory:
+        # the budget is divided among the workers the cluster starts
+        executor_kws['memory'] = args.memory
+
+    lease_dir = os.path.join(state_dir, stage['name'])
+    with TileLeases(lease_dir, node_id=args.node_id) as leases:
+        todo = [tile_id for tile_id in tile_ids if not leases.is_done(tile_id)]
+        print('[{}] {:,d} tiles, {:,d} already done, {:,d} to process'.format(
+            stage['name'], len(tile_ids), len(tile_ids) - len(todo),
+            len(todo)), flush=True)
+        if args.dry_run or not todo:
+            return {}
+
+        with get_executor(kind, workers=workers, **executor_kws) as executor:
+            results = map_tiles(func, todo, executor=executor, leases=leases,
+                                speculate=stage.get('speculate', False),
+                                errors='return', **kwargs)
+
+    failed = {
+        tile_id: result for tile_id, result in results.items()
+        if isinstance(result, Exception)
+    }
+    print('[{}] {:,d} tiles processed, {:,d} failed'.format(
+        stage['name'], len(results), len(failed)), flush=True)
+    for tile_id, error in failed.items():
+        print('[{}] {} failed: {}'.format(stage['name'], tile_id, error),
+              file=sys.stderr)
+    return failed
+
+
+def run(args):
+    "Executes the stages of a pipeline, returning the exit status"
+    config = load_config(args.config)
+    stages = config['stages']
+    if args.stages:
+        unknown = set(args.stages) - set(stage['name'] for stage in stages)
+        if unknown:
+            raise ConfigError('Unknown stages: {}'.format(', '.join(unknown)))
+        stages = [stage for stage in stages if stage['name'] in args.stages]
+
+    if not os.path.isdir(config['workdir']):
+        raise ConfigError('workdir {} does not exist'.format(
+            config['workdir']))
+    state_dir = os.path.abspath(args.state_dir or os.path.join(
+        config['workdir'], '.pyfirs', config['name']))
+    if args.fresh and not args.dry_run:
+        # start over, forgetting which tiles were finished previously, but
+        # never while another node is working from the same state
+        for stage in stages:
+            lease_dir = os.path.join(state_dir, stage['name'])
+            if not os.path.isdir(lease_dir):
+                continue
+            live = TileLeases(lease_dir).live()
+            if live:
+                raise ConfigError(
+                    'Cannot start fresh, {:,d} tiles of stage {} are being '
+                    'processed by another node'.format(len(live),
+                                                       stage['name']))
+        for stage in stages:
+            shutil.rmtree(os.path.join(state_dir, stage['name']),
+                          ignore_errors=True)
+
+    # relative paths in the kwargs of stages are resolved against workdir,
+    # including by any worker processes the executors start
+    cwd = os.getcwd()
+    os.chdir(config['workdir'])
+    try:
+        for stage in stages:
+            failed = run_stage(stage, config, args, state_dir)
+            if failed:
+                print('Stopping after {:,d} tiles failed in stage {}'.format(
+                    len(failed), stage['name']), file=sys.stderr)
+                return EXIT_FAILED
+    finally:
+        os.chdir(cwd)
+    return EXIT_OK
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='pyfirs', description='Run pyFIRS lidar processing pipelines.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser(
+        'run', help='execute the stages of a pipeline over an acquisition')
+    run_parser.add_argument('config', help='path to JSON pipeline config')
+    run_parser.add_argument('-w', '--workers', type=int,
+                            help='number of workers (default: all cores)')
+    run_parser.add_argument('-m', '--memory', type=parse_size,
+                            help='memory budget, such as 64GB, which limits '
+                            'the workers of stages declaring their memory '
+                            'use per tile (other stages are not limited)')
+    state = run_parser.add_mutually_exclusive_group()
+    state.add_argument('--resume', dest='fresh', action='store_false',
+                       help='skip tiles finished by a previous run (the '
+                       'default)')
+    state.add_argument('--fresh', dest='fresh', action='store_true',
+                       help='forget tiles finished by a previous run and '
+                       'process every tile again, unless another node is '
+                       'running')
+    run_parser.set_defaults(fresh=False)
+    run_parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='report the tiles each stage would process '
+                            'without processing them')
+    run_parser.add_argument('-s', '--stage', dest='stages', action='append',
+                            help='only run this stage (may be repeated)')
+    run_parser.add_argument('--state-dir',
+                            help='directory where progress is recorded '
+                            '(default: WORKDIR/.pyfirs/CONFIG_NAME)')
+    run_parser.add_argument('--node-id',
+                            help='name of this node when several nodes share '
+                            'the state directory')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        if args.command == 'run':
+            return run(args)
+    except ConfigError as e:
+        print('pyfirs: error: {}'.format(e), file=sys.stderr)
+        return EXIT_CONFIG
+    except KeyboardInterrupt:
+        print('pyfirs: interrupted', file=sys.stderr)
+        return EXIT_INTERRUPTED
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,673 @@
+import os
+import shutil
+import statistics
+import threading
+import time
+from collections import OrderedDict
+from concurrent import futures
+
+from pyFIRS.utils import commit_output_dir, split_tile, temp_output_dir
+
+
+class TileExecutor(object):
+    """Base class for running per-tile jobs on a pool of workers.
+
+    Executors wrap a backend that can run Python callables, and expose a
+    small interface shared by all backends so that the same pipeline code can
+    run serially on a laptop, on a pool of local threads or processes, or on a
+    dask.distributed cluster.
+
+    Subclasses must implement `submit`, which returns an object following the
+    `concurrent.futures.Future` interface (`result`, `done`, `cancel`).
+    """
+
+    def __init__(self, workers=None):
+        "Initialize with the number of workers jobs will be spread across"
+        self.workers = workers or os.cpu_count() or 1
+
+    def submit(self, func, *args, **kwargs):
+        """Schedules func(*args, **kwargs) to be executed.
+
+        Returns
+        -------
+        future : Future
+            a future representing the execution of the callable
+        """
+        raise NotImplementedError
+
+    def as_completed(self, fs):
+        """Iterates over futures, yielding each one as it completes."""
+        return futures.as_completed(fs)
+
+    def wait(self, fs, timeout=None):
+        """Blocks until at least one of the futures completes.
+
+        Parameters
+        ----------
+        fs : list-like
+            futures to wait on
+        timeout : numeric (optional)
+            maximum number of seconds to wait
+
+        Returns
+        -------
+        done, not_done : sets
+            futures that have and have not completed
+        """
+        return futures.wait(
+            fs, timeout=timeout, return_when=futures.FIRST_COMPLETED)
+
+    def cancel(self, job):
+        """Attempts to cancel a job before it starts.
+
+        Returns
+        -------
+        cancelled : boolean
+            True if the job will never run, False if it is running or
+            finished, in which case it runs to completion
+        """
+        return job.cancel()
+
+    def broadcast(self, obj):
+        """Makes an object available to all workers.
+
+        Backends that run in the same process simply return the object.
+        Distributed backends may return a handle to a copy of the object which
+        has been sent to each worker in advance, which can be passed to
+        `submit` in place of the object itself.
+        """
+        return obj
+
+    def map(self, func, *iterables, **kwargs):
+        """Executes func over each item in iterables.
+
+        Parameters
+        ----------
+        func : callable
+            function to execute
+        iterables : iterables
+            positional arguments that will be zipped together and passed to
+            func, as with the builtin map function
+        kwargs : optional
+            keyword arguments passed to each call of func
+
+        Returns
+        -------
+        results : list
+            results of each call, in the same order as the inputs
+        """
+        fs = [self.submit(func, *args, **kwargs) for args in zip(*iterables)]
+        return [f.result() for f in fs]
+
+    def shutdown(self, wait=True):
+        "Releases any resources held by the executor"
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=True)
+        return False
+
+
+class SerialExecutor(TileExecutor):
+    """Executes jobs one at a time in the calling process.
+
+    Jobs are run immediately when submitted. Useful for small jobs, for
+    debugging, and for environments where multiprocessing is not available.
+    """
+
+    def __init__(self, workers=1):
+        super().__init__(workers=1)
+
+    def submit(self, func, *args, **kwargs):
+        future = futures.Future()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        return future
+
+
+class ThreadExecutor(TileExecutor):
+    """Executes jobs on a pool of threads in the calling process.
+
+    Most pyFIRS jobs spend their time waiting on LAStools or FUSION command
+    line tools running in a subprocess, so a thread pool is usually the
+    lightest-weight way to run several of them at once on a single machine.
+    """
+
+    def __init__(self, workers=None):
+        super().__init__(workers=workers)
+        self.pool = futures.ThreadPoolExecutor(max_workers=self.workers)
+
+    def submit(self, func, *args, **kwargs):
+        return self.pool.submit(func, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+class ProcessExecutor(TileExecutor):
+    """Executes jobs on a pool of local processes.
+
+    Suited for jobs that do substantial processing in Python itself. Functions
+    and arguments submitted must be picklable.
+    """
+
+    def __init__(self, workers=None):
+        super().__init__(workers=workers)
+        self.pool = futures.ProcessPoolExecutor(max_workers=self.workers)
+
+    def submit(self, func, *args, **kwargs):
+        return self.pool.submit(func, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+class DaskExecutor(TileExecutor):
+    """Executes jobs on a dask.distributed cluster.
+
+    Parameters
+    ----------
+    client : dask.distributed.Client (optional)
+        an existing client connected to a cluster. If neither client nor
+        address is provided, a LocalCluster will be started.
+    address : string (optional)
+        address of a running dask scheduler to connect to, such as
+        'tcp://10.0.0.1:8786'
+    workers : int (optional)
+        number of workers to start if a LocalCluster is created
+    memory : int (optional)
+        number of bytes of memory shared among the workers of a LocalCluster
+        it creates. Each worker is limited to its share of the budget and, by
+        default, given a single thread, so that it processes one tile at a
+        time. If workers is not given, a worker is started for each core.
+    cluster_kws : optional
+        additional keyword arguments passed to LocalCluster
+    """
+
+    def __init__(self, client=None, address=None, workers=None, memory=None,
+                 **cluster_kws):
+        from dask.distributed import Client, LocalCluster
+
+        self.cluster = None
+        if client is None:
+            if address is None:
+                if memory is not None:
+                    workers = workers or os.cpu_count() or 1
+                    cluster_kws.setdefault('threads_per_worker', 1)
+                    cluster_kws['memory_limit'] = memory // workers
+                self.cluster = LocalCluster(n_workers=workers, **cluster_kws)
+                address = self.cluster
+            client = Client(address)
+        self.client = client
+        self.pending = set()  # jobs submitted which have not finished
+        self._lock = threading.Lock()
+        super().__init__(workers=len(client.nthreads()))
+
+    def submit(self, func, *args, **kwargs):
+        # jobs are expected to have side effects (writing files), so dask
+        # should never skip a call because it has seen the arguments before
+        job = self.client.submit(func, *args, pure=False, **kwargs)
+        with self._lock:
+            self.pending.add(job)
+        job.add_done_callback(self._forget)
+        return job
+
+    def _forget(self, job):
+        with self._lock:
+            self.pending.discard(job)
+
+    def cancel(self, job):
+        # a dask future cannot tell whether its task has started on a worker,
+        # and cancelling a task which has started does not stop it, so jobs
+        # are always left to run to completion
+        return False
+
+    def as_completed(self, fs):
+        from dask.distributed import as_completed
+        return as_completed(fs)
+
+    def wait(self, fs, timeout=None):
+        from dask.distributed import wait, TimeoutError
+        try:
+            done, not_done = wait(
+                fs, timeout=timeout, return_when='FIRST_COMPLETED')
+        except TimeoutError:
+            return set(), set(fs)
+        return set(done), set(not_done)
+
+    def broadcast(self, obj):
+        return self.client.scatter(obj, broadcast=True)
+
+    def shutdown(self, wait=True):
+        # only close what we started ourselves. Closing the cluster would
+        # kill jobs part way through writing their outputs, so they are
+        # waited for even when wait is False.
+        if self.cluster is not None:
+            from dask.distributed import wait as wait_for
+            with self._lock:
+                pending = list(self.pending)
+            wait_for(pending)
+            self.client.close()
+            self.cluster.close()
+
+
+EXECUTORS = {
+    'serial': SerialExecutor,
+    'threads': ThreadExecutor,
+    'processes': ProcessExecutor,
+    'dask': DaskExecutor
+}
+
+
+def get_executor(kind='threads', workers=None, **kwargs):
+    """Returns a TileExecutor for the requested backend.
+
+    Parameters
+    ----------
+    kind : string or TileExecutor
+        one of 'serial', 'threads', 'processes', or 'dask'. If an existing
+        TileExecutor is provided, it is returned unchanged.
+    workers : int (optional)
+        number of workers. Defaults to the number of cores on this machine
+        (or the size of the cluster for the dask backend).
+    kwargs : optional
+        additional keyword arguments passed to the executor, such as `client`
+        or `address` for the dask backend.
+
+    Returns
+    -------
+    executor : TileExecutor
+    """
+    if isinstance(kind, TileExecutor):
+        return kind
+    try:
+        executor_class = EXECUTORS[kind]
+    except KeyError:
+        raise ValueError('{} is not a recognized executor. Choose from '
+                         '{}'.format(kind, ', '.join(EXECUTORS)))
+    return executor_class(workers=workers, **kwargs)
+
+
+def map_tiles(func, tile_ids, executor=None, leases=None, speculate=False,
+              sizes=None, slowdown=4.0, merge=None, parts=2, buffer=0,
+              cache=None, inputs=None, errors='raise', workers=None,
+              **kwargs):
+    """Executes func(tile_id, **kwargs) for each tile using an executor.
+
+    This is the common entry point for running a per-tile processing step over
+    a lidar acquisition. Jobs are submitted all at once and their results are
+    gathered as they finish.
+
+    When leases are provided, tiles are instead claimed one at a time as
+    workers become free, so several machines running the same call against a
+    shared acquisition will divide the tiles between them. Only the tiles
+    claimed by this machine are processed and returned. Tiles held by other
+    machines are checked again every heartbeat of the leases until they are
+    done, and any whose lease expires (e.g., because its machine died) are
+    claimed and processed here.
+
+    When speculate is True, tiles are also submitted as workers become free,
+    and the runtime of each finished job is recorded relative to the size of
+    its tile. Once no tiles remain to be submitted, any job that has been
+    running more than `slowdown` times longer than expected for its size is
+    started again on an idle worker. The first attempt to finish wins and the
+    other is cancelled; an attempt which is already running cannot be
+    interrupted, so it runs to completion and its result is discarded. Each
+    attempt is given its own hidden temporary directory inside the `odir`
+    keyword argument in place of odir itself, and only the directory of the
+    attempt which wins is moved into odir, so func must write its outputs
+    under odir to be run speculatively. The temporary directory of an attempt
+    which loses is removed when it finishes. If map_tiles started the
+    executor, it returns without waiting for attempts which lost, unless it
+    started a dask cluster, which is only closed once they have finished.
+
+    When a merge function is provided, the stage is treated as one that can
+    process part of a tile. Tiles are submitted as workers become free, and
+    once fewer tiles remain to be submitted than there are idle workers, each
+    remaining tile is split into parts**2 sub-tiles using split_tile, each
+    overlapping its neighbors by `buffer`. Each sub-tile is processed by
+    calling func(tile_id, subtile=sub_id, buffer=buffer, **kwargs), where
+    sub_id follows the {LLX}_{LLY}_{LENGTH} naming convention and gives the
+    unbuffered extent of the sub-tile, and once all of them are finished
+    merge(tile_id, sub_ids, **kwargs) is executed to combine their outputs
+    (e.g., using merge_rasters). The result of merge is returned as the result
+    of the tile. Splitting only applies to stages which provide such a func
+    and merge pair, and the only one pyFIRS currently provides is the native
+    canopy height model, `pyFIRS.chm.pitfree_tile` and
+    `pyFIRS.chm.merge_pitfree_tile`. Height normalization (lasheight) and
+    FUSION gridmetrics have no sub-tile or merge functions, including for
+    the CSV outputs of gridmetrics, so those stages are always run on whole
+    tiles. With leases, tiles finished by other nodes or leased by them are
+    not counted among those remaining.
+
+    When a StagingCache and an inputs function are provided, the input files
+    of upcoming tiles are copied into the cache in the background, staying
+    ahead of the tiles being processed by twice the number of workers. The
+    wrappers read from these local copies when constructed with the same
+    cache.
+
+    Parameters
+    ----------
+    func : callable
+        function that accepts a tile_id as its first argument
+    tile_ids : list-like
+        identifiers of the tiles to process
+    executor : TileExecutor or string (optional)
+        executor to run the jobs on, or the name of a backend passed to
+        get_executor. Defaults to running jobs in a thread pool.
+    leases : TileLeases (optional)
+        lease manager used to claim tiles on a shared filesystem
+    speculate : boolean (optional)
+        whether to re-execute straggling jobs. Defaults to False.
+    sizes : dict or callable (optional)
+        size of each tile (e.g., number of points or bytes), used to compute
+        the expected runtime of its job. Either a mapping from tile_id to size,
+        or a function that accepts a tile_id and returns its size. By default,
+        all tiles are assumed to be the same size.
+    slowdown : numeric (optional)
+        how many times longer than expected a job must run before it is
+        re-executed. Defaults to 4.0.
+    merge : callable (optional)
+        function accepting a tile_id, a list of sub-tile ids, and kwargs,
+        which combines the outputs produced for each sub-tile. If not
+        provided, tiles are never split.
+    parts : int (optional)
+        number of sub-tiles along each side of a tile that is split. Defaults
+        to 2, splitting a tile into four sub-tiles.
+    buffer : numeric (optional)
+        distance by which sub-tiles extend beyond their share of a tile, such
+        as the buffer of the tiles themselves, so that their outputs have no
+        edge effects where they meet. Defaults to 0.
+    cache : StagingCache (optional)
+        local cache to prefetch the inputs of upcoming tiles into
+    inputs : callable (optional)
+        function accepting a tile_id and returning a list of its input files
+    errors : string (optional)
+        'raise' (default) to raise the exception of the first tile that
+        failed once all jobs are finished, or 'return' to return the exception
+        raised by each failed tile as its result
+    workers : int (optional)
+        number of workers of the executor, if it is started by map_tiles
+    kwargs : optional
+        keyword arguments passed to every call of func
+
+    Returns
+    -------
+    results : OrderedDict
+        result of func for each tile_id processed, in the same order as
+        tile_ids
+    """
+    if errors not in ('raise', 'return'):
+        raise ValueError("errors must be 'raise' or 'return'")
+    if speculate and 'odir' not in kwargs:
+        raise ValueError('func must write its outputs to an odir keyword '
+                         'argument to be run speculatively')
+
+    own_executor = not isinstance(executor, TileExecutor)
+    executor = get_executor(executor or 'threads', workers=workers)
+    tile_ids = list(tile_ids)
+
+    if cache is not None and inputs is not None:
+        prefetch = cache.prefetcher(tile_ids, inputs, 2 * executor.workers)
+    else:
+        prefetch = lambda: None
+
+    losers = []  # temporary directories of attempts which lost
+    try:
+        if leases is None and not speculate and merge is None:
+            jobs = OrderedDict()
+            try:
+                for tile_id in tile_ids:
+                    jobs[tile_id] = executor.submit(func, tile_id, **kwargs)
+                for _ in executor.as_completed(list(jobs.values())):
+                    prefetch()
+            except BaseException:
+                for job in jobs.values():
+                    job.cancel()
+                raise
+        else:
+            jobs = _map_bounded(func, tile_ids, executor, leases, speculate,
+                                sizes, slowdown, merge, parts, buffer,
+                                prefetch, losers, **kwargs)
+        if errors == 'return':
+            results = OrderedDict(
+                (tile_id, job.exception() or job.result())
+                for tile_id, job in jobs.items())
+        else:
+            results = OrderedDict(
+                (tile_id, job.result()) for tile_id, job in jobs.items())
+    finally:
+        # attempts which lost to a speculative copy are not waited for
+        if own_executor:
+            executor.shutdown(wait=False)
+            if isinstance(executor, DaskExecutor):
+                # attempts which lost have finished, but dask may not have
+                # run their callbacks before the client was closed
+                for tmp_odir in losers:
+                    _remove_dir(tmp_odir)
+
+    return results
+
+
+def _map_bounded(func, tile_ids, executor, leases, speculate, sizes,
+                 slowdown, merge, parts, buffer, prefetch, losers, **kwargs):
+    """Submits tiles as workers become free, keeping at most one job per
+    worker in flight, so that tiles are left for other nodes to claim and so
+    that idle workers can be detected for speculative re-execution and for
+    splitting the last tiles of a stage.
+
+    Each job is tracked by a key of (tile_id, subtile), where subtile is None
+    for a whole tile, the id of a sub-tile, or MERGE for the job combining the
+    sub-tiles of a tile.
+
+    The temporary output directory of each attempt left running after it
+    lost is appended to losers, and removed once the attempt finishes.
+    """
+    if sizes is None:
+        size_of = lambda tile_id: 1
+    elif callable(sizes):
+        size_of = sizes
+    else:
+        size_of = sizes.__getitem__
+
+    order = {tile_id: i for i, tile_id in enumerate(tile_ids)}
+    # tiles neither submitted here nor known to be done elsewhere, and when
+    # the lease of each was last read and when it expires
+    unsettled = OrderedDict.fromkeys(tile_ids)
+    checked = {}
+    to_submit = iter(tile_ids) if leases is None else leases.claimed(tile_ids)
+    exhausted = False
+    retry_at = 0  # when to check again for tiles held by other nodes
+    jobs = {}  # the job whose result was kept for each tile
+    attempts = {}  # key, start time and output directory of each attempt
+    running = {}  # attempts in flight for each unfinished key
+    subtiles = {}  # finished sub-tile jobs of each split tile
+    rates = []  # seconds per unit of size for finished jobs
+
+    def key_size(key):
+        tile_id, subtile = key
+        if subtile is None:
+            return size_of(tile_id)
+        return size_of(tile_id) / parts**2
+
+    def left_to_submit(tile_id, limit):
+        """Counts the tiles which remain to be submitted here, including
+        tile_id, stopping once limit is reached. Tiles finished by other
+        nodes, or leased by them and not expired, are not counted. The lease
+        of each tile is read at most once per heartbeat, rather than every
+        time a tile is submitted."""
+        if leases is None:
+            return len(tile_ids) - order[tile_id]
+        left, done, now = 1, [], time.time()
+        for other in unsettled:
+            if left >= limit:
+                break
+            if other in checked and \
+                    now - checked[other][0] < leases.heartbeat:
+                expires = checked[other][1]
+            elif leases.is_done(other):
+                done.append(other)
+                continue
+            else:
+                lease = leases.read(other)
+                expires = lease['expires'] if lease is not None else 0
+                checked[other] = (now, expires)
+            if expires < now:
+                left += 1
+        for other in done:
+            del unsettled[other]
+        return left
+
+    def submit(key):
+        tile_id, subtile = key
+        tmp_odir = None
+        if speculate and subtile is not MERGE:
+            tmp_odir = temp_output_dir(kwargs['odir'])
+            kws = dict(kwargs, odir=tmp_odir)
+        else:
+            kws = kwargs
+        if subtile is None:
+            job = executor.submit(func, tile_id, **kws)
+        elif subtile is MERGE:
+            job = executor.submit(merge, tile_id, list(subtiles[tile_id]),
+                                  **kwargs)
+        else:
+            job = executor.submit(func, tile_id, subtile=subtile,
+                                  buffer=buffer, **kws)
+        attempts[job] = (key, time.time(), tmp_odir)
+        running.setdefault(key, []).append(job)
+
+    def discard(job):
+        "Removes the outputs of an attempt once it has finished"
+        tmp_odir = attempts[job][2]
+        if tmp_odir is not None:
+            losers.append(tmp_odir)
+        job.add_done_callback(lambda _: _remove_dir(tmp_odir))
+
+    def finish(tile_id, job):
+        jobs[tile_id] = job
+        subtiles.pop(tile_id, None)
+        if leases is not None:
+            leases.release(tile_id, done=job.exception() is None)
+
+    def stragglers():
+        "Yields each attempt that is running, alone, past its deadline"
+        expected = statistics.median(rates)
+        for key, start, _ in list(attempts.values()):
+            if key is None or key[1] is MERGE or len(running[key]) > 1:
+                continue
+            yield key, start + slowdown * expected * key_size(key)
+
+    try:
+        while True:
+            while not exhausted and len(attempts) < executor.workers and \
+                    time.time() >= retry_at:
+                tile_id = next(to_submit, EXHAUSTED)
+                if tile_id is EXHAUSTED:
+                    exhausted = True
+                elif tile_id is None:
+                    # only tiles leased by other nodes are left, wait to see
+                    # whether they are finished or their leases expire
+                    retry_at = time.time() + leases.heartbeat
+                else:
+                    unsettled.pop(tile_id, None)
+                    idle = executor.workers - len(attempts)
+                    if merge is not None and \
+                            left_to_submit(tile_id, idle) < idle:
+                        # fewer tiles left than idle workers, split this one
+                        sub_ids = split_tile(tile_id, parts, buffer).index
+                        subtiles[tile_id] = OrderedDict(
+                            (sub_id, None) for sub_id in sub_ids)
+                        for sub_id in sub_ids:
+                            submit((tile_id, sub_id))
+                    else:
+                        submit((tile_id, None))
+
+            # wake up when the next attempt becomes a straggler
+            timeout = None
+            if speculate and exhausted and rates:
+                now = time.time()
+                for key, deadline in stragglers():
+                    if deadline <= now and len(attempts) < executor.workers:
+                        submit(key)
+                    elif deadline > now:
+                        timeout = min(timeout or deadline - now,
+                                      deadline - now)
+
+            # attempts that lost are not waited on
+            if exhausted and not running:
+                break
+
+            if not exhausted and retry_at > time.time():
+                wait = retry_at - time.time()
+                timeout = wait if timeout is None else min(timeout, wait)
+            if not attempts:
+                time.sleep(timeout)
+                continue
+            done, _ = executor.wait(list(attempts), timeout=timeout)
+
+            for job in done:
+                key, start, tmp_odir = attempts.pop(job)
+                if key is None:  # an attempt that lost, already discarded
+                    continue
+                if key[1] is None:
+                    prefetch()
+                running[key].remove(job)
+                failed = job.exception() is not None
+                if failed:
+                    _remove_dir(tmp_odir)
+                if failed and running[key]:
+                    continue  # let the other attempt finish
+                if not failed and tmp_odir is not None:
+                    commit_output_dir(tmp_odir, kwargs['odir'])
+                for other in running.pop(key):
+                    if not executor.cancel(other):
+                        # already running, keep counting it against its
+                        # worker until it finishes
+                        discard(other)
+                        attempts[other] = (None,) + attempts[other][1:]
+                    else:
+                        _remove_dir(attempts.pop(other)[2])
+
+                tile_id, subtile = key
+                if tile_id in jobs:  # another sub-tile of this tile failed
+                    continue
+                if not failed and subtile is not MERGE:
+                    rates.append((time.time() - start) / key_size(key))
+
+                if subtile is None or subtile is MERGE or failed:
+                    finish(tile_id, job)
+                else:
+                    subtiles[tile_id][subtile] = job
+                    if all(subtiles[tile_id].values()):
+                        submit((tile_id, MERGE))
+    except BaseException:
+        for job in list(attempts):
+            if executor.cancel(job):
+                _remove_dir(attempts.pop(job)[2])
+            else:
+                discard(job)
+        raise
+
+    return OrderedDict(
+        sorted(jobs.items(), key=lambda item: order[item[0]]))
+
+
+def _remove_dir(path):
+    "Removes the temporary output directory of an attempt, if it had one"
+    if path is not None:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# marks the job which merges the outputs of the sub-tiles of a tile
+MERGE = object()
+
+# marks the end of the tiles to submit
+EXHAUSTED = object()
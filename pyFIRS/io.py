@@ -0,0 +1,1027 @@
+"""Reading lidar data files directly, without starting external processes."""
+import glob
+import os
+import struct
+from collections import deque
+from concurrent import futures
+
+import numpy as np
+
+from pyFIRS.utils import (commit_output, discard_output, listlike,
+                          temp_output_path)
+
+# the public header block up to the fields added in each LAS version
+HEADER_FORMAT = '<4sHH16sBB32s32sHHHIIBHI5I3d3d6d'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)  # 227 bytes, LAS 1.0 to 1.2
+HEADER_14_FORMAT = '<QQIQ15Q'  # waveform, EVLRs and 64-bit point counts
+VLR_HEADER = struct.Struct('<H16sHH32s')
+EVLR_HEADER = struct.Struct('<H16sHQ32s')
+# the tiling written by lastile: the quadtree level and index of the tile, a
+# flag for buffered tiles, and the bounds of the quadtree
+LASTILING_VLR = struct.Struct('<III4f')
+
+# GeoTIFF keys identifying the coordinate reference system
+PROJECTED_CS_KEY = 3072
+GEOGRAPHIC_CS_KEY = 2048
+USER_DEFINED = 32767
+
+# bytes of the standard dimensions of each point data record format
+POINT_RECORD_SIZES = {0: 20, 1: 28, 2: 26, 3: 34, 4: 57, 5: 63, 6: 30, 7: 36,
+                      8: 38, 9: 59, 10: 67}
+
+# layers of point formats 6-10 in LAZ files which can be decompressed on
+# their own, as the lazrs SELECTIVE_DECOMPRESS flag needed for each field.
+# X, Y and the return numbers are always decompressed, other fields not
+# listed here are extra bytes.
+LAZ_LAYERS = {
+    'X': 0, 'Y': 0, 'bit_fields': 0,
+    'Z': 1,
+    'classification': 2,
+    'classification_flags': 4,
+    'intensity': 8,
+    'scan_angle': 16,
+    'user_data': 32,
+    'point_source_id': 64,
+    'gps_time': 128,
+    'red': 256, 'green': 256, 'blue': 256,
+    'nir': 512,
+    'wavepacket_index': 1024, 'wavepacket_offset': 1024,
+    'wavepacket_size': 1024, 'return_point_wave_location': 1024,
+    'x_t': 1024, 'y_t': 1024, 'z_t': 1024,
+}
+EXTRA_BYTES_LAYER = 2048
+
+# memory used by each chunk of points read, unless another budget is given
+CHUNK_MEMORY = 2**26
+
+# dimensions packed into the bits of a byte of each point record, given as
+# the field holding them and their mask, for point formats 0-5 and 6-10
+BIT_FIELDS_0 = {
+    'return_number': ('bit_fields', 0b00000111),
+    'number_of_returns': ('bit_fields', 0b00111000),
+    'scan_direction_flag': ('bit_fields', 0b01000000),
+    'edge_of_flight_line': ('bit_fields', 0b10000000),
+    'classification': ('raw_classification', 0b00011111),
+    'synthetic': ('raw_classification', 0b00100000),
+    'key_point': ('raw_classification', 0b01000000),
+    'withheld': ('raw_classification', 0b10000000),
+}
+BIT_FIELDS_6 = {
+    'return_number': ('bit_fields', 0b00001111),
+    'number_of_returns': ('bit_fields', 0b11110000),
+    'synthetic': ('classification_flags', 0b00000001),
+    'key_point': ('classification_flags', 0b00000010),
+    'withheld': ('classification_flags', 0b00000100),
+    'overlap': ('classification_flags', 0b00001000),
+    'scanner_channel': ('classification_flags', 0b00110000),
+    'scan_direction_flag': ('classification_flags', 0b01000000),
+    'edge_of_flight_line': ('classification_flags', 0b10000000),
+}
+
+
+class LasHeader(object):
+    """The public header block of a LAS or LAZ file.
+
+    Only the header and the variable length records describing the coordinate
+    reference system are read, so reading a header takes microseconds
+    regardless of the size of the file. LAZ files share the header of LAS
+    files, so both are supported without decompressing any points.
+
+    Parameters
+    ----------
+    path : string, path to file
+        LAS or LAZ file to read
+
+    Attributes
+    ----------
+    version : tuple
+        major and minor LAS version, e.g. (1, 4)
+    point_format : int
+        point data record format
+    point_record_length : int
+        number of bytes in each point record
+    point_count : int
+        number of points in the file
+    points_by_return : tuple
+        number of points for each return number
+    scale, offset : tuples
+        scale factors and offsets applied to the integer x, y, and z values
+        stored for each point
+    mins, maxs : tuples
+        minimum and maximum x, y, and z of the points
+    compressed : bool
+        whether points are compressed (i.e., the file is a LAZ file)
+    offset_to_points : int
+        position in the file where point records begin
+    epsg : int or None
+        EPSG code from the GeoTIFF keys of the file, if any
+    wkt : string or None
+        OGC Well Known Text of the coordinate reference system, if any
+    laszip_vlr : bytes or None
+        contents of the LASzip variable length record of a LAZ file, which
+        describes how its points are compressed
+    tile_bbox : tuple or None
+        (xmin, ymin, xmax, ymax) of the tile a file written by lastile holds,
+        excluding any buffer, as used by the `use_tile_bb` option of LAStools
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            raw = f.read(375)
+            if len(raw) < HEADER_SIZE or raw[:4] != b'LASF':
+                raise ValueError('{} is not a LAS or LAZ file'.format(path))
+
+            fields = struct.unpack(HEADER_FORMAT, raw[:HEADER_SIZE])
+            self.version = (fields[4], fields[5])
+            self.header_size = fields[10]
+            self.offset_to_points = fields[11]
+            num_vlrs = fields[12]
+            self.point_format = fields[13] & 0x3F
+            self.compressed = bool(fields[13] & 0x80)
+            self.point_record_length = fields[14]
+            self.point_count = fields[15]
+            self.points_by_return = tuple(fields[16:21])
+            self.scale = tuple(fields[21:24])
+            self.offset = tuple(fields[24:27])
+            max_x, min_x, max_y, min_y, max_z, min_z = fields[27:33]
+            self.mins = (min_x, min_y, min_z)
+            self.maxs = (max_x, max_y, max_z)
+
+            evlr_start, num_evlrs = 0, 0
+            if self.version >= (1, 4) and len(raw) >= 375:
+                extra = struct.unpack(HEADER_14_FORMAT, raw[227:375])
+                evlr_start, num_evlrs = extra[1], extra[2]
+                # 64-bit counts are used when the legacy counts cannot hold
+                # the number of points or the point format is 6 or higher
+                if extra[3]:
+                    self.point_count = extra[3]
+                    self.points_by_return = tuple(extra[4:19])
+
+            self.epsg, self.wkt, self.laszip_vlr = None, None, None
+            self.tile_bbox = None
+            f.seek(self.header_size)
+            for _ in range(num_vlrs):
+                record = VLR_HEADER.unpack(f.read(VLR_HEADER.size))
+                self._read_vlr(f, record[1], record[2], record[3])
+            if num_evlrs:
+                f.seek(evlr_start)
+                for _ in range(num_evlrs):
+                    record = EVLR_HEADER.unpack(f.read(EVLR_HEADER.size))
+                    self._read_vlr(f, record[1], record[2], record[3])
+
+    def _read_vlr(self, f, user_id, record_id, length):
+        """Parses a variable length record if it describes the coordinate
+        reference system or the LAZ compression, otherwise skips over it."""
+        user_id = user_id.rstrip(b'\x00')
+        if user_id == b'laszip encoded' and record_id == 22204:
+            self.laszip_vlr = f.read(length)
+            return
+        if user_id == b'LAStools' and record_id == 10:
+            self.tile_bbox = tile_bbox(f.read(length))
+            return
+        if user_id != b'LASF_Projection' or record_id not in (34735, 2112):
+            f.seek(length, 1)
+            return
+
+        data = f.read(length)
+        if record_id == 2112:  # OGC coordinate system WKT
+            self.wkt = data.rstrip(b'\x00').decode('utf-8', 'replace')
+            return
+
+        # GeoKeyDirectoryTag, a header followed by entries of 4 shorts
+        num_keys = struct.unpack_from('<4H', data)[3]
+        keys = struct.unpack_from('<{}H'.format(4 * num_keys), data, 8)
+        found = {}
+        for i in range(0, len(keys), 4):
+            key_id, location, _, value = keys[i:i + 4]
+            if location == 0:  # value is stored in the key itself
+                found[key_id] = value
+        for key_id in (PROJECTED_CS_KEY, GEOGRAPHIC_CS_KEY):
+            if found.get(key_id, USER_DEFINED) != USER_DEFINED:
+                self.epsg = found[key_id]
+                break
+
+    @property
+    def bounds(self):
+        "The (xmin, ymin, zmin, xmax, ymax, zmax) of the points"
+        return self.mins + self.maxs
+
+    @property
+    def crs(self):
+        """The coordinate reference system as WKT or an 'EPSG:code' string,
+        as accepted by rasterio and geopandas, or None if not declared."""
+        if self.wkt:
+            return self.wkt
+        if self.epsg:
+            return 'EPSG:{}'.format(self.epsg)
+        return None
+
+    def __repr__(self):
+        return '<LasHeader {}: {:,d} points, format {}, LAS {}.{}>'.format(
+            self.path, self.point_count, self.point_format, *self.version)
+
+
+def tile_bbox(data):
+    """Finds the bounds of a tile from the tiling record written by lastile.
+
+    The tile is the cell at `level_index` of a quadtree `level` levels deep
+    over the bounds in the record, found by halving the bounds once for each
+    level, as LAStools does.
+
+    Returns
+    -------
+    bbox : tuple
+        (xmin, ymin, xmax, ymax) of the tile
+    """
+    level, level_index, _, min_x, max_x, min_y, max_y = \
+        LASTILING_VLR.unpack_from(data)
+    while level:
+        index = (level_index >> (2 * (level - 1))) & 3
+        mid_x, mid_y = (min_x + max_x) / 2.0, (min_y + max_y) / 2.0
+        if index & 1:
+            min_x = mid_x
+        else:
+            max_x = mid_x
+        if index & 2:
+            min_y = mid_y
+        else:
+            max_y = mid_y
+        level -= 1
+    return (min_x, min_y, max_x, max_y)
+
+
+def read_header(path):
+    """Reads the header of a LAS or LAZ file.
+
+    Returns
+    -------
+    header : LasHeader
+    """
+    return LasHeader(path)
+
+
+def read_bounds(paths):
+    """Reads the combined bounds of one or more LAS or LAZ files from their
+    headers.
+
+    Parameters
+    ----------
+    paths : string or list-like of strings
+        paths to files, which may include wildcards such as 'tiles/*.laz'
+
+    Returns
+    -------
+    bounds : tuple
+        a 6-tuple containing (xmin, ymin, zmin, xmax, ymax, zmax)
+    """
+    if not listlike(paths):
+        paths = [paths]
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(path)) or [path])
+
+    headers = [read_header(path) for path in files]
+    mins = [min(h.mins[i] for h in headers) for i in range(3)]
+    maxs = [max(h.maxs[i] for h in headers) for i in range(3)]
+    return tuple(mins + maxs)
+
+
+class PointChunk(object):
+    """A chunk of point records read from a LAS or LAZ file.
+
+    Records are held as a NumPy structured array with the fields of the LAS
+    point format, in which X, Y and Z are the 32-bit integers stored in the
+    file, taking a third of the memory of real-world coordinates as 64-bit
+    floats. Real-world coordinates are only computed, from the scale and
+    offset of the file, when `x`, `y` or `z` are accessed, and points can be
+    assigned to grid cells without computing them at all, using `cells`.
+    Dimensions packed into the bits of a field, such as classification and
+    return_number, are unpacked when accessed by name.
+
+    Example
+    -------
+    >>> for chunk in iter_points('tile.laz', memory=2**28):
+    ...     ground = chunk['classification'] == 2
+    ...     heights = chunk.z[ground]
+
+    Parameters
+    ----------
+    array : structured array
+        point records
+    scale, offset : tuples
+        scale factors and offsets of the x, y, and z coordinates
+    point_format : int
+        LAS point data record format of the records
+    """
+
+    def __init__(self, array, scale, offset, point_format):
+        self.array = array
+        self.scale = scale
+        self.offset = offset
+        self.point_format = point_format
+        self.bit_fields = BIT_FIELDS_6 if point_format >= 6 else BIT_FIELDS_0
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, name):
+        if name in self.array.dtype.names:
+            return self.array[name]
+        if name in self.bit_fields:
+            field, mask = self.bit_fields[name]
+            shift = (mask & -mask).bit_length() - 1
+            return (self.array[field] & mask) >> shift
+        raise KeyError('{} is not a dimension of point format {}'.format(
+            name, self.point_format))
+
+    @property
+    def names(self):
+        "Names of the dimensions of the points"
+        fields = [name for name in self.array.dtype.names
+                  if not any(field == name for field, _ in
+                             self.bit_fields.values())]
+        return fields + [name for name, (field, _) in self.bit_fields.items()
+                         if field in self.array.dtype.names]
+
+    def scaled(self, axis):
+        "Real-world coordinates along an axis, 'x', 'y' or 'z'"
+        i = 'xyz'.index(axis)
+        return self.array[axis.upper()] * self.scale[i] + self.offset[i]
+
+    @property
+    def x(self):
+        return self.scaled('x')
+
+    @property
+    def y(self):
+        return self.scaled('y')
+
+    @property
+    def z(self):
+        return self.scaled('z')
+
+    def quantize(self, value, axis):
+        """Converts a real-world coordinate along an axis, 'x', 'y' or 'z',
+        into the units of the stored integers."""
+        i = 'xyz'.index(axis)
+        return (value - self.offset[i]) / self.scale[i]
+
+    def cells(self, transform):
+        """Assigns each point to a cell of a grid.
+
+        The origin and resolution of the grid are converted into the units of
+        the stored integer coordinates, rather than converting every point
+        into real-world coordinates. When the grid aligns with those units,
+        as when the resolution is a multiple of the scale (e.g., a 0.5 m grid
+        of points stored in centimeters), cells are assigned using exact
+        integer arithmetic.
+
+        Parameters
+        ----------
+        transform : Affine
+            transform of a north-up grid, as returned by
+            `pyFIRS.chm.make_grid`
+
+        Returns
+        -------
+        rows, cols : arrays
+            row and column of the cell holding each point, which are outside
+            the bounds of the grid for points outside of it
+        """
+        x0 = self.quantize(transform.c, 'x')
+        y1 = self.quantize(transform.f, 'y')
+        step_x = transform.a / self.scale[0]
+        step_y = -transform.e / self.scale[1]
+        X = self.array['X'].astype(np.int64)
+        Y = self.array['Y'].astype(np.int64)
+
+        values = np.array((x0, y1, step_x, step_y))
+        if np.allclose(values, np.round(values), rtol=0, atol=1e-6):
+            x0, y1, step_x, step_y = np.round(values).astype(np.int64)
+            return (y1 - Y) // step_y, (X - x0) // step_x
+        rows = np.floor((y1 - Y) / step_y).astype(np.int64)
+        cols = np.floor((X - x0) / step_x).astype(np.int64)
+        return rows, cols
+
+    def to_dict(self, scaled=True):
+        """Unpacks the points into a dict of arrays, one for each dimension.
+
+        If scaled, coordinates are real-world values keyed as 'x', 'y', and
+        'z', rather than the stored integers keyed as 'X', 'Y', and 'Z'.
+        """
+        points = {}
+        for name in self.names:
+            if scaled and name in ('X', 'Y', 'Z'):
+                points[name.lower()] = self.scaled(name.lower())
+            else:
+                points[name] = self[name]
+        return points
+
+
+def chunk_points(header, memory=CHUNK_MEMORY, record_size=None):
+    """Number of points which can be read at once within a memory budget.
+
+    Each point takes the bytes of its record, plus room for its real-world
+    x, y, and z coordinates once computed.
+
+    Parameters
+    ----------
+    header : LasHeader
+        header of the file to be read
+    memory : int
+        bytes of memory for each chunk
+    record_size : int (optional)
+        bytes of each point record held, if only some fields are read.
+        Defaults to the full point record length.
+    """
+    record_size = record_size or header.point_record_length
+    return max(1, int(memory // (record_size + 3 * 8)))
+
+
+def point_dtype(path):
+    """The NumPy structured dtype of the point records of a LAS or LAZ file,
+    including any extra bytes dimensions it declares."""
+    import laspy
+
+    with laspy.open(path) as reader:
+        dtype = reader.header.point_format.dtype()
+        record_length = reader.header.point_format.size
+    if dtype.itemsize < record_length:  # undeclared extra bytes
+        dtype = np.dtype(dtype.descr + [
+            ('extra_bytes', 'u1', (record_length - dtype.itemsize,))])
+    return dtype
+
+
+def memmap_points(path, mode='r'):
+    """Maps the point records of an uncompressed LAS file into memory.
+
+    The records are exposed as a structured array backed by `np.memmap`,
+    without reading, parsing or copying them. Pages of the file are only read
+    when the points on them are used, and are cached by the operating system,
+    so repeated vectorized passes over a tile, such as filtering, binning or
+    looking up heights, run at memory speed rather than decoding speed.
+
+    Parameters
+    ----------
+    path : string, path to file
+        uncompressed LAS file
+    mode : string
+        'r' for read-only access, or 'r+' to modify points in place
+
+    Returns
+    -------
+    points : PointChunk
+        all the points of the file
+    """
+    header = read_header(path)
+    if header.compressed:
+        raise ValueError('{} is compressed, only LAS files can be memory '
+                         'mapped'.format(path))
+    array = np.memmap(path, dtype=point_dtype(path), mode=mode,
+                      offset=header.offset_to_points,
+                      shape=(header.point_count,))
+    return PointChunk(array, header.scale, header.offset, header.point_format)
+
+
+def stored_fields(fields, dtype, point_format):
+    """Lists the fields of point records holding a set of dimensions.
+
+    Parameters
+    ----------
+    fields : list-like of strings
+        dimensions, as named by `PointChunk`. The coordinates may be given as
+        'x', 'y', and 'z', and dimensions packed into bits, such as
+        classification in point formats 0-5, are held by the field they are
+        packed into.
+    dtype : structured dtype
+        layout of the point records, as returned by `point_dtype`
+    point_format : int
+        LAS point data record format
+
+    Returns
+    -------
+    names : list
+        names of the fields of dtype to keep, in the order of the records
+    """
+    bit_fields = BIT_FIELDS_6 if point_format >= 6 else BIT_FIELDS_0
+    needed = set()
+    for name in fields:
+        if name in ('x', 'y', 'z'):
+            name = name.upper()
+        if name in dtype.names:
+            needed.add(name)
+        elif name in bit_fields and bit_fields[name][0] in dtype.names:
+            needed.add(bit_fields[name][0])
+        else:
+            raise KeyError('{} is not a dimension of point format {}'.format(
+                name, point_format))
+    return [name for name in dtype.names if name in needed]
+
+
+def decompression_selection(fields, point_format):
+    """The layers of a LAZ file which must be decompressed to read fields.
+
+    Point formats 6-10 are compressed in layers which can be decompressed
+    independently, so the layers of fields which are not needed can be
+    skipped. Points of formats 0-5 are always decompressed in full.
+
+    Parameters
+    ----------
+    fields : list-like of strings
+        names of the fields of the point records to read, as returned by
+        `stored_fields`, or None for all fields
+
+    Returns
+    -------
+    selection : int
+        a combination of lazrs SELECTIVE_DECOMPRESS flags
+    """
+    everything = 0xFFFFFFFF  # lazrs.SELECTIVE_DECOMPRESS_ALL
+    if fields is None or point_format < 6:
+        return everything
+    selection = 0
+    for name in fields:
+        selection |= LAZ_LAYERS.get(name, EXTRA_BYTES_LAYER)
+    return selection
+
+
+def laz_chunk_table(path, header=None):
+    """Lists the chunks a LAZ file is compressed in, each of which can be
+    decompressed independently.
+
+    Returns
+    -------
+    chunks : list of tuples
+        (number of points, position in file, number of bytes) of each chunk
+    """
+    import lazrs
+
+    if header is None:
+        header = read_header(path)
+    with open(path, 'rb') as f:
+        f.seek(header.offset_to_points)
+        table = lazrs.read_chunk_table(f, lazrs.LazVlr(header.laszip_vlr))
+        position = f.tell()  # the table is preceded by its own offset
+
+    chunks = []
+    remaining = header.point_count
+    for count, nbytes in table:
+        # tables of fixed size chunks report a full last chunk
+        count = min(count, remaining)
+        chunks.append((count, position, nbytes))
+        position += nbytes
+        remaining -= count
+    return chunks
+
+
+def _decompress_chunk(path, header, chunk, dtype, out, selection=None):
+    """Decompresses a chunk of a LAZ file into an array, which may hold only
+    some of the fields of the point records."""
+    import lazrs
+
+    count, position, nbytes = chunk
+    with open(path, 'rb') as f:
+        f.seek(position)
+        data = f.read(nbytes)
+
+    if out.dtype == dtype:
+        buffer = out
+    else:  # only the chunk being decompressed holds every field
+        buffer = np.zeros(count, dtype=dtype)
+    if selection is not None:
+        selection = lazrs.DecompressionSelection(selection)
+    lazrs.decompress_points_with_chunk_table(
+        data, header.laszip_vlr, buffer.view(np.uint8), [(count, nbytes)],
+        selection)
+    if buffer is not out:
+        for name in out.dtype.names:
+            out[name] = buffer[name]
+
+
+def _iter_laz_arrays(path, header, dtype, chunk_size, workers, fields=None):
+    """Decompresses the chunks of a LAZ file in a pool of threads, yielding
+    arrays of consecutive chunks holding at least chunk_size points in the
+    order they are stored. The next array is decompressed while the current
+    one is used. If fields are given, the arrays only hold those fields, and
+    only the layers of the file holding them are decompressed."""
+    batches, batch, count = [], [], 0
+    for chunk in laz_chunk_table(path, header):
+        batch.append(chunk)
+        count += chunk[0]
+        if count >= chunk_size:
+            batches.append(batch)
+            batch, count = [], 0
+    if batch:
+        batches.append(batch)
+
+    out_dtype = dtype
+    selection = None
+    if fields is not None:
+        out_dtype = np.dtype([(name, dtype.fields[name][0])
+                              for name in fields])
+        selection = decompression_selection(fields, header.point_format)
+
+    def submit(batch):
+        array = np.empty(sum(chunk[0] for chunk in batch), dtype=out_dtype)
+        jobs, start = [], 0
+        for chunk in batch:
+            stop = start + chunk[0]
+            jobs.append(pool.submit(_decompress_chunk, path, header, chunk,
+                                    dtype, array[start:stop], selection))
+            start = stop
+        return array, jobs
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(submit(batch))
+            if len(pending) > 1:
+                array, jobs = pending.popleft()
+                for job in jobs:
+                    job.result()
+                yield array
+        while pending:
+            array, jobs = pending.popleft()
+            for job in jobs:
+                job.result()
+            yield array
+
+
+def iter_points(path, chunk_size=None, memory=CHUNK_MEMORY, as_dict=False,
+                workers=None, fields=None):
+    """Iterates over the points of a LAS or LAZ file in chunks.
+
+    Only a chunk or two is held in memory at a time, so files much larger
+    than memory can be processed. The chunks of uncompressed LAS files are
+    views of `memmap_points`. LAZ files are compressed in chunks which can be
+    decompressed independently, so these are decompressed by a pool of
+    threads (using lazrs, which releases the GIL), and reassembled in order.
+    Reading a single large tile therefore scales with the number of cores.
+
+    Parameters
+    ----------
+    path : string, path to file
+        LAS or LAZ file to read
+    chunk_size : int (optional)
+        number of points in each chunk. Defaults to as many as fit in memory.
+    memory : int
+        bytes of memory for each chunk, used if chunk_size is not provided
+    as_dict : bool
+        whether to yield each chunk as a dict of arrays, as returned by
+        `PointChunk.to_dict`, rather than a PointChunk
+    workers : int (optional)
+        number of threads decompressing LAZ files. Defaults to the number of
+        cores on this machine.
+    fields : list-like of strings (optional)
+        dimensions to read, such as ['x', 'y', 'z', 'classification',
+        'return_number'], as described for `stored_fields`. Chunks only hold
+        the fields of the point records holding these dimensions, so more
+        points fit in the memory budget. For point formats 6-10 in LAZ files,
+        other dimensions, such as RGB, GPS time and extra bytes, are not even
+        decompressed. By default, every dimension is read.
+
+    Yields
+    ------
+    chunk : PointChunk or dict
+        the next chunk of points, in the order they are stored in the file
+    """
+    header = read_header(path)
+    dtype = point_dtype(path)
+    if fields is not None:
+        fields = stored_fields(fields, dtype, header.point_format)
+    if chunk_size is None:
+        record_size = dtype.itemsize if fields is None else sum(
+            dtype.fields[name][0].itemsize for name in fields)
+        chunk_size = chunk_points(header, memory, record_size)
+
+    if header.compressed:
+        arrays = _iter_laz_arrays(path, header, dtype, chunk_size,
+                                  workers or os.cpu_count() or 1, fields)
+    elif fields is not None:
+        arrays = [memmap_points(path).array[fields]]
+    else:
+        arrays = [memmap_points(path).array]
+
+    # arrays are sliced into chunks of chunk_size, carrying any remainder
+    # over to the next array
+    carry = None
+    for array in arrays:
+        if carry is not None and len(carry):
+            array = np.concatenate((carry, array))
+        whole = len(array) - len(array) % chunk_size
+        for start in range(0, whole, chunk_size):
+            chunk = PointChunk(array[start:start + chunk_size], header.scale,
+                               header.offset, header.point_format)
+            yield chunk.to_dict() if as_dict else chunk
+        carry = array[whole:]
+    if carry is not None and len(carry):
+        chunk = PointChunk(carry, header.scale, header.offset,
+                           header.point_format)
+        yield chunk.to_dict() if as_dict else chunk
+
+
+def read_points(path, workers=None, fields=None):
+    """Reads all the points of a LAS or LAZ file at once.
+
+    LAZ files are decompressed by a pool of threads, and fields may be
+    selected, as for `iter_points`.
+
+    Returns
+    -------
+    points : PointChunk
+    """
+    header = read_header(path)
+    if not header.compressed:
+        points = memmap_points(path)
+        if fields is None:
+            array = np.array(points.array)
+        else:
+            fields = stored_fields(fields, points.array.dtype,
+                                   header.point_format)
+            array = np.empty(len(points), dtype=[
+                (name, points.array.dtype.fields[name][0])
+                for name in fields])
+            for name in fields:
+                array[name] = points.array[name]
+        return PointChunk(array, header.scale, header.offset,
+                          header.point_format)
+
+    for chunk in iter_points(path, chunk_size=max(1, header.point_count),
+                             workers=workers, fields=fields):
+        return chunk
+    dtype = point_dtype(path)
+    if fields is not None:
+        dtype = np.dtype([(name, dtype.fields[name][0]) for name in
+                          stored_fields(fields, dtype, header.point_format)])
+    return PointChunk(np.empty(0, dtype=dtype), header.scale, header.offset,
+                      header.point_format)
+
+
+def _compress_chunk(laszip_vlr, data):
+    "Compresses a chunk of point records, without a chunk table"
+    import lazrs
+
+    compressed = bytes(lazrs.compress_points(laszip_vlr, data, False))
+    # the stream begins with the offset to its chunk table, which follows
+    # the compressed points
+    table_offset = struct.unpack_from('<q', compressed)[0]
+    return compressed[8:table_offset]
+
+
+class LazWriter(object):
+    """Writes points to a LAZ file, compressing chunks of points in parallel.
+
+    Points are compressed in chunks which do not depend on each other, so
+    each chunk is compressed by one of a pool of threads (using lazrs, which
+    releases the GIL). Compressed chunks are written to disk in order as soon
+    as they and the chunks before them are done, and a chunk table is written
+    at the end, so the file can be read by LAStools, laspy, PDAL and
+    `iter_points` alike. Writing a tile therefore scales with the number of
+    cores.
+
+    The header and variable length records, including the extended records
+    of LAS 1.4, are copied from a template file, typically the file the
+    points were read from, and the point counts and bounds are updated from
+    the points written. The file is written to a
+    temporary name and only renamed to its final name when closed, so an
+    interrupted writer never leaves a partial file.
+
+    Example
+    -------
+    >>> with LazWriter('ground.laz', template='tile.laz') as writer:
+    ...     for chunk in iter_points('tile.laz'):
+    ...         writer.write(chunk.array[chunk['classification'] == 2])
+
+    Parameters
+    ----------
+    path : string, path to file
+        LAZ file to write
+    template : string, path to file
+        LAS or LAZ file whose point format, scale, offset and coordinate
+        reference system are used. Points written must have the same record
+        layout and use the same scale and offset.
+    workers : int (optional)
+        number of threads compressing chunks. Defaults to the number of cores
+        on this machine.
+    """
+
+    def __init__(self, path, template, workers=None):
+        import lazrs
+
+        self.path = path
+        self.header = read_header(template)
+        self.dtype = point_dtype(template)
+        self.workers = workers or os.cpu_count() or 1
+        extra_bytes = self.header.point_record_length - \
+            POINT_RECORD_SIZES[self.header.point_format]
+        self.laszip_vlr = lazrs.LazVlr.new_for_compression(
+            self.header.point_format, extra_bytes)
+        self.chunk_size = self.laszip_vlr.chunk_size()
+
+        # copy the header and the records describing the points, except for
+        # any LASzip record, which is replaced by our own
+        with open(template, 'rb') as f:
+            self.raw_header = bytearray(f.read(self.header.header_size))
+            num_vlrs = struct.unpack_from('<I', self.raw_header, 100)[0]
+            vlrs = []
+            for _ in range(num_vlrs):
+                vlr_header = f.read(VLR_HEADER.size)
+                data = f.read(VLR_HEADER.unpack(vlr_header)[3])
+                user_id = VLR_HEADER.unpack(vlr_header)[1].rstrip(b'\x00')
+                if user_id != b'laszip encoded':
+                    vlrs.append(vlr_header + data)
+
+            # the extended records of LAS 1.4, such as a WKT coordinate
+            # system, are copied to follow the chunk table
+            evlrs, self.waveform_offset = [], None
+            if len(self.raw_header) >= 375:
+                evlr_start, num_evlrs = struct.unpack_from(
+                    '<QI', self.raw_header, 235)
+                if num_evlrs:
+                    f.seek(evlr_start)
+                for _ in range(num_evlrs):
+                    evlr_header = f.read(EVLR_HEADER.size)
+                    _, user_id, record_id, length, _ = \
+                        EVLR_HEADER.unpack(evlr_header)
+                    if user_id.rstrip(b'\x00') == b'LASF_Spec' and \
+                            record_id == 65535:  # waveform data packets
+                        self.waveform_offset = sum(len(e) for e in evlrs)
+                    evlrs.append(evlr_header + f.read(length))
+        self.evlrs = b''.join(evlrs)
+        self.num_evlrs = len(evlrs)
+        self.evlr_start = 0
+        record_data = bytes(self.laszip_vlr.record_data())
+        vlrs.append(VLR_HEADER.pack(0, b'laszip encoded', 22204,
+                                    len(record_data), b'pyFIRS') +
+                    record_data)
+        self.vlrs = b''.join(vlrs)
+        self.num_vlrs = len(vlrs)
+        self.offset_to_points = self.header.header_size + len(self.vlrs)
+
+        self.tmp = temp_output_path(path)
+        self.file = open(self.tmp, 'wb')
+        self.file.write(self.raw_header)
+        self.file.write(self.vlrs)
+        self.file.write(struct.pack('<q', -1))  # offset to chunk table
+        self.pool = futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()  # (point count, job) of each chunk, in order
+        self.chunk_table = []
+        self.buffered, self.num_buffered = [], 0
+        self.point_count = 0
+        self.mins = np.full(3, np.iinfo(np.int32).max, dtype=np.int64)
+        self.maxs = np.full(3, np.iinfo(np.int32).min, dtype=np.int64)
+        self.by_return = np.zeros(16, dtype=np.int64)
+
+    def write(self, points):
+        """Adds points to the file.
+
+        Parameters
+        ----------
+        points : PointChunk or structured array
+            point records with the same layout as those of the template
+        """
+        array = points.array if isinstance(points, PointChunk) else points
+        if array.dtype.itemsize != self.dtype.itemsize:
+            raise ValueError('Points of {} bytes cannot be written as point '
+                             'format {}'.format(array.dtype.itemsize,
+                                                self.header.point_format))
+        self.buffered.append(array)
+        self.num_buffered += len(array)
+        if self.num_buffered >= self.chunk_size:
+            buffered = np.concatenate(self.buffered)
+            whole = len(buffered) - len(buffered) % self.chunk_size
+            for start in range(0, whole, self.chunk_size):
+                self._submit(buffered[start:start + self.chunk_size])
+            self.buffered = [buffered[whole:]]
+            self.num_buffered = len(buffered) - whole
+
+    def _submit(self, array):
+        "Tallies the points of a chunk and starts compressing it"
+        array = np.ascontiguousarray(array).view(self.dtype)
+        chunk = PointChunk(array, self.header.scale, self.header.offset,
+                           self.header.point_format)
+        for i, axis in enumerate('XYZ'):
+            self.mins[i] = min(self.mins[i], array[axis].min())
+            self.maxs[i] = max(self.maxs[i], array[axis].max())
+        self.by_return += np.bincount(chunk['return_number'],
+                                      minlength=16)[:16]
+        self.point_count += len(array)
+
+        job = self.pool.submit(_compress_chunk, self.laszip_vlr,
+                               array.tobytes())
+        self.pending.append((len(array), job))
+        # compressed chunks are written in order, and only a few are held
+        # in memory while waiting for the chunks before them
+        while len(self.pending) > 2 * self.workers:
+            self._write_next()
+
+    def _write_next(self):
+        count, job = self.pending.popleft()
+        data = job.result()
+        self.file.write(data)
+        self.chunk_table.append((count, len(data)))
+
+    def close(self):
+        """Writes the remaining points, the chunk table and the header, and
+        moves the file to its final name.
+
+        Returns
+        -------
+        path : string, path to file
+            the LAZ file written
+        """
+        import lazrs
+
+        if self.file.closed:
+            return self.path
+        try:
+            if self.num_buffered:
+                self._submit(np.concatenate(self.buffered))
+            while self.pending:
+                self._write_next()
+
+            table_offset = self.file.tell()
+            lazrs.write_chunk_table(self.file, self.chunk_table,
+                                    self.laszip_vlr)
+            if self.num_evlrs:
+                self.evlr_start = self.file.tell()
+                self.file.write(self.evlrs)
+            self.file.seek(self.offset_to_points)
+            self.file.write(struct.pack('<q', table_offset))
+            self.file.seek(0)
+            self.file.write(self._final_header())
+        except BaseException:
+            self.discard()
+            raise
+        self.pool.shutdown()
+        self.file.close()
+        commit_output(self.tmp)
+        return self.path
+
+    def _final_header(self):
+        "The header of the template, updated for the points written"
+        raw = self.raw_header
+        point_format = self.header.point_format
+        struct.pack_into('<IIB', raw, 96, self.offset_to_points,
+                         self.num_vlrs, point_format | 0x80)
+
+        # legacy counts are only used for older point formats
+        legacy = point_format < 6 and self.point_count < 2**32
+        struct.pack_into('<I5I', raw, 107,
+                         self.point_count if legacy else 0,
+                         *(self.by_return[1:6] if legacy else [0] * 5))
+
+        if self.point_count:
+            scale, offset = self.header.scale, self.header.offset
+            mins = [self.mins[i] * scale[i] + offset[i] for i in range(3)]
+            maxs = [self.maxs[i] * scale[i] + offset[i] for i in range(3)]
+        else:
+            mins = maxs = [0.0, 0.0, 0.0]
+        struct.pack_into('<6d', raw, 179, maxs[0], mins[0], maxs[1], mins[1],
+                         maxs[2], mins[2])
+
+        if len(raw) >= 375:  # LAS 1.4, with the extended records copied
+            waveform_start = 0
+            if self.waveform_offset is not None:
+                waveform_start = self.evlr_start + self.waveform_offset
+            struct.pack_into('<QQIQ15Q', raw, 227, waveform_start,
+                             self.evlr_start, self.num_evlrs,
+                             self.point_count, *self.by_return[1:16])
+        return bytes(raw)
+
+    def discard(self):
+        "Abandons the file, removing anything written"
+        for _, job in self.pending:
+            job.cancel()
+        self.pool.shutdown()
+        self.file.close()
+        discard_output(self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif not self.file.closed:
+            self.discard()
+
+
+def write_points(path, points, template, workers=None):
+    """Writes points to a LAZ file, compressing them in parallel.
+
+    Parameters are as described for `LazWriter`, with points given as a
+    PointChunk, a structured array, or an iterable of either.
+
+    Returns
+    -------
+    path : string, path to file
+        the LAZ file written
+    """
+    with LazWriter(path, template, workers=workers) as writer:
+        if isinstance(points, (PointChunk, np.ndarray)):
+            points = [points]
+        for chunk in points:
+            writer.write(chunk)
+    return path
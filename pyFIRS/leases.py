@@ -0,0 +1,323 @@
+import glob
+import json
+import os
+import platform
+import threading
+import time
+import uuid
+
+
+class TileLeases(object):
+    """Coordinates which node processes each tile using lease files on a
+    shared filesystem.
+
+    Several machines running the same pipeline against one shared acquisition
+    directory can use leases to divide the tiles among themselves without a
+    scheduler service. Before processing a tile, a node claims it by atomically
+    creating a lease file named {tile_id}.lease in lease_dir. While the node
+    holds the lease, a background thread renews it periodically (heartbeats).
+    If a node dies, its leases stop being renewed and expire after `ttl`
+    seconds, after which another node may take them over. When a tile is
+    finished, the node releases its lease and leaves a {tile_id}.done marker
+    so that no other node will claim the tile again.
+
+    Expiry is judged using the clocks of each node, so the clocks of machines
+    sharing a lease directory should be kept in sync (e.g., using NTP). A lease
+    is only renewed while at least a third of its ttl remains, so a node that
+    falls behind on its heartbeats gives up its lease rather than overwriting
+    a lease another node has since taken over.
+
+    Parameters
+    ----------
+    lease_dir : string, path to directory
+        shared directory where lease files will be written
+    node_id : string (optional)
+        name identifying this node. Defaults to the hostname and process id.
+    ttl : numeric
+        number of seconds a lease remains valid without being renewed
+    heartbeat : numeric (optional)
+        number of seconds between renewals of leases held by this node, which
+        must be less than two thirds of ttl. Defaults to one third of ttl.
+    """
+
+    def __init__(self, lease_dir, node_id=None, ttl=600, heartbeat=None):
+        self.lease_dir = lease_dir
+        os.makedirs(lease_dir, exist_ok=True)
+        self.node_id = node_id or '{}-{}'.format(platform.node(), os.getpid())
+        self.ttl = ttl
+        self.heartbeat = heartbeat or ttl / 3.0
+        if self.heartbeat >= 2 * ttl / 3.0:
+            raise ValueError('heartbeat must be less than two thirds of ttl')
+        self.held = {}  # tile_id -> token of each lease held by this node
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _lease_path(self, tile_id):
+        return os.path.join(self.lease_dir, tile_id + '.lease')
+
+    def _done_path(self, tile_id):
+        return os.path.join(self.lease_dir, tile_id + '.done')
+
+    def _write_tmp(self, tile_id, token):
+        """Writes the contents of a lease to a uniquely-named temporary file
+        and returns its path."""
+        tmp = os.path.join(self.lease_dir,
+                           '{}.{}.tmp'.format(tile_id, uuid.uuid4().hex))
+        lease = {
+            'node': self.node_id,
+            'token': token,
+            'expires': time.time() + self.ttl
+        }
+        with open(tmp, 'w') as f:
+            json.dump(lease, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return tmp
+
+    def read(self, tile_id):
+        """Reads the current lease on a tile.
+
+        Returns
+        -------
+        lease : dict or None
+            the node holding the lease, its token, and when it expires. None
+            if the tile is not leased.
+        """
+        try:
+            return self._load(self._lease_path(tile_id))
+        except FileNotFoundError:
+            return None
+
+    def _load(self, path):
+        """Parses a lease file. A lease which is empty or cannot be parsed may
+        still be being written (e.g., by a node creating leases without hard
+        links), so it is treated as held until ttl has passed since it was
+        last modified."""
+        with open(path) as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                expires = os.fstat(f.fileno()).st_mtime + self.ttl
+        return {'node': None, 'token': None, 'expires': expires}
+
+    def live(self):
+        """Lists the tiles leased by any node whose leases have not expired.
+
+        Returns
+        -------
+        tile_ids : list
+            tiles currently being processed
+        """
+        tile_ids = []
+        pattern = os.path.join(glob.escape(self.lease_dir), '*.lease')
+        for path in sorted(glob.glob(pattern)):
+            tile_id = os.path.basename(path)[:-len('.lease')]
+            lease = self.read(tile_id)
+            if lease is not None and lease['expires'] >= time.time():
+                tile_ids.append(tile_id)
+        return tile_ids
+
+    def is_done(self, tile_id):
+        "Whether any node has finished processing a tile"
+        return os.path.exists(self._done_path(tile_id))
+
+    def claim(self, tile_id):
+        """Attempts to claim a tile for this node.
+
+        Returns
+        -------
+        claimed : boolean
+            True if this node now holds the lease on the tile, False if the
+            tile is finished or held by another node whose lease has not
+            expired.
+        """
+        if self.is_done(tile_id):
+            return False
+
+        created = self._create(tile_id)
+        if not created:
+            lease = self.read(tile_id)
+            if lease is None or lease['expires'] < time.time():
+                created = self._break(tile_id) and self._create(tile_id)
+
+        # a node finishing the tile leaves its marker before removing its
+        # lease, so the tile may have been finished since it was checked
+        if created and self.is_done(tile_id):
+            self.release(tile_id, done=False)
+            return False
+        return created
+
+    def _create(self, tile_id):
+        """Atomically creates a lease file, failing if one already exists."""
+        token = uuid.uuid4().hex
+        tmp = self._write_tmp(tile_id, token)
+        try:
+            # hard links are created atomically and fail if the target
+            # exists, including on NFS where O_EXCL has historically been
+            # unreliable
+            os.link(tmp, self._lease_path(tile_id))
+        except FileExistsError:
+            return False
+        except OSError:  # filesystem does not support hard links
+            # the lease is empty until its contents are moved into place,
+            # which other nodes treat as held (see _load)
+            try:
+                fd = os.open(self._lease_path(tile_id),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+            os.close(fd)
+            os.replace(tmp, self._lease_path(tile_id))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        with self._lock:
+            self.held[tile_id] = token
+        self._start_heartbeat()
+        return True
+
+    def _break(self, tile_id):
+        """Removes an expired lease so the tile can be claimed again.
+
+        Renaming the lease out of the way is atomic, so when several nodes try
+        to break the same lease only one of them will succeed.
+        """
+        stale = os.path.join(self.lease_dir, '{}.{}.stale'.format(
+            tile_id, uuid.uuid4().hex))
+        try:
+            os.rename(self._lease_path(tile_id), stale)
+        except FileNotFoundError:  # lease was released or broken already
+            return True
+
+        lease = self._load(stale)
+        if lease['expires'] >= time.time():
+            # the owner renewed the lease after we read it, put it back
+            try:
+                os.link(stale, self._lease_path(tile_id))
+            except OSError:
+                pass
+            os.remove(stale)
+            return False
+
+        os.remove(stale)
+        return True
+
+    def renew(self, tile_id):
+        """Extends the lease this node holds on a tile.
+
+        Returns
+        -------
+        renewed : boolean
+            False if the lease is no longer held by this node, including when
+            less than a third of its ttl remained, since another node may
+            break it before it could be replaced.
+        """
+        with self._lock:
+            token = self.held.get(tile_id)
+        if token is None:
+            return False
+
+        # the new lease is written before checking the current one, so that
+        # only the rename happens between the check and the replacement
+        tmp = self._write_tmp(tile_id, token)
+        lease = self.read(tile_id)
+        renewed = lease is not None and lease['token'] == token and \
+            lease['expires'] - time.time() > self.ttl / 3.0
+        if renewed:
+            os.replace(tmp, self._lease_path(tile_id))
+            # a node whose clock runs ahead may have taken the lease over
+            lease = self.read(tile_id)
+            renewed = lease is not None and lease['token'] == token
+        else:
+            os.remove(tmp)
+
+        if not renewed:
+            with self._lock:
+                self.held.pop(tile_id, None)
+        return renewed
+
+    def release(self, tile_id, done=True):
+        """Releases the lease this node holds on a tile.
+
+        Parameters
+        ----------
+        tile_id : string
+            tile to release
+        done : boolean
+            whether the tile was finished. If True, a marker is left so no
+            other node will claim the tile. If False (e.g., processing failed),
+            the tile may be claimed again.
+        """
+        with self._lock:
+            token = self.held.pop(tile_id, None)
+        if token is None:
+            return
+
+        if done:
+            open(self._done_path(tile_id), 'a').close()
+
+        lease = self.read(tile_id)
+        if lease is not None and lease['token'] == token:
+            try:
+                os.remove(self._lease_path(tile_id))
+            except FileNotFoundError:
+                pass
+
+    def claimed(self, tile_ids):
+        """Yields the tiles from tile_ids that this node succeeds in claiming.
+
+        Tiles are claimed lazily as the generator is consumed, so nodes
+        consuming the same list of tiles at their own pace will share them.
+
+        Tiles held by other nodes are tried again once the rest have been
+        tried, since their leases will expire if those nodes die. While only
+        such tiles remain, None is yielded after each pass over them, so that
+        the consumer can finish its own work (and releases its own leases)
+        before asking again, e.g. after waiting for a heartbeat. The generator
+        ends once every tile is done or has been claimed by this node.
+        """
+        pending = list(tile_ids)
+        while pending:
+            held = []
+            for tile_id in pending:
+                if self.claim(tile_id):
+                    yield tile_id
+                elif not self.is_done(tile_id):
+                    held.append(tile_id)
+            pending = held
+            if pending:
+                yield None
+
+    def _start_heartbeat(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._beat, daemon=True)
+            self._thread.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            with self._lock:
+                tile_ids = list(self.held)
+            for tile_id in tile_ids:
+                try:
+                    self.renew(tile_id)
+                except OSError:  # shared filesystem temporarily unavailable
+                    pass
+
+    def close(self):
+        """Stops renewing leases and releases any still held, without marking
+        their tiles as done."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for tile_id in list(self.held):
+            self.release(tile_id, done=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
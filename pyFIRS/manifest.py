@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import threading
+
+from pyFIRS.utils import TileInputs, atomic_output, parse_coords_from_tileid
+
+
+def file_identity(path, checksum=False):
+    """Describes the contents of a file so that changes to it can be detected.
+
+    Parameters
+    ----------
+    path : string, path to file
+        file to identify
+    checksum : boolean
+        whether to include a SHA-1 digest of the file contents. This is slow
+        for large files, but detects changes even when a file is replaced by
+        one with the same size and modification time.
+
+    Returns
+    -------
+    identity : dict
+        size, modification time (in nanoseconds) and, optionally, the SHA-1
+        digest of the file
+    """
+    stat = os.stat(path)
+    identity = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if checksum:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                sha1.update(block)
+        identity['sha1'] = sha1.hexdigest()
+    return identity
+
+
+def stale_regions(tile_ids, region_size=None):
+    """Identifies the mosaic regions affected by a set of tiles.
+
+    Parameters
+    ----------
+    tile_ids : list-like
+        tiles which have been (re)processed, following the naming convention
+        {LLX}_{LLY}_{LENGTH}
+    region_size : int (optional)
+        length of the square regions derived products are mosaicked into, in
+        projected units. Should be a multiple of the tile length. If not
+        provided, a single mosaic covering the whole acquisition is assumed.
+
+    Returns
+    -------
+    region_ids : list
+        sorted ids of the regions to mosaic again, following the same naming
+        convention as tiles. If region_size is not provided, this is ['all']
+        when any tile is affected.
+    """
+    tile_ids = list(tile_ids)
+    if region_size is None:
+        return ['all'] if tile_ids else []
+
+    regions = set()
+    for tile_id in tile_ids:
+        llx, lly, length = parse_coords_from_tileid(tile_id)
+        regions.add((llx // region_size * region_size,
+                     lly // region_size * region_size))
+    return ['{}_{}_{}'.format(x, y, region_size) for x, y in sorted(regions)]
+
+
+class TileManifest(object):
+    """Records which source files each output tile was produced from, so that
+    only the tiles affected by new or corrected source files are reprocessed.
+
+    When a tile is processed, the identity (size, modification time and,
+    optionally, checksum) of each source file it was made from is recorded.
+    When source tiles are added or redelivered later, a tile is stale if the
+    set of source files intersecting it has changed or if any of them has
+    changed since the tile was processed.
+
+    Example
+    -------
+    >>> manifest = TileManifest(os.path.join(INTERIM, 'manifest.json'))
+    >>> intersecting_tiles = get_intersecting_tiles(src_tiles, new_tiles)
+    >>> stale = manifest.stale_tiles(intersecting_tiles, src_dir=RAW)
+    >>> results = map_tiles(make_tile, stale, executor=executor)
+    >>> manifest.record(stale)
+    >>> manifest.save()
+    >>> regions = stale_regions(stale, region_size=10000)
+
+    Parameters
+    ----------
+    path : string, path to file
+        JSON file the manifest is stored in. Loaded if it exists.
+    checksum : boolean
+        whether source files are identified using SHA-1 digests of their
+        contents in addition to their size and modification time
+    """
+
+    def __init__(self, path, checksum=False):
+        self.path = path
+        self.checksum = checksum
+        self.tiles = {}  # tile_id -> {source: identity} when processed
+        self.pending = {}  # tile_id -> {source: identity} from last scan
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.tiles = json.load(f)['tiles']
+
+    def _identify(self, path, previous=None):
+        """Identifies a source file, reusing a previous checksum if the file
+        appears unchanged."""
+        identity = file_identity(path)
+        if self.checksum:
+            if previous and previous.get('sha1') and \
+                    previous['size'] == identity['size'] and \
+                    previous['mtime'] == identity['mtime']:
+                identity['sha1'] = previous['sha1']
+            else:
+                identity = file_identity(path, checksum=True)
+        return identity
+
+    def _matches(self, recorded, current):
+        if self.checksum and 'sha1' in recorded:
+            return recorded['sha1'] == current['sha1']
+        return recorded == {k: current[k] for k in ('size', 'mtime')}
+
+    def stale_tiles(self, intersecting_tiles, src_dir=None):
+        """Identifies the tiles that need to be (re)processed.
+
+        The source files of every tile are identified, and remembered so that
+        the tiles can be recorded once they have been processed.
+
+        Parameters
+        ----------
+        intersecting_tiles : DataFrame or TileInputs
+            as returned by get_intersecting_tiles, indexed by tile_id with the
+            source files of each tile as a space-delimited string in the
+            'intersecting_files' column
+        src_dir : string, path to directory (optional)
+            directory containing the source files, if they are listed by name
+
+        Returns
+        -------
+        tile_ids : list
+            tiles which have not been processed, whose set of source files has
+            changed, or whose source files have been modified, in the order
+            they appear in intersecting_tiles
+        """
+        if isinstance(intersecting_tiles, TileInputs):
+            tiles = intersecting_tiles.items()
+        else:
+            tiles = ((tile_id, files.split(' ')) for tile_id, files in
+                     intersecting_tiles['intersecting_files'].items())
+
+        identities = {}
+        stale = []
+        for tile_id, files in tiles:
+            recorded = self.tiles.get(tile_id, {})
+            sources = {}
+            for name in files:
+                path = os.path.join(src_dir, name) if src_dir else name
+                if path not in identities:
+                    identities[path] = self._identify(path,
+                                                      recorded.get(path))
+                sources[path] = identities[path]
+
+            self.pending[tile_id] = sources
+            if set(recorded) != set(sources) or not all(
+                    self._matches(recorded[path], sources[path])
+                    for path in sources):
+                stale.append(tile_id)
+
+        return stale
+
+    def orphaned_tiles(self, intersecting_tiles):
+        """Identifies recorded tiles which no longer intersect any source
+        files, such as when source tiles are withdrawn from an acquisition.
+        """
+        current = set(intersecting_tiles.index)
+        return sorted(tile_id for tile_id in self.tiles
+                      if tile_id not in current)
+
+    def record(self, tile_ids):
+        """Records that tiles have been processed from the source files
+        identified by the last call to stale_tiles.
+
+        Parameters
+        ----------
+        tile_ids : string or list-like of strings
+            tiles which have been processed successfully
+        """
+        if isinstance(tile_ids, str):
+            tile_ids = [tile_ids]
+        with self.lock:
+            for tile_id in tile_ids:
+                self.tiles[tile_id] = self.pending[tile_id]
+
+    def forget(self, tile_ids):
+        "Removes tiles from the manifest, so they will be processed again"
+        if isinstance(tile_ids, str):
+            tile_ids = [tile_ids]
+        with self.lock:
+            for tile_id in tile_ids:
+                self.tiles.pop(tile_id, None)
+
+    def save(self):
+        "Writes the manifest to its JSON file"
+        with self.lock:
+            contents = {'checksum': self.checksum, 'tiles': self.tiles}
+            with atomic_output(self.path) as tmp:
+                with open(tmp, 'w') as f:
+                    json.dump(contents, f, indent=1, sort_keys=True)
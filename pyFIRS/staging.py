@@ -0,0 +1,507 @@
+import hashlib
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+import zlib
+from collections import Counter, OrderedDict
+from concurrent import futures
+from contextlib import contextmanager
+
+from pyFIRS.utils import (PipelineError, _commit_order, atomic_output,
+                          discard_output, listlike, temp_output_path)
+
+
+class StagingCache(object):
+    """Stages copies of input files from network storage onto local scratch.
+
+    Inputs stored on a NAS are copied into cache_dir (e.g., on a local SSD)
+    the first time they are requested, and subsequent requests are served
+    from the local copy for as long as the source file is unchanged. Copies of
+    the inputs of upcoming tiles can be made in the background with
+    `prefetch`, so a tile's inputs are usually local by the time it is
+    processed. When the cache grows beyond max_bytes, the least recently used
+    files are evicted, except for those in use.
+
+    A copy keeps the basename of its source file, so LAStools and FUSION name
+    outputs derived from it exactly as they would for the original. Sidecar
+    files sharing the stem of a source (such as LAStools .lax spatial indexes)
+    are staged along with it.
+
+    The cache is shared by the threads of one process. When running jobs in
+    several processes, give each process its own cache_dir.
+
+    Parameters
+    ----------
+    cache_dir : string, path to directory
+        local directory to hold staged copies
+    max_bytes : int
+        maximum size of the cache, in bytes
+    workers : int
+        number of files to copy concurrently in the background
+    companions : list-like of strings
+        extensions of sidecar files staged along with each source file
+    """
+
+    def __init__(self, cache_dir, max_bytes, workers=2,
+                 companions=('.lax',)):
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.companions = companions
+        self.entries = OrderedDict()  # least recently used first
+        self.pins = Counter()
+        self.pending = {}
+        self.reserved = 0  # bytes of copies in progress
+        self.lock = threading.RLock()
+        self.pool = futures.ThreadPoolExecutor(max_workers=workers)
+        self._load()
+
+    @property
+    def nbytes(self):
+        "Total size of the files held in the cache"
+        with self.lock:
+            return sum(entry['nbytes'] for entry in self.entries.values())
+
+    def _entry_dir(self, path):
+        key = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, key)
+
+    def _load(self):
+        """Indexes copies left in cache_dir by a previous session, oldest
+        first, so they can be reused."""
+        found = []
+        for key in os.listdir(self.cache_dir):
+            meta = os.path.join(self.cache_dir, key, 'meta.json')
+            try:
+                with open(meta) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                shutil.rmtree(os.path.join(self.cache_dir, key),
+                              ignore_errors=True)
+                continue
+            found.append((os.path.getmtime(meta), entry))
+        for _, entry in sorted(found, key=lambda item: item[0]):
+            self.entries[entry['source']] = entry
+
+    def _is_current(self, entry):
+        "Whether the source of a staged copy is unchanged since it was copied"
+        try:
+            stat = os.stat(entry['source'])
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and \
+            stat.st_mtime == entry['mtime'] and \
+            os.path.exists(entry['local'])
+
+    def lookup(self, path):
+        """Returns the local copy of a file if one is staged, otherwise None.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return None
+            if not self._is_current(entry):
+                # a copy in use is replaced in place when it is staged again
+                self._evict(path, delete=self.pins[path] == 0)
+                return None
+            self.entries.move_to_end(path)
+            return entry['local']
+
+    def stage(self, path):
+        """Returns the path to a local copy of a file, copying it if needed.
+
+        If the file cannot be staged (e.g., it is larger than the cache or the
+        copy fails), the original path is returned so callers can always read
+        from the path provided.
+        """
+        path = os.path.abspath(path)
+        local = self.lookup(path)
+        if local is not None:
+            return local
+        with self.lock:
+            future = self.pending.get(path)
+            if future is None:
+                future = self.pool.submit(self._copy, path)
+                self.pending[path] = future
+        try:
+            return future.result()
+        except OSError:
+            return path
+
+    def prefetch(self, paths):
+        """Starts copying files in the background if they are not staged."""
+        for path in paths:
+            path = os.path.abspath(path)
+            if self.lookup(path) is not None:
+                continue
+            with self.lock:
+                if path not in self.pending:
+                    self.pending[path] = self.pool.submit(self._copy, path)
+
+    def _copy(self, path):
+        reserved = 0
+        try:
+            stat = os.stat(path)
+            stem = os.path.splitext(path)[0]
+            sources = [path] + [
+                stem + ext for ext in self.companions
+                if os.path.exists(stem + ext)
+            ]
+            nbytes = sum(os.path.getsize(src) for src in sources)
+            if nbytes > self.max_bytes:
+                return path
+
+            with self.lock:
+                self._make_room(nbytes)
+                self.reserved += nbytes
+                reserved = nbytes
+
+            entry_dir = self._entry_dir(path)
+            os.makedirs(entry_dir, exist_ok=True)
+            for src in sources:
+                dst = os.path.join(entry_dir, os.path.basename(src))
+                with atomic_output(dst) as tmp:
+                    shutil.copyfile(src, tmp)
+
+            entry = {
+                'source': path,
+                'local': os.path.join(entry_dir, os.path.basename(path)),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'nbytes': nbytes
+            }
+            with open(os.path.join(entry_dir, 'meta.json'), 'w') as f:
+                json.dump(entry, f)
+
+            with self.lock:
+                self.entries[path] = entry
+            return entry['local']
+        except OSError:
+            shutil.rmtree(self._entry_dir(path), ignore_errors=True)
+            raise
+        finally:
+            with self.lock:
+                self.reserved -= reserved
+                self.pending.pop(path, None)
+
+    def _make_room(self, nbytes):
+        "Evicts least recently used, unpinned files until nbytes will fit"
+        for path in list(self.entries):
+            if self.nbytes + self.reserved + nbytes <= self.max_bytes:
+                break
+            if self.pins[path] == 0:
+                self._evict(path)
+
+    def _evict(self, path, delete=True):
+        entry = self.entries.pop(path)
+        if delete:
+            shutil.rmtree(os.path.dirname(entry['local']), ignore_errors=True)
+
+    @contextmanager
+    def staged(self, paths):
+        """Context manager which stages files and keeps them from being
+        evicted until the block completes.
+
+        Parameters
+        ----------
+        paths : string or list-like of strings, paths to files
+            files to stage. Anything that is not an existing file, such as a
+            wildcard, is passed through unchanged.
+
+        Yields
+        ------
+        local_paths : string or list of strings
+            paths to the local copies, matching the form of paths
+        """
+        single = not listlike(paths)
+        paths = [paths] if single else list(paths)
+        files = [os.path.abspath(p) for p in paths if os.path.isfile(str(p))]
+        with self.lock:
+            self.pins.update(files)
+        try:
+            local_paths = [
+                self.stage(p) if os.path.isfile(str(p)) else p for p in paths
+            ]
+            yield local_paths[0] if single else local_paths
+        finally:
+            with self.lock:
+                self.pins.subtract(files)
+
+    def prefetcher(self, tile_ids, inputs, depth):
+        """Returns a function which prefetches the inputs of the next tile in
+        tile_ids each time it is called, after first prefetching the inputs
+        of `depth` tiles.
+
+        Parameters
+        ----------
+        tile_ids : list-like
+            tiles in the order they will be processed
+        inputs : callable
+            function that accepts a tile_id and returns its input files
+        depth : int
+            number of tiles to stay ahead of
+        """
+        upcoming = iter(tile_ids)
+
+        def advance():
+            tile_id = next(upcoming, None)
+            if tile_id is not None:
+                self.prefetch(inputs(tile_id))
+
+        for _ in range(depth):
+            advance()
+        return advance
+
+    def close(self):
+        "Waits for background copies to finish"
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def _crc32(path, blocksize=2**20):
+    "Computes the CRC-32 checksum of a file"
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+class WriteBehind(object):
+    """Moves outputs written to local scratch onto network storage in the
+    background.
+
+    Many small, synchronous writes to an NFS-mounted output directory slow
+    LAStools and FUSION down considerably. With write-behind, tools write
+    their outputs into a fresh directory on local scratch instead, and once a
+    tool succeeds the directory is queued for upload. Background threads copy
+    each file to a temporary name in its final directory, check that the copy
+    matches the local file, and rename it into place, so an output found on
+    network storage is always complete. Meanwhile, the node moves on to its
+    next job.
+
+    The queue of directories awaiting upload is bounded, so when the network
+    cannot keep up, submitting further outputs blocks rather than letting
+    local scratch fill up.
+
+    Parameters
+    ----------
+    scratch_dir : string, path to directory
+        local directory where outputs are written before upload
+    max_pending : int
+        maximum number of output directories waiting to be uploaded
+    workers : int
+        number of threads uploading outputs
+    verify : boolean
+        whether each uploaded file is read back and its checksum compared
+        against the local file. If False, only file sizes are compared.
+    retries : int
+        number of additional attempts to upload a file before giving up
+    """
+
+    def __init__(self, scratch_dir, max_pending=8, workers=1, verify=True,
+                 retries=2):
+        self.scratch_dir = os.path.abspath(scratch_dir)
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        self.verify = verify
+        self.retries = retries
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.failed = []  # (local_dir, odir, error) of failed uploads
+        self.lock = threading.Lock()
+        self.threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._drain, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def local_dir(self):
+        "Creates a new, empty directory on local scratch to write outputs to"
+        path = os.path.join(self.scratch_dir, uuid.uuid4().hex)
+        os.makedirs(path)
+        return path
+
+    def submit(self, local_dir, odir):
+        """Queues the contents of a local directory to be moved into odir.
+
+        Blocks while the queue is full.
+        """
+        self.queue.put((local_dir, odir))
+
+    def discard(self, local_dir):
+        "Removes a local directory whose outputs will not be uploaded"
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            local_dir, odir = item
+            try:
+                self._upload(local_dir, odir)
+            except OSError as e:
+                # local copies are kept so they can be recovered
+                with self.lock:
+                    self.failed.append((local_dir, odir, e))
+            finally:
+                self.queue.task_done()
+
+    def _upload(self, local_dir, odir):
+        paths = []
+        for root, dirs, files in os.walk(local_dir):
+            paths.extend(os.path.join(root, f) for f in files)
+
+        # sidecar files are committed before primary outputs
+        for local_file in sorted(paths, key=_commit_order):
+            final = os.path.join(odir, os.path.relpath(local_file, local_dir))
+            os.makedirs(os.path.dirname(final), exist_ok=True)
+            for attempt in range(self.retries + 1):
+                try:
+                    self._upload_file(local_file, final)
+                    break
+                except OSError:
+                    if attempt == self.retries:
+                        raise
+                    time.sleep(2**attempt)
+            os.remove(local_file)
+        shutil.rmtree(local_dir)
+
+    def _upload_file(self, local_file, final):
+        tmp_path = temp_output_path(final)
+        try:
+            shutil.copyfile(local_file, tmp_path)
+            if os.path.getsize(tmp_path) != os.path.getsize(local_file) or \
+                    (self.verify and _crc32(tmp_path) != _crc32(local_file)):
+                raise OSError('Upload of {} to {} is corrupt'.format(
+                    local_file, final))
+        except OSError:
+            discard_output(tmp_path)
+            raise
+        os.replace(tmp_path, final)
+
+    def flush(self):
+        """Waits until all queued outputs have been uploaded.
+
+        Raises
+        ------
+        PipelineError
+            if any outputs could not be uploaded. Their local copies are left
+            in scratch_dir.
+        """
+        self.queue.join()
+        with self.lock:
+            failed, self.failed = self.failed, []
+        if failed:
+            msg = '\n'.join('{} -> {}: {}'.format(*item) for item in failed)
+            raise PipelineError(
+                '{} outputs could not be uploaded:\n{}'.format(
+                    len(failed), msg))
+
+    def close(self):
+        "Uploads all queued outputs and stops the upload threads"
+        try:
+            self.flush()
+        finally:
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def is_local_ssd(path):
+    """Whether a directory is on a local solid state (non-rotational) drive.
+
+    Detected from the block device holding the directory on Linux. Returns
+    False for network, RAM-backed and unrecognized filesystems, and on other
+    operating systems.
+    """
+    try:
+        dev = os.stat(path).st_dev
+    except OSError:
+        return False
+    block = os.path.realpath('/sys/dev/block/{}:{}'.format(
+        os.major(dev), os.minor(dev)))
+    # partitions do not describe their queue, their parent device does
+    for device in (block, os.path.dirname(block)):
+        rotational = os.path.join(device, 'queue', 'rotational')
+        if os.path.exists(rotational):
+            with open(rotational) as f:
+                return f.read().strip() == '0'
+    return False
+
+
+def local_scratch_dirs():
+    """Lists fast local directories which could hold intermediate files, in
+    order of preference: RAM-backed /dev/shm, then the system temporary
+    directory if it is on a local SSD."""
+    candidates = []
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        candidates.append('/dev/shm')
+    tmp = tempfile.gettempdir()
+    if is_local_ssd(tmp):
+        candidates.append(tmp)
+    return candidates
+
+
+def choose_scratch_dir(needed, scratch_dir='auto', fallback=None,
+                       headroom=1.25):
+    """Chooses a directory with room for a given volume of intermediate files.
+
+    Parameters
+    ----------
+    needed : int
+        estimated number of bytes of intermediate files
+    scratch_dir : string, path to directory
+        directory to use if it has room, or 'auto' to use the first of
+        `local_scratch_dirs` with room
+    fallback : string, path to directory (optional)
+        directory to use when none of the candidates has room
+    headroom : numeric
+        factor by which free space must exceed the estimate, allowing for
+        error in the estimate and for other processes sharing the directory
+
+    Returns
+    -------
+    scratch_dir : string, path to directory
+        the chosen directory, or fallback if none has room
+    """
+    if scratch_dir == 'auto':
+        candidates = local_scratch_dirs()
+    else:
+        os.makedirs(scratch_dir, exist_ok=True)
+        candidates = [scratch_dir]
+
+    for path in candidates:
+        try:
+            free = shutil.disk_usage(path).free
+        except OSError:
+            continue
+        if free >= needed * headroom:
+            return path
+
+    if scratch_dir != 'auto':
+        warnings.warn('{} does not have room for an estimated {:,d} bytes of '
+                      'intermediate files, using {} instead'.format(
+                          scratch_dir, int(needed), fallback))
+    return fallback
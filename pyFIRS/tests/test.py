@@ -1,11 +1,58 @@
+import contextlib
+import glob
+import importlib.util
+import io
+import json
 import os
+import struct
+import tempfile
+import threading
+import time
 import unittest
+import uuid
 import numpy as np
-from pyFIRS.utils import listlike
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+from pyFIRS.utils import (listlike, atomic_output, make_buffered_fishnet,
+                          get_intersecting_tiles, split_tile, merge_rasters)
+from pyFIRS.chm import (make_grid, rasterize_tin, select_layers, tin_fits,
+                        tin_memory, pitfree, pitfree_tile, merge_pitfree_tile,
+                        splat_highest, MaxCompositor, NODATA)
+from pyFIRS.cli import ConfigError, load_config, main, parse_size
+from pyFIRS.executors import get_executor, map_tiles
+from pyFIRS.io import (iter_points, laz_chunk_table, memmap_points,
+                       read_header, read_points, write_points)
+from pyFIRS.leases import TileLeases
+from pyFIRS.manifest import TileManifest, stale_regions
+from pyFIRS.staging import StagingCache, WriteBehind, choose_scratch_dir
 
 this_dir = os.path.dirname(__file__)
 
 
+def speculative_job(tile_id, odir, slow, marks):
+    """Writes the output of a tile, recording each attempt in marks. The first
+    attempt at the slow tile waits until a release file appears in marks."""
+    open(os.path.join(marks, '{}.{}'.format(tile_id, uuid.uuid4().hex)),
+         'w').close()
+    try:
+        os.close(os.open(os.path.join(marks, tile_id + '-first'),
+                         os.O_CREAT | os.O_EXCL))
+        first = True
+    except FileExistsError:
+        first = False
+    text = 'fast'
+    if tile_id == slow and first:
+        text = 'slow'
+        for _ in range(600):
+            if os.path.exists(os.path.join(marks, 'release')):
+                break
+            time.sleep(0.05)
+    os.makedirs(odir, exist_ok=True)  # as the wrappers do
+    with open(os.path.join(odir, tile_id + '.txt'), 'w') as f:
+        f.write(text)
+
+
 class TestUtils(unittest.TestCase):
 
     def test_listlike(self):
@@ -19,6 +66,883 @@ class TestUtils(unittest.TestCase):
         self.assertFalse(listlike(1))  # single number
         self.assertFalse(listlike('string'))  # string
 
+    def test_atomic_output(self):
+        """Checks that outputs written under a temporary name, including
+        sidecar files, are only renamed to their final names on success."""
+        odir = tempfile.mkdtemp()
+        outfile = os.path.join(odir, 'tile.shp')
+        with atomic_output(outfile) as tmp:
+            for ext in ['.shp', '.shx', '.dbf']:
+                open(tmp.replace('.shp', ext), 'w').close()
+            self.assertFalse(os.path.exists(outfile))
+        self.assertEqual(sorted(os.listdir(odir)),
+                         ['tile.dbf', 'tile.shp', 'tile.shx'])
+
+        with self.assertRaises(ValueError):
+            with atomic_output(os.path.join(odir, 'failed.shp')) as tmp:
+                open(tmp, 'w').close()
+                raise ValueError
+        self.assertEqual(len(os.listdir(odir)), 3)
+
+    def test_compact_intersecting_tiles(self):
+        """Checks that the compact lookup of intersecting tiles lists the same
+        files for each tile as the DataFrame."""
+        src_tiles = gpd.GeoDataFrame(
+            {'file_name': ['{}.laz'.format(i) for i in range(6)]},
+            geometry=[box(x, y, x + 750, y + 750)
+                      for x in (0, 750, 1500) for y in (0, 750)])
+        new_tiles = make_buffered_fishnet(0, 0, 2250, 1500, None, buffer=50)
+        joined = get_intersecting_tiles(src_tiles, new_tiles)
+        compact = get_intersecting_tiles(src_tiles, new_tiles, compact=True)
+        self.assertEqual(list(compact.index), list(joined.index))
+        for tile_id in joined.index:
+            self.assertEqual(
+                compact[tile_id],
+                joined.loc[tile_id].values[0].split(' '))
+
+
+    def test_split_merge(self):
+        """Checks that a tile split into buffered sub-tiles is merged back
+        into the tile, with the buffers trimmed away."""
+        import rasterio
+        from affine import Affine
+        subtiles = split_tile('0_0_100', parts=2, buffer=10)
+        self.assertEqual(sorted(subtiles.index),
+                         ['0_0_50', '0_50_50', '50_0_50', '50_50_50'])
+        self.assertEqual(tuple(subtiles.loc['50_0_50'].geometry.bounds),
+                         (40.0, -10.0, 110.0, 60.0))
+
+        tmpdir = tempfile.mkdtemp()
+        values = np.arange(120 * 120, dtype=np.float32).reshape(120, 120)
+        rasters = []
+        for sub_id, geom in subtiles.geometry.items():
+            xmin, ymin, xmax, ymax = [int(v) for v in geom.bounds]
+            path = os.path.join(tmpdir, sub_id + '.tif')
+            with rasterio.open(path, 'w', driver='GTiff', width=70,
+                               height=70, count=1, dtype='float32',
+                               transform=Affine(1, 0, xmin, 0, -1, ymax)) \
+                    as dst:
+                dst.write(values[110 - ymax:180 - ymax,
+                                 xmin + 10:xmin + 80], 1)
+            rasters.append(path)
+
+        merged = os.path.join(tmpdir, 'merged.tif')
+        merge_rasters(rasters, merged, bounds=(0, 0, 100, 100))
+        with rasterio.open(merged) as src:
+            self.assertEqual(tuple(src.bounds), (0, 0, 100, 100))
+            self.assertTrue(np.array_equal(src.read(1),
+                                           values[10:110, 10:110]))
+
+
+class TestExecutors(unittest.TestCase):
+
+    def test_map_tiles(self):
+        """Checks that each executor backend returns results keyed by tile in
+        the order the tiles were provided."""
+        tile_ids = ['0_0_1000', '1000_0_1000', '0_1000_1000']
+        for kind in ['serial', 'threads', 'processes']:
+            with get_executor(kind, workers=2) as executor:
+                results = map_tiles(len, tile_ids, executor=executor)
+            self.assertEqual(list(results.keys()), tile_ids)
+            self.assertEqual(list(results.values()), [8, 11, 11])
+
+    def test_speculate(self):
+        """Checks that a straggling tile is re-executed without waiting for
+        the original attempt, and that only the first attempt to finish
+        commits its output."""
+        odir, marks = tempfile.mkdtemp(), tempfile.mkdtemp()
+        tile_ids = ['{}_0_1000'.format(1000 * i) for i in range(6)]
+        with get_executor('threads', workers=2) as executor:
+            map_tiles(speculative_job, tile_ids, executor=executor,
+                      speculate=True, odir=odir, slow=tile_ids[-1],
+                      marks=marks)
+            # the first attempt at the slow tile waits until map_tiles has
+            # returned, so it can only lose
+            open(os.path.join(marks, 'release'), 'w').close()
+        self.check_speculated(odir, marks, tile_ids)
+
+    @unittest.skipUnless(importlib.util.find_spec('distributed'),
+                         'dask.distributed is not installed')
+    def test_speculate_dask(self):
+        """Checks that an attempt which loses on the dask backend is left to
+        finish, and its temporary outputs are removed once it does."""
+        odir, marks = tempfile.mkdtemp(), tempfile.mkdtemp()
+        tile_ids = ['{}_0_1000'.format(1000 * i) for i in range(6)]
+        with get_executor('dask', workers=2, threads_per_worker=1,
+                          processes=False, dashboard_address=None) as executor:
+            map_tiles(speculative_job, tile_ids, executor=executor,
+                      speculate=True, odir=odir, slow=tile_ids[-1],
+                      marks=marks)
+            open(os.path.join(marks, 'release'), 'w').close()
+        # dask runs the callback removing the outputs of the losing attempt
+        # in the background
+        for _ in range(100):
+            if not glob.glob(os.path.join(odir, '.pyfirs-tmp-*')):
+                break
+            time.sleep(0.05)
+        self.check_speculated(odir, marks, tile_ids)
+
+    def check_speculated(self, odir, marks, tile_ids):
+        slow = tile_ids[-1]
+        self.assertEqual(len(glob.glob(os.path.join(marks, slow + '.*'))), 2)
+        self.assertEqual(sorted(os.listdir(odir)),
+                         sorted(tile_id + '.txt' for tile_id in tile_ids))
+        with open(os.path.join(odir, slow + '.txt')) as f:
+            self.assertEqual(f.read(), 'fast')
+
+    @unittest.skipUnless(importlib.util.find_spec('distributed'),
+                         'dask.distributed is not installed')
+    def test_map_tiles_dask(self):
+        """Checks that the dask backend runs tiles on a LocalCluster it starts
+        and closes itself."""
+        tile_ids = ['0_0_1000', '1000_0_1000']
+        with get_executor('dask', workers=1, processes=False,
+                          dashboard_address=None) as executor:
+            results = map_tiles(len, tile_ids, executor=executor)
+            self.assertIsNotNone(executor.cluster)
+        self.assertEqual(list(results.values()), [8, 11])
+
+    @unittest.skipUnless(importlib.util.find_spec('distributed'),
+                         'dask.distributed is not installed')
+    def test_dask_memory(self):
+        """Checks that a memory budget is divided among the workers the
+        LocalCluster actually starts."""
+        for workers in [None, 2]:
+            with get_executor('dask', workers=workers, memory=2**30,
+                              processes=False,
+                              dashboard_address=None) as executor:
+                info = executor.client.scheduler_info()['workers']
+                self.assertEqual(executor.workers,
+                                 workers or os.cpu_count())
+                self.assertEqual(
+                    [w['memory_limit'] for w in info.values()],
+                    [2**30 // executor.workers] * executor.workers)
+                self.assertEqual(
+                    [w['nthreads'] for w in info.values()],
+                    [1] * executor.workers)
+
+
+class TestLeases(unittest.TestCase):
+
+    def test_claim_release(self):
+        """Checks that a tile can only be leased by one node at a time and is
+        not claimed again once it is done."""
+        lease_dir = tempfile.mkdtemp()
+        with TileLeases(lease_dir, node_id='a') as a, \
+                TileLeases(lease_dir, node_id='b') as b:
+            self.assertTrue(a.claim('0_0_1000'))
+            self.assertFalse(b.claim('0_0_1000'))
+            a.release('0_0_1000', done=False)
+            self.assertTrue(b.claim('0_0_1000'))
+            b.release('0_0_1000', done=True)
+            self.assertFalse(a.claim('0_0_1000'))
+
+    def test_unreadable_lease(self):
+        """Checks that an empty lease, as left while a lease is being written
+        without hard links, is held until ttl passes from when it was made."""
+        lease_dir = tempfile.mkdtemp()
+        open(os.path.join(lease_dir, '0_0_1000.lease'), 'w').close()
+        with TileLeases(lease_dir, node_id='a', ttl=0.2) as a:
+            self.assertFalse(a.claim('0_0_1000'))
+            time.sleep(0.3)
+            self.assertTrue(a.claim('0_0_1000'))
+
+    def test_map_tiles_leases(self):
+        """Checks that nodes competing for the same tiles process each tile
+        once between them, including a tile whose node died holding it."""
+        lease_dir = tempfile.mkdtemp()
+        tile_ids = ['{}_0_1000'.format(1000 * i) for i in range(12)]
+        dead = TileLeases(lease_dir, node_id='dead', ttl=0.5)
+        self.assertTrue(dead.claim(tile_ids[-1]))
+        dead._stop.set()  # stops renewing without releasing, as if it died
+
+        processed = []
+        def process(tile_id, node):
+            time.sleep(0.05)
+            processed.append((node, tile_id))
+
+        def run(node):
+            with TileLeases(lease_dir, node_id=node, ttl=1.0,
+                            heartbeat=0.1) as leases:
+                map_tiles(process, tile_ids, executor='threads',
+                          leases=leases, node=node)
+
+        nodes = [threading.Thread(target=run, args=(node,))
+                 for node in ('a', 'b')]
+        for node in nodes:
+            node.start()
+        for node in nodes:
+            node.join()
+        self.assertEqual(sorted(tile for _, tile in processed),
+                         sorted(tile_ids))
+        self.assertEqual(len({node for node, _ in processed}), 2)
+
+    def test_map_tiles_leases_split(self):
+        """Checks that the only tile left to process is split into sub-tiles
+        when the tiles after it were finished by another node."""
+        lease_dir = tempfile.mkdtemp()
+        tile_ids = ['{}_0_1000'.format(1000 * i) for i in range(8)]
+        for tile_id in tile_ids[1:]:
+            open(os.path.join(lease_dir, tile_id + '.done'), 'w').close()
+
+        def process(tile_id, subtile=None, buffer=0):
+            return subtile
+
+        def merge(tile_id, sub_ids):
+            return sorted(sub_ids)
+
+        with TileLeases(lease_dir, node_id='a') as leases:
+            results = map_tiles(process, tile_ids, executor='threads',
+                                workers=4, leases=leases, merge=merge)
+        self.assertEqual(list(results), tile_ids[:1])
+        self.assertEqual(len(results[tile_ids[0]]), 4)
+
+    def test_map_tiles_leases_reads(self):
+        """Checks that the leases of tiles held by another node are not read
+        again every time a tile is submitted."""
+        lease_dir = tempfile.mkdtemp()
+        tile_ids = ['{}_0_1000'.format(1000 * i) for i in range(12)]
+        reads = {}
+
+        class CountingLeases(TileLeases):
+            def read(self, tile_id):
+                reads[tile_id] = reads.get(tile_id, 0) + 1
+                return super().read(tile_id)
+
+            def claimed(self, tile_ids):
+                # gives up on tiles held by other nodes, rather than waiting
+                return (tile_id for tile_id in tile_ids if self.claim(tile_id))
+
+        with TileLeases(lease_dir, node_id='b') as other, \
+                CountingLeases(lease_dir, node_id='a') as leases:
+            for tile_id in tile_ids[:4]:
+                other.claim(tile_id)
+            results = map_tiles(
+                lambda tile_id, subtile=None, buffer=0: subtile, tile_ids,
+                executor='threads', workers=3, leases=leases,
+                merge=lambda tile_id, sub_ids: None)
+        self.assertEqual(list(results), tile_ids[4:])
+        # once when claiming the tile, and once when counting tiles left
+        self.assertEqual([reads[tile_id] for tile_id in tile_ids[:4]],
+                         [2] * 4)
+
+
+class TestStaging(unittest.TestCase):
+
+    def test_stage_evict(self):
+        """Checks that staged copies are reused and that the least recently
+        used copy is evicted when the cache is full."""
+        src_dir, cache_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        paths = [os.path.join(src_dir, 'tile{}.laz'.format(i)) for i in range(3)]
+        for path in paths:
+            with open(path, 'wb') as f:
+                f.write(b'0' * 100)
+        with StagingCache(cache_dir, max_bytes=250) as cache:
+            local = cache.stage(paths[0])
+            self.assertNotEqual(local, paths[0])
+            self.assertEqual(os.path.basename(local), 'tile0.laz')
+            self.assertEqual(cache.stage(paths[0]), local)
+            cache.stage(paths[1])
+            cache.stage(paths[2])
+            self.assertIsNone(cache.lookup(paths[0]))
+            self.assertEqual(cache.nbytes, 200)
+
+    def test_write_behind(self):
+        """Checks that outputs written to local scratch are moved to their
+        output directory and removed from scratch."""
+        scratch_dir, odir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        with WriteBehind(scratch_dir) as uploader:
+            local_dir = uploader.local_dir()
+            with open(os.path.join(local_dir, 'tile.laz'), 'wb') as f:
+                f.write(b'0' * 100)
+            uploader.submit(local_dir, odir)
+        self.assertEqual(os.listdir(odir), ['tile.laz'])
+        self.assertEqual(os.listdir(scratch_dir), [])
+
+    def test_write_behind_chain(self):
+        """Checks that a step writing in place can be read by the next step
+        right away, while final outputs are uploaded in the background."""
+        import shutil
+        import subprocess
+        from pyFIRS.wrappers.lastools import LAStools_base
+
+        def execute(cmd, kwargs, wine_prefix=None):
+            # copies each input to odir, as a LAStools tool run on it would
+            for path in glob.glob(kwargs['i']):
+                shutil.copy(path, kwargs['odir'])
+            return subprocess.CompletedProcess(cmd, 0, b'', b'')
+
+        src_dir, scratch_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        work, odir = os.path.join(src_dir, 'work'), os.path.join(src_dir, 'out')
+        with open(os.path.join(src_dir, 'tile.laz'), 'wb') as f:
+            f.write(b'0' * 100)
+        with WriteBehind(scratch_dir) as uploader:
+            las = LAStools_base.__new__(LAStools_base)
+            las.src, las.system, las.cache = '', 'Windows', None
+            las.uploader = uploader
+            las._execute = execute
+            las.lasheight(i=os.path.join(src_dir, '*.laz'), odir=work,
+                          upload=False)
+            self.assertEqual(os.listdir(work), ['tile.laz'])
+            las.lasthin(i=os.path.join(work, '*.laz'), odir=odir)
+        self.assertEqual(os.listdir(odir), ['tile.laz'])
+        self.assertEqual(os.listdir(scratch_dir), [])
+
+    def test_choose_scratch_dir(self):
+        "Checks that scratch falls back when the estimate does not fit"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertEqual(choose_scratch_dir(1, tmpdir), tmpdir)
+            with self.assertWarns(UserWarning):
+                chosen = choose_scratch_dir(2**70, tmpdir, fallback='nas')
+            self.assertEqual(chosen, 'nas')
+
+
+class TestManifest(unittest.TestCase):
+
+    def test_stale_tiles(self):
+        """Checks that only tiles intersecting new or modified source files
+        are identified as stale."""
+        src_dir = tempfile.mkdtemp()
+        for name in ['a.laz', 'b.laz', 'c.laz']:
+            with open(os.path.join(src_dir, name), 'wb') as f:
+                f.write(b'0' * 100)
+        intersecting_tiles = pd.DataFrame(
+            {'intersecting_files': ['a.laz', 'a.laz b.laz', 'b.laz']},
+            index=['0_0_1000', '1000_0_1000', '2000_0_1000'])
+
+        manifest_path = os.path.join(src_dir, 'manifest.json')
+        manifest = TileManifest(manifest_path)
+        stale = manifest.stale_tiles(intersecting_tiles, src_dir)
+        self.assertEqual(stale, list(intersecting_tiles.index))
+        manifest.record(stale)
+        manifest.save()
+
+        with open(os.path.join(src_dir, 'a.laz'), 'wb') as f:
+            f.write(b'0' * 200)
+        manifest = TileManifest(manifest_path)
+        stale = manifest.stale_tiles(intersecting_tiles, src_dir)
+        self.assertEqual(stale, ['0_0_1000', '1000_0_1000'])
+        self.assertEqual(stale_regions(stale, region_size=2000), ['0_0_2000'])
+        manifest.record(stale)
+
+        intersecting_tiles.loc['2000_0_1000'] = 'b.laz c.laz'
+        stale = manifest.stale_tiles(intersecting_tiles, src_dir)
+        self.assertEqual(stale, ['2000_0_1000'])
+
+
+class TestCLI(unittest.TestCase):
+
+    def setUp(self):
+        """Writes a pipeline whose stage records each tile it processes, and
+        fails on tiles named in the FAIL environment variable."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.module = 'stages_{}'.format(os.path.basename(self.tmpdir))
+        with open(os.path.join(self.tmpdir, self.module + '.py'), 'w') as f:
+            f.write('import os\n'
+                    'def record(tile_id, log):\n'
+                    '    if tile_id in os.environ.get("FAIL", "").split():\n'
+                    '        raise ValueError(tile_id)\n'
+                    '    with open(log, "a") as f:\n'
+                    '        f.write(tile_id + "\\n")\n')
+        self.log = os.path.join(self.tmpdir, 'log.txt')
+        self.config = os.path.join(self.tmpdir, 'pipeline.json')
+        with open(self.config, 'w') as f:
+            json.dump({'tiles': ['0_0_1000', '1000_0_1000'],
+                       'executor': 'serial',
+                       'stages': [{'name': 'record',
+                                   'function': self.module + ':record',
+                                   'kwargs': {'log': self.log}}]}, f)
+
+    def run_pipeline(self, *args, fail=''):
+        os.environ['FAIL'] = fail
+        try:
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                return main(['run', self.config] + list(args))
+        finally:
+            del os.environ['FAIL']
+
+    def processed(self):
+        with open(self.log) as f:
+            return f.read().split()
+
+    def test_parse_size(self):
+        """Checks that sizes are parsed in binary units."""
+        self.assertEqual(parse_size('16GB'), 16 * 2**30)
+        self.assertEqual(parse_size('512M'), 512 * 2**20)
+        self.assertEqual(parse_size('1.5 kib'), 1536)
+        self.assertEqual(parse_size(1000), 1000)
+        with self.assertRaises(ValueError):
+            parse_size('lots')
+
+    def test_load_config(self):
+        """Checks that workdir is resolved next to the configuration and that
+        invalid configurations are rejected."""
+        config = load_config(self.config)
+        self.assertEqual(config['workdir'], os.path.join(self.tmpdir, '.'))
+        self.assertEqual(config['name'], 'pipeline')
+        bad = os.path.join(self.tmpdir, 'bad.json')
+        for stages in ([], [{'name': 'a', 'function': 'nocolon'}],
+                       [{'name': 'a', 'function': 'm:f'},
+                        {'name': 'a', 'function': 'm:g'}],
+                       [{'name': 'a', 'function': 'm:f',
+                         'speculate': True}]):
+            with open(bad, 'w') as f:
+                json.dump({'tiles': ['0_0_1000'], 'stages': stages}, f)
+            with self.assertRaises(ConfigError):
+                load_config(bad)
+
+    def test_exit_status(self):
+        """Checks the exit status for a failed tile and a bad configuration,
+        and that a run resumes from the tiles finished by the last one."""
+        self.assertEqual(self.run_pipeline(fail='1000_0_1000'), 1)
+        self.assertEqual(self.processed(), ['0_0_1000'])
+        self.assertEqual(self.run_pipeline(), 0)
+        self.assertEqual(self.processed(), ['0_0_1000', '1000_0_1000'])
+        self.assertEqual(self.run_pipeline('--fresh'), 0)
+        self.assertEqual(len(self.processed()), 4)
+        self.assertEqual(self.run_pipeline('--resume'), 0)
+        self.assertEqual(len(self.processed()), 4)
+        with self.assertRaises(SystemExit) as exited:
+            self.run_pipeline('--resume', '--fresh')
+        self.assertEqual(exited.exception.code, 2)
+        self.assertEqual(self.run_pipeline('--stage', 'missing'), 2)
+        with open(self.config) as f:
+            config = json.load(f)
+        config['stages'][0]['speculate'] = True
+        with open(self.config, 'w') as f:
+            json.dump(config, f)
+        self.assertEqual(self.run_pipeline(), 2)
+
+    def test_relative_kwargs(self):
+        """Checks that relative paths in the kwargs of a stage are resolved
+        against workdir rather than the directory pyfirs is run from."""
+        with open(self.config) as f:
+            config = json.load(f)
+        config['stages'][0]['kwargs']['log'] = 'log.txt'
+        with open(self.config, 'w') as f:
+            json.dump(config, f)
+        cwd, elsewhere = os.getcwd(), os.path.realpath(tempfile.mkdtemp())
+        os.chdir(elsewhere)
+        try:
+            self.assertEqual(self.run_pipeline(), 0)
+            self.assertEqual(os.getcwd(), elsewhere)
+            self.assertEqual(os.listdir(elsewhere), [])
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(self.processed(), ['0_0_1000', '1000_0_1000'])
+
+    def test_fresh_with_live_leases(self):
+        """Checks that --fresh is refused while another node holds a lease,
+        leaving the state of the other node in place."""
+        lease_dir = os.path.join(self.tmpdir, '.pyfirs', 'pipeline', 'record')
+        with TileLeases(lease_dir, node_id='other') as other:
+            other.claim('0_0_1000')
+            self.assertEqual(self.run_pipeline('--fresh'), 2)
+            self.assertEqual(other.live(), ['0_0_1000'])
+            other.release('0_0_1000')
+        self.assertEqual(self.run_pipeline(), 0)
+        self.assertEqual(self.processed(), ['1000_0_1000'])
+
+
+class TestCHM(unittest.TestCase):
+
+    def test_rasterize_tin(self):
+        """Checks that a TIN is interpolated linearly at cell centers and that
+        triangles with long edges are left as gaps."""
+        xx, yy = np.meshgrid(np.arange(0, 10.5, 0.5), np.arange(0, 10.5, 0.5))
+        x, y = xx.ravel(), yy.ravel()
+        keep = (x < 4) | (x > 6)  # leaves a 2 unit wide gap between points
+        x, y, z = x[keep], y[keep], 2 * x[keep] + y[keep]
+        transform, shape = make_grid(0, 0, 10, 10, 1.0)
+        raster = rasterize_tin(x, y, z, transform, shape, kill=1.0)
+        self.assertEqual(shape, (10, 10))
+        self.assertAlmostEqual(raster[9, 0], 2 * 0.5 + 0.5, places=5)
+        self.assertTrue(np.isnan(raster[5, 5]))
+
+    def test_splat_integer(self):
+        """Checks that points thinned in the integer units stored in a file
+        stay integers and keep the same heights as when thinned in
+        real-world coordinates."""
+        rng = np.random.RandomState(0)
+        X = rng.randint(0, 10000, 5000).astype(np.int32)
+        Y = rng.randint(0, 10000, 5000).astype(np.int32)
+        Z = rng.randint(0, 3000, 5000).astype(np.int32)
+        offset = (500000.0, 4000000.0)
+        x, y = X * 0.01 + offset[0], Y * 0.01 + offset[1]
+        ix, iy, iz = splat_highest(X, Y, Z, 0, 50,
+                                   origin=(-offset[0] / 0.01,
+                                           -offset[1] / 0.01))
+        self.assertEqual((ix.dtype, iy.dtype, iz.dtype), (np.int32,) * 3)
+        rx, ry, rz = splat_highest(x, y, Z, 0, 0.5)
+        self.assertTrue(np.array_equal(
+            np.sort(ix * 0.01 + offset[0]), np.sort(rx)))
+        self.assertTrue(np.array_equal(np.sort(iz), np.sort(rz)))
+
+    def test_max_compositor(self):
+        """Checks that rasters offset from the composite, or only partly
+        overlapping it, are folded into the right cells, that misaligned
+        rasters are refused, and that a folded file is deleted along with its
+        sidecars."""
+        import rasterio
+        from affine import Affine
+        tmpdir = tempfile.mkdtemp()
+        transform, shape = make_grid(0, 0, 4, 3, 1.0)
+        with MaxCompositor(os.path.join(tmpdir, 'max.dat'), transform,
+                           shape) as compositor:
+            # offset by one column and one row into the composite
+            compositor.fold(np.full((2, 2), 5.0, dtype=np.float32),
+                            Affine(1, 0, 1, 0, -1, 2))
+            # hanging off the lower right corner, so only [1, 7] is inside
+            layer = np.array([[1, 7, 7], [np.nan, 9, 9]], dtype=np.float32)
+            compositor.fold(layer, Affine(1, 0, 2, 0, -1, 1))
+
+            path = os.path.join(tmpdir, 'layer.bil')
+            with rasterio.open(path, 'w', driver='EHdr', width=2, height=1,
+                               count=1, dtype='float32', nodata=NODATA,
+                               transform=Affine(1, 0, -1, 0, -1, 3)) as dst:
+                dst.write(np.array([[8, 3]], dtype=np.float32), 1)
+            compositor.fold_file(path)
+            self.assertEqual(os.listdir(tmpdir), ['max.dat'])
+
+            # misaligned rasters are refused rather than shifted
+            with self.assertRaises(ValueError):
+                compositor.fold(layer, Affine(1, 0, 2.4, 0, -1, 1))
+            with self.assertRaises(ValueError):
+                compositor.fold(layer, Affine(0.5, 0, 2, 0, -0.5, 1))
+            # but not within the tolerance for rounded header coordinates
+            compositor.fold(np.zeros((1, 1), dtype=np.float32),
+                            Affine(1, 0, 1e-6, 0, -1, 3))
+
+            outfile = os.path.join(tmpdir, 'chm.bil')
+            compositor.write(outfile, block_rows=2)
+        self.assertFalse(os.path.exists(os.path.join(tmpdir, 'max.dat')))
+
+        expected = np.array([[3, NODATA, NODATA, NODATA],
+                             [NODATA, 5, 5, NODATA],
+                             [NODATA, 5, 5, 7]], dtype=np.float32)
+        with rasterio.open(outfile) as src:
+            self.assertEqual(src.transform, transform)
+            self.assertTrue(np.array_equal(src.read(1), expected))
+
+    def write_crowns(self, path):
+        """Writes a 100 x 100 tile of sloping ground points with three tree
+        crowns."""
+        import laspy
+        rng = np.random.RandomState(0)
+        x, y = rng.uniform(0, 100, 30000), rng.uniform(0, 100, 30000)
+        z, classification = 0.05 * x, np.full(30000, 2)
+        for cx, cy, ht, r in ((30, 30, 20, 6), (70, 60, 30, 8), (50, 52, 15, 5)):
+            dist = np.hypot(x - cx, y - cy)
+            crown = (dist < r) & (rng.rand(30000) < 0.8)
+            z[crown] += ht * (1 - dist[crown] / r)
+            classification[crown] = 5
+        las = laspy.LasData(laspy.LasHeader(point_format=1, version='1.2'))
+        las.header.scales = [0.01, 0.01, 0.01]
+        las.x, las.y, las.z = x, y, z
+        las.classification = classification
+        las.write(path)
+
+    def test_pitfree_subtiles(self):
+        """Checks that a CHM made from buffered sub-tiles of a tile, split by
+        map_tiles, matches the CHM of the whole tile."""
+        import rasterio
+        tmpdir = tempfile.mkdtemp()
+        self.write_crowns(os.path.join(tmpdir, '0_0_100.laz'))
+
+        whole = pitfree_tile('0_0_100', tmpdir, os.path.join(tmpdir, 'whole'),
+                             'm', xy_res=1.0)
+        # a single tile and more workers than tiles, so the tile is split
+        split = map_tiles(pitfree_tile, ['0_0_100'], executor='threads',
+                          workers=4, merge=merge_pitfree_tile, buffer=10,
+                          src_dir=tmpdir, outdir=os.path.join(tmpdir, 'split'),
+                          units='m', xy_res=1.0)['0_0_100']
+        self.assertFalse(os.path.exists(
+            os.path.join(tmpdir, 'split', 'subtiles')))
+        with rasterio.open(whole) as a, rasterio.open(split) as b:
+            self.assertEqual(a.bounds, b.bounds)
+            self.assertTrue(np.array_equal(a.read(1), b.read(1)))
+
+    def test_pitfree_resolutions(self):
+        """Checks that the CHMs made at several resolutions from one splatted
+        cloud are named for their resolution and match CHMs made at each
+        resolution alone."""
+        import rasterio
+        tmpdir = tempfile.mkdtemp()
+        lasfile = os.path.join(tmpdir, '0_0_100.laz')
+        self.write_crowns(lasfile)
+
+        outfiles = pitfree(lasfile, os.path.join(tmpdir, 'multi'), 'm',
+                           xy_res=[0.5, 1.0, 2.0])
+        self.assertEqual([os.path.basename(f) for f in outfiles],
+                         ['0_0_100_chm_pitfree_0p5.bil',
+                          '0_0_100_chm_pitfree_1.bil',
+                          '0_0_100_chm_pitfree_2.bil'])
+        for res, outfile in zip([0.5, 1.0, 2.0], outfiles):
+            single = pitfree(lasfile, os.path.join(tmpdir, str(res)), 'm',
+                             xy_res=res)
+            with rasterio.open(outfile) as a, rasterio.open(single) as b:
+                self.assertEqual(a.shape, (int(100 / res), int(100 / res)))
+                self.assertEqual(a.bounds, b.bounds)
+                self.assertTrue(np.array_equal(a.read(1), b.read(1)))
+
+    def test_pitfree_tile_bbox(self):
+        """Checks that the CHM of a buffered tile written by lastile is
+        trimmed to the tile bounding box, as use_tile_bb does."""
+        import laspy
+        import rasterio
+        rng = np.random.RandomState(0)
+        x, y = rng.uniform(90, 210, 20000), rng.uniform(190, 310, 20000)
+        z = rng.uniform(0, 20, 20000)
+        z[::4] = 0.0
+        las = laspy.LasData(laspy.LasHeader(point_format=1, version='1.2'))
+        las.header.scales = [0.01, 0.01, 0.01]
+        las.x, las.y, las.z = x, y, z
+        las.classification = np.where(z == 0.0, 2, 1)
+        # the 100 x 100 tile at column 1, row 2 of a two level quadtree over
+        # (0, 0, 400, 400), with the buffer flag set
+        las.header.vlrs.append(laspy.VLR(
+            user_id='LAStools', record_id=10, description='tile',
+            record_data=struct.pack('<III4f', 2, 9, 1 << 30,
+                                    0, 400, 0, 400)))
+        tmpdir = tempfile.mkdtemp()
+        lasfile = os.path.join(tmpdir, 'tile.laz')
+        las.write(lasfile)
+
+        self.assertEqual(read_header(lasfile).tile_bbox, (100, 200, 200, 300))
+        from pyFIRS.wrappers.lastools import get_tile_bounds
+        self.assertEqual(get_tile_bounds(os.path.join(tmpdir, '*.laz')),
+                         (100, 200, 200, 300))
+        outfile = pitfree(lasfile, tmpdir, 'm', xy_res=1.0)
+        with rasterio.open(outfile) as src:
+            self.assertEqual(tuple(src.bounds), (100, 200, 200, 300))
+            self.assertFalse((src.read(1) == src.nodata).any())
+
+    def test_pitfree_empty(self):
+        """Checks that a tile with no ground or vegetation points, such as
+        one over open water, gets a CHM of nodata over its bounds."""
+        import laspy
+        import rasterio
+        las = laspy.LasData(laspy.LasHeader(point_format=1, version='1.2'))
+        las.header.scales = [0.01, 0.01, 0.01]
+        las.x, las.y = np.arange(100.0), np.arange(100.0)
+        las.z = np.zeros(100)
+        las.classification = np.full(100, 9)  # water
+        tmpdir = tempfile.mkdtemp()
+        lasfile = os.path.join(tmpdir, 'water.laz')
+        las.write(lasfile)
+
+        outfile = pitfree(lasfile, tmpdir, 'm', xy_res=1.0,
+                          bounds=(0, 0, 50, 50))
+        with rasterio.open(outfile) as src:
+            self.assertEqual(tuple(src.bounds), (0, 0, 50, 50))
+            self.assertTrue((src.read(1) == src.nodata).all())
+        with self.assertRaisesRegex(ValueError, 'water.laz'):
+            pitfree(lasfile, tmpdir, 'm', xy_res=1.0)
+
+    def test_pitfree_batch_inputs(self):
+        """Checks that a batch passes its tiles in a list file, works in a
+        directory of its own, and rejects tiles sharing a name."""
+        import subprocess
+        from pyFIRS.utils import PipelineError
+        from pyFIRS.wrappers.lastools import useLAStools
+        calls = []
+
+        def execute(cmd, kwargs, wine_prefix=None):
+            # records the tiles listed for lasheight, then fails
+            with open(kwargs['lof']) as f:
+                calls.append((os.path.dirname(kwargs['lof']),
+                              f.read().split()))
+            return subprocess.CompletedProcess(cmd, 1, b'', b'failed')
+
+        las = useLAStools.__new__(useLAStools)
+        las.src, las.system, las.cache, las.uploader = '', 'Windows', None, None
+        las._execute = execute
+        tmpdir = tempfile.mkdtemp()
+        tiles = [os.path.join(tmpdir, name) for name in ['a.laz', 'b.laz']]
+        for _ in range(2):
+            with self.assertRaises(PipelineError):
+                las.pitfree_batch(tiles, tmpdir, 'm')
+        self.assertEqual(calls[0][1], tiles)
+        self.assertNotEqual(calls[0][0], calls[1][0])
+
+        with self.assertRaises(ValueError):
+            las.pitfree_batch([tiles[0], os.path.join(tmpdir, 'x', 'a.laz')],
+                              tmpdir, 'm')
+        self.assertEqual(len(calls), 2)
+
+    def test_select_layers(self):
+        "Checks that layers with sparse height bands are skipped"
+        z = np.concatenate((np.full(50, 1.0), np.full(3, 3.0),
+                            np.full(40, 12.0), np.full(2, 22.0)))
+        hts = [0.0, 2.0, 5.0, 10.0, 15.0, 20.0]
+        self.assertEqual(select_layers(z, hts, 10), [0.0, 10.0])
+        self.assertEqual(select_layers(z, hts, 1), [0.0, 2.0, 10.0, 20.0])
+
+    def test_tin_fits(self):
+        "Checks that TIN memory is shared among workers"
+        memory = tin_memory(10**6) * 4
+        self.assertTrue(tin_fits(10**6, workers=4, memory=memory))
+        self.assertFalse(tin_fits(10**6, workers=5, memory=memory))
+
+
+class TestIO(unittest.TestCase):
+
+    def test_read_header(self):
+        "Checks that headers written by laspy are read without laspy"
+        import laspy
+        from pyproj import CRS
+        las = laspy.LasData(laspy.LasHeader(point_format=6, version='1.4'))
+        las.header.scales = [0.01, 0.01, 0.001]
+        las.header.offsets = [500000, 4000000, 0]
+        las.header.add_crs(CRS.from_epsg(26910))
+        las.x = np.array([500000.5, 500100.25, 500050.0])
+        las.y = np.array([4000000.0, 4000200.0, 4000100.5])
+        las.z = np.array([10.0, 55.5, -1.25])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.laz')
+            las.write(path)
+            header = read_header(path)
+        self.assertTrue(header.compressed)
+        self.assertEqual(header.version, (1, 4))
+        self.assertEqual(header.point_format, 6)
+        self.assertEqual(header.point_count, 3)
+        self.assertEqual(header.scale, (0.01, 0.01, 0.001))
+        self.assertEqual(header.bounds, (500000.5, 4000000.0, -1.25,
+                                         500100.25, 4000200.0, 55.5))
+        self.assertIn('26910', header.crs)
+
+    def test_iter_points(self):
+        "Checks that chunks read back the points and classes laspy wrote"
+        import laspy
+        las = laspy.LasData(laspy.LasHeader(point_format=1, version='1.2'))
+        las.header.scales = [0.01, 0.01, 0.01]
+        las.x = np.arange(1000) * 0.25
+        las.y = np.arange(1000) * 0.5
+        las.z = np.arange(1000) % 30
+        las.classification = np.arange(1000) % 3 + 1
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.laz')
+            las.write(path)
+            chunks = list(iter_points(path, chunk_size=300, workers=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [300, 300, 300, 100])
+        x = np.concatenate([chunk.x for chunk in chunks])
+        classes = np.concatenate([chunk['classification'] for chunk in chunks])
+        self.assertTrue(np.allclose(x, las.x))
+        self.assertTrue(np.array_equal(classes, las.classification))
+        self.assertEqual(chunks[0]['X'].dtype, np.int32)
+
+    def test_memmap_points(self):
+        "Checks that LAS point records are mapped rather than read"
+        import laspy
+        las = laspy.LasData(laspy.LasHeader(point_format=3, version='1.2'))
+        las.x, las.y = np.arange(100) * 1.5, np.arange(100) * 2.0
+        las.z = np.arange(100) % 7
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.las')
+            las.write(path)
+            points = memmap_points(path)
+            self.assertIsInstance(points.array, np.memmap)
+            self.assertTrue(np.allclose(points.y, las.y))
+            self.assertTrue(np.allclose(points.z[points.z > 3],
+                                        las.z[las.z > 3]))
+            del points
+            las.write(path.replace('.las', '.laz'))
+            with self.assertRaises(ValueError):
+                memmap_points(path.replace('.las', '.laz'))
+
+    def test_write_points(self):
+        "Checks that chunks compressed in parallel make a readable LAZ file"
+        import laspy
+        las = laspy.LasData(laspy.LasHeader(point_format=6, version='1.4'))
+        las.x = np.arange(120001) * 0.01
+        las.y = np.arange(120001) * 0.02
+        las.z = np.arange(120001) % 40
+        las.return_number = np.arange(120001) % 2 + 1
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'src.las')
+            dst = os.path.join(tmpdir, 'dst.laz')
+            las.write(src)
+            write_points(dst, iter_points(src, chunk_size=7000), src,
+                         workers=3)
+            header = read_header(dst)
+            chunks = laz_chunk_table(dst)
+            copy = laspy.read(dst)
+        self.assertTrue(header.compressed)
+        self.assertEqual(header.point_count, 120001)
+        self.assertEqual(header.points_by_return[:2], (60001, 60000))
+        self.assertEqual(header.maxs[0], las.x.max())
+        self.assertEqual([count for count, _, _ in chunks],
+                         [50000, 50000, 20001])
+        self.assertTrue(np.array_equal(copy.points.array, las.points.array))
+
+    def test_write_points_evlrs(self):
+        """Checks that the extended records of a LAS 1.4 template, such as
+        its WKT coordinate system, are copied after the points."""
+        import laspy
+        from pyproj import CRS
+        wkt = CRS.from_epsg(26910).to_wkt()
+        las = laspy.LasData(laspy.LasHeader(point_format=6, version='1.4'))
+        las.header.global_encoding.wkt = True
+        las.header.evlrs = laspy.vlrs.vlrlist.VLRList([laspy.VLR(
+            user_id='LASF_Projection', record_id=2112, description='WKT',
+            record_data=wkt.encode() + b'\x00')])
+        las.x, las.y, las.z = np.arange(100.0), np.arange(100.0), np.zeros(100)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'src.las')
+            dst = os.path.join(tmpdir, 'dst.laz')
+            las.write(src)
+            write_points(dst, iter_points(src), src)
+            header = read_header(dst)
+            copy = laspy.read(dst)
+        self.assertEqual(header.wkt, wkt)
+        self.assertEqual(len(copy.header.evlrs), 1)
+        self.assertTrue(np.array_equal(copy.points.array, las.points.array))
+
+    def test_read_fields(self):
+        "Checks that only the fields of the requested dimensions are read"
+        import laspy
+        las = laspy.LasData(laspy.LasHeader(point_format=7, version='1.4'))
+        las.x, las.y = np.arange(500) * 0.5, np.arange(500) * 0.25
+        las.z = np.arange(500) % 25
+        las.classification = np.arange(500) % 6
+        las.red = np.arange(500)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.laz')
+            las.write(path)
+            points = read_points(path, fields=['x', 'y', 'z',
+                                               'classification'])
+        self.assertEqual(points.array.dtype.names,
+                         ('X', 'Y', 'Z', 'classification'))
+        self.assertTrue(np.allclose(points.z, las.z))
+        self.assertTrue(np.array_equal(points['classification'],
+                                       las.classification))
+        with self.assertRaises(KeyError):
+            points['red']
+
+    def test_cells(self):
+        "Checks that points are gridded in integer space like real space"
+        import laspy
+        las = laspy.LasData(laspy.LasHeader(point_format=1, version='1.2'))
+        las.header.scales = [0.01, 0.01, 0.01]
+        las.header.offsets = [500000, 4000000, 0]
+        rng = np.random.RandomState(0)
+        las.x = 500000 + rng.uniform(0, 100, 1000).round(2)
+        las.y = 4000000 + rng.uniform(0, 100, 1000).round(2)
+        las.z = np.zeros(1000)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.laz')
+            las.write(path)
+            points = read_points(path, fields=['x', 'y'])
+        for res in (0.5, 0.3333):
+            transform, shape = make_grid(500000, 4000000, 500100, 4000100,
+                                         res)
+            rows, cols = points.cells(transform)
+            self.assertTrue(np.array_equal(
+                cols, np.floor((points.x - transform.c) / res)))
+            self.assertTrue(np.array_equal(
+                rows, np.floor((transform.f - points.y) / res)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,17 @@
 import glob
 import json
 import os
+import re
+import shutil
 import subprocess
 import time
+import uuid
+from contextlib import contextmanager
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import ParseError
 
 import geopandas as gpd
+import pandas as pd
 import rasterio
 import numpy as np
 from shapely.geometry import Polygon
@@ -56,6 +61,166 @@ def clean_dir(dir_to_clean, file_extensions):
                'file_extensions needs to be a string or list-like of strings.')
 
 
+# prefix given to outputs while they are being written, they are hidden from
+# wildcards like *.laz and are renamed to their final names once complete
+TMP_PREFIX = '.pyfirs-tmp-'
+TMP_PATTERN = re.compile(r'^\.pyfirs-tmp-[0-9a-f]{8}-')
+
+# files that accompany a primary output (e.g., .shx alongside a .shp), these
+# are committed before the primary output so that its existence implies the
+# whole set of files is complete
+SIDECAR_EXTENSIONS = ('.shx', '.dbf', '.prj', '.cpg', '.qix', '.hdr', '.blw',
+                      '.tfw', '.kml', '.lax', '.aux.xml', '.ovr', '.stx')
+
+
+def _commit_order(path):
+    "Sort key that puts sidecar files ahead of primary outputs"
+    return (not path.lower().endswith(SIDECAR_EXTENSIONS), path)
+
+
+def temp_output_path(path):
+    """Returns a hidden, temporary path to write an output to.
+
+    The temporary file is placed in the same directory as the final output so
+    that it can be renamed to its final name atomically once it is complete.
+    Any other files a tool writes using the temporary name as a stem (such as
+    the .shx and .dbf accompanying a .shp, or FUSION outputs which add a
+    suffix to the name provided) will be committed along with it.
+
+    Parameters
+    ----------
+    path : string, path to file
+        final path of the output
+
+    Returns
+    -------
+    tmp_path : string, path to file
+        temporary path to write the output to
+    """
+    dirname, basename = os.path.split(path)
+    prefix = '{}{}-'.format(TMP_PREFIX, uuid.uuid4().hex[:8])
+    return os.path.join(dirname, prefix + basename)
+
+
+def _temp_outputs(tmp_path):
+    "Finds all files written using the stem of a temporary output path"
+    dirname, basename = os.path.split(tmp_path)
+    prefix = TMP_PATTERN.match(basename).group(0)
+    return glob.glob(os.path.join(glob.escape(dirname or '.'),
+                                  glob.escape(prefix) + '*'))
+
+
+def commit_output(tmp_path):
+    """Renames outputs written to a temporary path to their final names.
+
+    Parameters
+    ----------
+    tmp_path : string, path to file
+        temporary path produced by temp_output_path
+
+    Returns
+    -------
+    committed : list
+        paths to the committed output files
+    """
+    committed = []
+    for tmp_file in sorted(_temp_outputs(tmp_path), key=_commit_order):
+        dirname, basename = os.path.split(tmp_file)
+        final = os.path.join(dirname, TMP_PATTERN.sub('', basename))
+        os.replace(tmp_file, final)
+        committed.append(final)
+    return committed
+
+
+def discard_output(tmp_path):
+    """Removes outputs written to a temporary path, such as when the tool
+    writing them has failed."""
+    for tmp_file in _temp_outputs(tmp_path):
+        os.remove(tmp_file)
+
+
+@contextmanager
+def atomic_output(path):
+    """Context manager providing a temporary path to write an output to.
+
+    The output is renamed to `path` when the block completes, or removed if
+    an exception is raised, so a file found at `path` is always complete.
+
+    Example
+    -------
+    >>> with atomic_output('tile.shp') as tmp:
+    ...     gdf.to_file(tmp)
+    """
+    tmp_path = temp_output_path(path)
+    try:
+        yield tmp_path
+    except BaseException:
+        discard_output(tmp_path)
+        raise
+    else:
+        commit_output(tmp_path)
+
+
+def temp_output_dir(odir):
+    """Creates a hidden, temporary directory inside odir to write outputs to.
+
+    Use with commit_output_dir when a tool names its own outputs, such as
+    LAStools commands given an output directory rather than a filename.
+    """
+    tmp_dir = os.path.join(odir, TMP_PREFIX + uuid.uuid4().hex[:8] + '-')
+    os.makedirs(tmp_dir)
+    return tmp_dir
+
+
+def commit_output_dir(tmp_dir, odir):
+    """Moves all outputs from a temporary directory into odir.
+
+    Parameters
+    ----------
+    tmp_dir : string, path to directory
+        temporary directory produced by temp_output_dir
+    odir : string, path to directory
+        final output directory
+
+    Returns
+    -------
+    committed : list
+        paths to the committed output files
+    """
+    committed = []
+    for root, dirs, files in os.walk(tmp_dir):
+        paths = [os.path.join(root, f) for f in files]
+        for tmp_file in sorted(paths, key=_commit_order):
+            final = os.path.join(odir, os.path.relpath(tmp_file, tmp_dir))
+            os.makedirs(os.path.dirname(final), exist_ok=True)
+            os.replace(tmp_file, final)
+            committed.append(final)
+    shutil.rmtree(tmp_dir)
+    return committed
+
+
+def remove_temp_outputs(directory):
+    """Deletes temporary outputs left in a directory by interrupted runs.
+
+    Parameters
+    ----------
+    directory : string, path to directory
+        directory to clean up
+
+    Returns
+    -------
+    num_removed : int
+        number of temporary files and directories removed
+    """
+    to_rem = glob.glob(os.path.join(glob.escape(directory), TMP_PREFIX + '*'))
+    for path in to_rem:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    return len(to_rem)
+
+
 def clean_buffer_polys(poly_shp,
                        tile_shp,
                        odir,
@@ -106,7 +271,8 @@ def clean_buffer_polys(poly_shp,
         clean_polys = clean_polys.simplify(simp_tol, simp_topol)
 
     if len(clean_polys) > 0:
-        clean_polys.to_file(outfile)
+        with atomic_output(outfile) as tmp:
+            clean_polys.to_file(tmp)
 
 
 def clip_tile_from_shp(in_raster, in_shp, odir, buffer=0):
@@ -142,11 +308,17 @@ def clip_tile_from_shp(in_raster, in_shp, odir, buffer=0):
     # create the output directory if it doesn't already exist
     os.makedirs(odir, exist_ok=True)
     outfile = os.path.join(odir, basename)
+    tmp_outfile = temp_output_path(outfile)
     # clip the raster
     proc_clip = subprocess.run(
-        ['rio', 'clip', in_raster, outfile, '--bounds', tile_bnds],
+        ['rio', 'clip', in_raster, tmp_outfile, '--bounds', tile_bnds],
         stderr=subprocess.PIPE,
         stdout=subprocess.PIPE)
+
+    if proc_clip.returncode == 0:
+        commit_output(tmp_outfile)
+    else:
+        discard_output(tmp_outfile)
     return proc_clip
 
 
@@ -174,14 +346,21 @@ def convert_project(infile, outfile, crs):
     proc_project: CompletedProcess
         result of executing subprocess.run using rio edit-info
     '''
+    tmp_outfile = temp_output_path(outfile)
     # convert the file to the new format
-    proc_convert = subprocess.run(['rio', 'convert', infile, outfile],
+    proc_convert = subprocess.run(['rio', 'convert', infile, tmp_outfile],
                                   stderr=subprocess.PIPE,
                                   stdout=subprocess.PIPE)
     # add the projection info
-    proc_project = subprocess.run(['rio', 'edit-info', '--crs', crs, outfile],
-                                  stderr=subprocess.PIPE,
-                                  stdout=subprocess.PIPE)
+    proc_project = subprocess.run(
+        ['rio', 'edit-info', '--crs', crs, tmp_outfile],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.PIPE)
+
+    if proc_convert.returncode == 0 and proc_project.returncode == 0:
+        commit_output(tmp_outfile)
+    else:
+        discard_output(tmp_outfile)
     return proc_convert, proc_project
 
 
@@ -573,7 +752,7 @@ def make_buffered_fishnet(xmin, ymin, xmax, ymax, crs, spacing=1000,
     return buff_fishnet_gdf.set_index('tile_id')
 
 
-def get_intersecting_tiles(src_tiles, new_tiles):
+def get_intersecting_tiles(src_tiles, new_tiles, compact=False):
     """Identifies tiles from src that intersect tiles in new_tiles.
 
     This function is intended to identify the files which should be read for
@@ -588,15 +767,29 @@ def get_intersecting_tiles(src_tiles, new_tiles):
     new_tiles : GeoDataFrame
       New tiling scheme for lidar acquisition, such as one created by the
       make_buffered_fishnet function
+    compact : bool
+      If True, returns a TileInputs lookup instead of a GeoDataFrame. This is
+      much smaller to send to workers for large acquisitions, and looking up
+      the files for a tile does not require parsing strings.
 
     Returns
     -------
-    joined_tiles : GeoDataFrame
+    joined_tiles : GeoDataFrame or TileInputs
       Each row shows a tile from new_tiles that intersected with one or more
       tiles from src_tiles. The list of tiles from src_tiles that intersect
       each tile in new_tiles are formatted as a space-delimited string.
     """
     joined = gpd.sjoin(new_tiles, src_tiles)
+
+    if compact:
+        # a stable sort keeps files in the same order as the GeoDataFrame
+        joined = joined.sort_index(kind='mergesort')
+        tile_ids, counts = np.unique(joined.index.values.astype(str),
+                                     return_counts=True)
+        indices, paths = pd.factorize(joined['file_name'])
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return TileInputs(tile_ids, offsets, indices, paths)
+
     joined_tiles = joined.groupby(level=0)['file_name'].apply(list).apply(
         ' '.join).to_frame()
     joined_tiles.index.name = 'tile_id'
@@ -608,6 +801,95 @@ def get_intersecting_tiles(src_tiles, new_tiles):
     return joined_tiles
 
 
+class TileInputs(object):
+    """Compact lookup of the input files intersecting each tile.
+
+    File paths are stored once each in a deduplicated table, and the files
+    for each tile are stored as a run of integer indices into that table
+    (compressed sparse row format), so the lookup remains small for national-
+    scale tile sets. Looking up the files for a tile is O(1).
+
+    Usually created by get_intersecting_tiles with compact=True.
+
+    Parameters
+    ----------
+    tile_ids : array-like of strings
+        identifiers of the tiles
+    offsets : array-like of ints
+        position in indices where the files for each tile begin, with a final
+        entry marking the end of the last tile (len(tile_ids) + 1 values)
+    indices : array-like of ints
+        positions in paths of the files for each tile
+    paths : array-like of strings
+        deduplicated table of file paths
+
+    Example
+    -------
+    >>> tile_inputs = get_intersecting_tiles(src_tiles, new_tiles, True)
+    >>> tile_inputs['450000_5030000_1000']
+    ['raw/45122A1101.laz', 'raw/45122A1102.laz']
+    """
+
+    def __init__(self, tile_ids, offsets, indices, paths):
+        self.tile_ids = np.asarray(tile_ids, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.paths = [str(path) for path in paths]
+        if len(self.offsets) != len(self.tile_ids) + 1:
+            raise ValueError('offsets must have one more entry than tile_ids')
+        self._build_lookup()
+
+    def _build_lookup(self):
+        self._rows = {tile_id: i for i, tile_id in enumerate(self.tile_ids)}
+
+    def __getstate__(self):
+        # the lookup table is rebuilt after unpickling rather than sent along
+        state = self.__dict__.copy()
+        del state['_rows']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_lookup()
+
+    @property
+    def index(self):
+        "Identifiers of the tiles, in the same order as get_intersecting_tiles"
+        return self.tile_ids
+
+    def __len__(self):
+        return len(self.tile_ids)
+
+    def __iter__(self):
+        return iter(self.tile_ids)
+
+    def __contains__(self, tile_id):
+        return tile_id in self._rows
+
+    def __getitem__(self, tile_id):
+        "Returns the list of files intersecting a tile"
+        row = self._rows[tile_id]
+        start, stop = self.offsets[row], self.offsets[row + 1]
+        return [self.paths[i] for i in self.indices[start:stop]]
+
+    def items(self):
+        "Iterates over (tile_id, list of files) pairs"
+        for tile_id in self.tile_ids:
+            yield tile_id, self[tile_id]
+
+    def with_dir(self, src_dir):
+        "Returns a copy with each path joined onto src_dir"
+        return TileInputs(self.tile_ids, self.offsets, self.indices,
+                          [os.path.join(src_dir, path) for path in self.paths])
+
+    def to_frame(self):
+        """Converts the lookup into the DataFrame returned by
+        get_intersecting_tiles."""
+        files = [' '.join(self[tile_id]) for tile_id in self.tile_ids]
+        return pd.DataFrame({'intersecting_files': files},
+                            index=pd.Index(self.tile_ids, name='tile_id'))
+
+
 def parse_coords_from_tileid(tile_id):
     """Get the coordinates of the lower left corner of the tile, assuming the
     tile has been named in the pattern {XMIN}_{YMIN}_{LENGTH}.
@@ -635,3 +917,98 @@ def parse_coords_from_tileid(tile_id):
         llx, lly, length = [int(coord) for coord in tile_parts]
 
     return llx, lly, length
+
+
+def split_tile(tile_id, parts=2, buffer=0, crs=None):
+    """Splits a tile into a grid of smaller, buffered sub-tiles.
+
+    Sub-tiles are generated using make_buffered_fishnet and are named following
+    the same {LLX}_{LLY}_{LENGTH} convention as the tile they are split from,
+    so they can be processed by any function that derives the extent of a tile
+    using parse_coords_from_tileid.
+
+    Parameters
+    ----------
+    tile_id : string
+        tile to split, following the naming convention {LLX}_{LLY}_{LENGTH}
+    parts : int
+        number of sub-tiles along each side of the tile, so that the tile is
+        split into parts**2 sub-tiles
+    buffer : int
+        amount of overlap between neighboring sub-tiles
+    crs : Coordinate Reference System (optional)
+        Must be readable by GeoPandas to create a GeoDataFrame.
+
+    Returns
+    -------
+    subtiles : GeoDataFrame
+        buffered sub-tiles indexed by their tile_id
+    """
+    llx, lly, length = parse_coords_from_tileid(tile_id)
+    if length % parts != 0:
+        raise ValueError('{} cannot be split evenly into {} parts'.format(
+            tile_id, parts))
+    spacing = length // parts
+
+    fishnet = make_buffered_fishnet(llx, lly, llx + length, lly + length, crs,
+                                    spacing=spacing, buffer=buffer)
+    coords = [parse_coords_from_tileid(sub_id) for sub_id in fishnet.index]
+    within = [(llx <= x < llx + length) and (lly <= y < lly + length)
+              for x, y, _ in coords]
+
+    return fishnet[within]
+
+
+def merge_rasters(infiles, outfile, **kwargs):
+    """Merges rasters produced for neighboring tiles into a single raster.
+
+    Where rasters overlap (e.g., in the buffers of sub-tiles), values are taken
+    from the first raster covering each cell. The merged raster is written
+    atomically with the same format and data type as the first input.
+
+    Parameters
+    ----------
+    infiles : list-like of strings, paths to files
+        rasters to merge
+    outfile : string, path to file
+        merged raster to produce
+    kwargs : optional
+        keyword arguments passed to rasterio.merge.merge, such as `bounds` to
+        trim the merged raster to the extent of the unbuffered tile
+    """
+    from rasterio.merge import merge
+
+    srcs = [rasterio.open(infile) for infile in infiles]
+    try:
+        mosaic, transform = merge(srcs, **kwargs)
+        profile = srcs[0].profile
+    finally:
+        for src in srcs:
+            src.close()
+
+    profile.update(
+        height=mosaic.shape[1], width=mosaic.shape[2], transform=transform)
+    with atomic_output(outfile) as tmp:
+        with rasterio.open(tmp, 'w', **profile) as dst:
+            dst.write(mosaic)
+
+
+def available_memory():
+    '''Bytes of physical memory available for new processes, or None if this
+    cannot be determined.'''
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:  # Linux reports memory which could be reclaimed from caches
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
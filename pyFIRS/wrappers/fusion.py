@@ -1,8 +1,63 @@
 import os
+import shutil
 import subprocess
 import platform
 import warnings
-from pyFIRS.utils import listlike, PipelineError
+from pyFIRS.utils import (listlike, PipelineError, temp_output_path,
+                          commit_output, discard_output)
+
+
+# position of the output file among the required parameters of each FUSION
+# command line tool which writes one. FUSION names any additional outputs
+# (e.g., the .prj of a .dtm, or the CSVs of gridmetrics) using the name of
+# this file as a stem.
+FUSION_OUTPUTS = {
+    'ascii2dtm': 0,
+    'asciiimport': 2,
+    'canopymaxima': 1,
+    'canopymodel': 0,
+    'catalog': 1,
+    'clipdata': 1,
+    'clipdtm': 1,
+    'cloudmetrics': 1,
+    'cover': 1,
+    'csv2grid': 2,
+    'densitymetrics': 3,
+    'dtm2acsii': 1,
+    'dtm2envi': 1,
+    'dtm2tif': 1,
+    'dtm2xyz': 1,
+    'dtmdescribe': 1,
+    'filterdata': 3,
+    'firstlastreturn': 0,
+    'gridmetrics': 3,
+    'gridsample': 2,
+    'gridsurfacecreate': 0,
+    'gridsurfacestats': 1,
+    'groundfilter': 0,
+    'imagecreate': 0,
+    'intensityimage': 1,
+    'joindb': 5,
+    'lda2ascii': 1,
+    'mergedata': 1,
+    'mergedtm': 0,
+    'mergeraster': 0,
+    'polyclipdata': 1,
+    'returndensity': 0,
+    'splitdtm': 1,
+    'surfacesample': 2,
+    'thindata': 0,
+    'tiledimagemap': 0,
+    'tinsurfacecreate': 0,
+    'topometrics': 5,
+    'treeseg': 2
+}
+
+# tools which append to an existing output unless the /new switch is used
+FUSION_APPENDS = ('canopymaxima', 'cloudmetrics')
+
+# tools which modify their inputs in place
+FUSION_IN_PLACE = ('repairgriddtm', )
 
 
 # helper functions for formatting command line arguments
@@ -37,13 +92,64 @@ def format_fusion_args(arg):
 class useFUSION(object):
     "A class for executing FUSION functions as methods"
 
-    def __init__(self, src='C:\\FUSION'):
-        "Initialize with a path to the FUSION executables"
+    def __init__(self, src='C:\\FUSION', cache=None, uploader=None):
+        """Initialize with a path to the FUSION executables.
+
+        If a StagingCache is provided, input files are read from local copies
+        staged by the cache rather than from their original location. If a
+        WriteBehind uploader is provided, outputs are written to local scratch
+        and moved to their output directory in the background.
+        """
         self.src = src
         self.system = platform.system()
+        self.cache = cache
+        self.uploader = uploader
 
     def run(self, cmd, *params, **kwargs):
-        "Formats and executes a FUSION command line call using subprocess"
+        """Formats and executes a FUSION command line call using subprocess.
+
+        Unless `atomic=False` is passed, the output file is written to a
+        temporary name and renamed to its final name (along with any other
+        files FUSION names after it) only if the tool succeeds, so that an
+        output which exists is always complete. If a WriteBehind uploader is
+        in use, the output is written to local scratch and uploaded in the
+        background, unless `upload=False` is passed, as it should be when the
+        output is read by a following step right away.
+        """
+        if 'atomic' in kwargs:
+            atomic = kwargs['atomic']
+            del kwargs['atomic']
+        else:
+            atomic = True
+
+        if 'upload' in kwargs:
+            upload = kwargs['upload']
+            del kwargs['upload']
+        else:
+            upload = True
+        uploader = self.uploader if upload else None
+
+        # redirect the output to local scratch to be uploaded once the tool
+        # succeeds, or to a temporary name until the tool succeeds
+        tmp_output, local_dir = None, None
+        in_place = cmd in FUSION_IN_PLACE
+        output_ix = FUSION_OUTPUTS.get(cmd)
+        has_output = output_ix is not None and output_ix < len(params) \
+            and isinstance(params[output_ix], str)
+        if has_output and (atomic or uploader is not None):
+            params = list(params)
+            output = params[output_ix]
+            if uploader is not None:
+                local_dir = uploader.local_dir()
+                local_output = os.path.join(local_dir,
+                                            os.path.basename(output))
+            else:
+                local_output = tmp_output = temp_output_path(output)
+            if cmd in FUSION_APPENDS and 'new' not in kwargs \
+                    and os.path.exists(output):
+                shutil.copy2(output, local_output)
+            params[output_ix] = local_output
+
         # prepend the path to FUSION tools to the user-specified command
         cmd = os.path.join(self.src, cmd)
 
@@ -70,11 +176,47 @@ class useFUSION(object):
         # format kwargs as FUSION 'switches'
         switches = format_fusion_kws(**kwargs)
 
+        # read inputs from local copies if a staging cache is in use
+        inputs = [
+            j for j, param in enumerate(params) if j != output_ix
+            and isinstance(param, str) and os.path.isfile(param)
+        ]
+        if self.cache is not None and inputs and not in_place:
+            with self.cache.staged([params[j] for j in inputs]) as staged:
+                params = list(params)
+                for j, local_path in zip(inputs, staged):
+                    params[j] = local_path
+                proc = self._execute(cmd, switches, params, wine_prefix)
+        else:
+            proc = self._execute(cmd, switches, params, wine_prefix)
+
+        if echo:
+            print(proc.stdout.decode())
+            print(proc.stderr.decode())
+
+        if proc.returncode != 0:
+            if tmp_output:
+                discard_output(tmp_output)
+            if local_dir:
+                self.uploader.discard(local_dir)
+            cmd_name = os.path.basename(cmd)
+            error_msg = proc.stderr.decode()
+            raise PipelineError(
+                '''{} failed on with the following error message
+                {}'''.format(cmd_name, error_msg))
+
+        if tmp_output:
+            commit_output(tmp_output)
+        if local_dir:
+            self.uploader.submit(local_dir, os.path.dirname(output) or '.')
+
+        return proc
+
+    def _execute(self, cmd, switches, params, wine_prefix=None):
+        "Executes a FUSION command line tool using subprocess"
         # format the required parameters for each function as strings
         params = [format_fusion_args(param) for param in params]
 
-        cmd = os.path.join(self.src, cmd)
-
         if self.system == 'Linux':
             # if we're on a linux system, execute the commands using WINE
             if wine_prefix:  # if we're using specific WINE server
@@ -102,17 +244,6 @@ class useFUSION(object):
                                   stderr=subprocess.PIPE,
                                   stdout=subprocess.PIPE)
 
-        if echo:
-            print(proc.stdout.decode())
-            print(proc.stderr.decode())
-
-        if proc.returncode != 0:
-            cmd_name = os.path.basename(cmd)
-            error_msg = proc.stderr.decode()
-            raise PipelineError(
-                '''{} failed on with the following error message
-                {}'''.format(cmd_name, error_msg))
-
         return proc
 
     def ascii2dtm(self, surfacefile, xyunits, zunits, coordsys, zone,
@@ -1,8 +1,17 @@
+import glob
 import os
 import subprocess
 import platform
 import shutil
-from pyFIRS.utils import listlike, PipelineError
+import tempfile
+from pyFIRS import chm
+from pyFIRS.chm import pitfree_params
+from pyFIRS.executors import TileExecutor, get_executor
+from pyFIRS.io import read_bounds, read_header, read_points
+from pyFIRS.staging import choose_scratch_dir
+from pyFIRS.utils import (listlike, PipelineError, temp_output_path,
+                          commit_output, discard_output, temp_output_dir,
+                          commit_output_dir)
 import urllib.request
 import geopandas as gpd
 import numpy as np
@@ -25,13 +34,31 @@ def format_lastools_kws(**kwargs):
     return kws
 
 
+def writes_beside_input(cmd, kwargs):
+    '''Whether a LAStools call writes its outputs into the directory of its
+    input files, as happens when neither `o` nor `odir` are specified.'''
+    if 'o' in kwargs or 'odir' in kwargs:
+        return False
+    if cmd == 'lasinfo':  # only writes a report if asked to
+        return any(key.startswith('o') for key in kwargs)
+    return True
+
+
 class LAStools_base(object):
     "A class for executing LAStools functions as methods"
 
-    def __init__(self, src='C:\\lastools\\bin'):
-        "Initialize with a path to the LAStools executables"
+    def __init__(self, src='C:\\lastools\\bin', cache=None, uploader=None):
+        """Initialize with a path to the LAStools executables.
+
+        If a StagingCache is provided, input files are read from local copies
+        staged by the cache rather than from their original location. If a
+        WriteBehind uploader is provided, outputs are written to local scratch
+        and moved to their output directory in the background.
+        """
         self.src = src
         self.system = platform.system()
+        self.cache = cache
+        self.uploader = uploader
 
         # retrieve the documentation for each LAStool from the web
         tools = [
@@ -78,6 +105,18 @@ class LAStools_base(object):
             name of LAStools command line tool
         input: string, path to file(s)
             path to files to process with command line tool
+        atomic: boolean (optional)
+            Whether outputs are written to temporary names and renamed to their
+            final names only if the tool succeeds, so that an output which
+            exists is always complete. Outputs named with `o` are written
+            alongside their final location, outputs directed to `odir` are
+            written into a hidden subdirectory of `odir`. Defaults to True.
+        upload: boolean (optional)
+            Whether outputs are written to local scratch and moved to their
+            output directory in the background, if a WriteBehind uploader is
+            in use. Steps whose outputs are read by a following step right
+            away should pass False, so that their outputs are in place when
+            the tool returns. Defaults to True.
 
         Returns
         -------
@@ -103,6 +142,81 @@ class LAStools_base(object):
         else:
             wine_prefix = None
 
+        if 'atomic' in kwargs:
+            atomic = kwargs['atomic']
+            del kwargs['atomic']
+        else:
+            atomic = True
+
+        if 'upload' in kwargs:
+            upload = kwargs['upload']
+            del kwargs['upload']
+        else:
+            upload = True
+
+        # redirect outputs to local scratch to be uploaded once the tool
+        # succeeds, or to temporary names until the tool succeeds
+        tmp_output, tmp_odir, local_dir = None, None, None
+        if self.uploader is not None and upload and \
+                ('o' in kwargs or 'odir' in kwargs):
+            odir = kwargs.get('odir', '')
+            local_dir = self.uploader.local_dir()
+            if 'o' in kwargs:
+                o = str(kwargs['o'])
+                # LAStools joins a relative output name onto odir
+                odir = os.path.dirname(os.path.join(odir, o)) or '.'
+                kwargs['o'] = os.path.basename(o)
+            kwargs['odir'] = local_dir
+        elif atomic and 'o' in kwargs:
+            odir, o = kwargs.get('odir', ''), str(kwargs['o'])
+            # LAStools joins a relative output name onto odir
+            tmp_o = temp_output_path(o)
+            kwargs['o'] = tmp_o
+            tmp_output = tmp_o if os.path.isabs(o) else os.path.join(
+                odir, tmp_o)
+        elif atomic and 'odir' in kwargs:
+            odir = kwargs['odir']
+            tmp_odir = temp_output_dir(odir)
+            kwargs['odir'] = tmp_odir
+
+        # read inputs from local copies if a staging cache is in use, unless
+        # the tool would write its outputs alongside them
+        if self.cache is not None and 'i' in kwargs and \
+                not writes_beside_input(cmd, kwargs):
+            with self.cache.staged(kwargs['i']) as staged:
+                proc = self._execute(cmd, dict(kwargs, i=staged), wine_prefix)
+        else:
+            proc = self._execute(cmd, kwargs, wine_prefix)
+
+        if echo:
+            print(proc.stdout.decode())
+            print(proc.stderr.decode())
+
+        if proc.returncode != 0:
+            if tmp_output:
+                discard_output(tmp_output)
+            if tmp_odir:
+                shutil.rmtree(tmp_odir, ignore_errors=True)
+            if local_dir:
+                self.uploader.discard(local_dir)
+            cmd_name = os.path.basename(cmd)
+            error_msg = proc.stderr.decode().split('\r')[0]
+            raise PipelineError(
+                '''{} failed on "{}" with the following error message
+                {}'''.format(cmd_name, kwargs.get('i', kwargs.get('lof')),
+                             error_msg))
+
+        if tmp_output:
+            commit_output(tmp_output)
+        if tmp_odir:
+            commit_output_dir(tmp_odir, odir)
+        if local_dir:
+            self.uploader.submit(local_dir, odir)
+
+        return proc
+
+    def _execute(self, cmd, kwargs, wine_prefix=None):
+        "Executes a LAStools command line tool using subprocess"
         # format the kwargs
         kws = format_lastools_kws(**kwargs)
 
@@ -133,16 +247,6 @@ class LAStools_base(object):
             proc = subprocess.run([cmd + '.exe', *kws],
                                   stderr=subprocess.PIPE,
                                   stdout=subprocess.PIPE)
-        if echo:
-            print(proc.stdout.decode())
-            print(proc.stderr.decode())
-
-        if proc.returncode != 0:
-            cmd_name = os.path.basename(cmd)
-            error_msg = proc.stderr.decode().split('\r')[0]
-            raise PipelineError(
-                '''{} failed on "{}" with the following error message
-                {}'''.format(cmd_name, kwargs['i'], error_msg))
 
         return proc
 
@@ -281,13 +385,16 @@ class LAStools_base(object):
 
 # Pythonic wrappers for LAStools command line tools
 def get_bounds(lasinfo):
-    '''Parses the minimum and maximum X, Y, and Z values from LASinfo output.
+    '''Retrieves the minimum and maximum X, Y, and Z values of lidar data.
 
-    This is a helper function used by the pitfree function.
+    This is a helper function used by the pitfree function. Bounds are read
+    directly from the headers of LAS/LAZ files, which avoids running lasinfo.
+    Output already produced by lasinfo can also be parsed.
 
     Parameters
     ----------
-    lasinfo: string
+    lasinfo: string or list-like of strings
+        path(s) to lidar data files, which may include wildcards, or the
         result produced by executing the lasinfo command line tool on a lidar
         data file
 
@@ -296,26 +403,116 @@ def get_bounds(lasinfo):
     bounds: tuple
         a 6-tuple containing (xmin, ymin, zmin, xmax, ymax, zmax)
     '''
-    min_start = lasinfo.index('min x y z:')
-    min_stop = lasinfo.index('\r\n', min_start)
-    min_line = lasinfo[min_start:min_stop]
-    min_vals = min_line.split(':')[1].strip().split(' ')
-    mins = (float(min_vals[0]), float(min_vals[1]), float(min_vals[2]))
+    if listlike(lasinfo) or 'min x y z:' not in lasinfo:
+        return read_bounds(lasinfo)
+
+    # lasinfo reports may use either Windows or Unix line endings
+    bounds = {}
+    for line in lasinfo.splitlines():
+        line = line.strip()
+        for key in ('min x y z:', 'max x y z:'):
+            if line.startswith(key) and key not in bounds:
+                vals = line[len(key):].split()
+                bounds[key] = tuple(float(val) for val in vals[:3])
+    return bounds['min x y z:'] + bounds['max x y z:']
 
-    max_start = lasinfo.index('max x y z:', min_stop)
-    max_stop = lasinfo.index('\r\n', max_start)
-    max_line = lasinfo[max_start:max_stop]
-    max_vals = max_line.split(':')[1].strip().split(' ')
-    maxs = (float(max_vals[0]), float(max_vals[1]), float(max_vals[2]))
-    return mins + maxs
+
+def get_tile_bounds(lasfiles):
+    '''Retrieves the extent of rasters made from lidar data with use_tile_bb.
+
+    LAStools trims the rasters of tiles written by lastile to their tile
+    bounding box, dropping any buffer, and leaves rasters of other files at
+    the extent of their points. This is a helper function used by the
+    pitfree functions to lay out the grid into which layers are merged.
+
+    Parameters
+    ----------
+    lasfiles: string or list-like of strings
+        path(s) to lidar data files, which may include wildcards
+
+    Returns
+    -------
+    bounds: tuple
+        a 4-tuple containing (xmin, ymin, xmax, ymax)
+    '''
+    if not listlike(lasfiles):
+        lasfiles = [lasfiles]
+    boxes = []
+    for path in lasfiles:
+        for lasfile in sorted(glob.glob(path)) or [path]:
+            header = read_header(lasfile)
+            boxes.append(header.tile_bbox or header.mins[:2] + header.maxs[:2])
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+def pitfree_scratch_bytes(lasfiles, units, xy_res=None, workers=1):
+    '''Estimates the volume of intermediate files written by pitfree.
+
+    The normalized point cloud, and the splatted point cloud of each
+    resolution, are each taken to be as large as their input file. For each
+    resolution, rasters covering the extent of
+    each input are on disk for the ground DEM, the maximum raster, and the
+    layers being made by each worker.
+
+    Parameters
+    ----------
+    lasfiles: list-like of strings
+        paths to the lidar data files to be processed
+    units, xy_res: as described for `useLAStools.pitfree`
+    workers: int
+        number of las2dem or blast2dem jobs run at once
+
+    Returns
+    -------
+    nbytes: int
+        estimated number of bytes of intermediate files
+    '''
+    resolutions = xy_res if listlike(xy_res) else [xy_res]
+    resolutions = [pitfree_params(units, 0, res)[0] for res in resolutions]
+    nbytes = 0
+    for lasfile in lasfiles:
+        xmin, ymin, _, xmax, ymax, _ = read_header(lasfile).bounds
+        nbytes += (1 + len(resolutions)) * os.path.getsize(lasfile)
+        for res in resolutions:
+            cells = (int((xmax - xmin) / res) + 2) * \
+                (int((ymax - ymin) / res) + 2)
+            nbytes += 4 * cells * (workers + 2)
+    return nbytes
 
 
 class useLAStools(LAStools_base):
     """A class which inherits the command-line tools from LAStools_base and
     provides additional methods for processing lidar data that chain together
     these lower-level commands and which may integrate some Python processing.
+
+    The intermediate steps of these methods write their outputs in place, so
+    the next step can read them, and only their final outputs are passed to
+    a WriteBehind uploader, if one is in use.
     """
 
+    def _write_outputs(self, compositors, outfiles):
+        "Writes composited rasters, through the uploader if there is one"
+        if self.uploader is None:
+            for compositor, outfile in zip(compositors, outfiles):
+                compositor.write(outfile)
+            return
+
+        # outputs sharing a directory are uploaded together
+        local_dirs = {}
+        try:
+            for compositor, outfile in zip(compositors, outfiles):
+                odir, name = os.path.split(outfile)
+                if odir not in local_dirs:
+                    local_dirs[odir] = self.uploader.local_dir()
+                compositor.write(os.path.join(local_dirs[odir], name))
+        except BaseException:
+            for local_dir in local_dirs.values():
+                self.uploader.discard(local_dir)
+            raise
+        for odir, local_dir in local_dirs.items():
+            self.uploader.submit(local_dir, odir)
+
     def pitfree(self,
                 lasfile,
                 outdir,
@@ -324,19 +521,24 @@ class useLAStools(LAStools_base):
                 z_res=None,
                 splat_radius=None,
                 max_TIN_edge=None,
-                blast=False,
+                blast='auto',
                 cleanup=True,
                 echo=False,
-                wine_prefix=None):
+                wine_prefix=None,
+                workers=None,
+                backend='lastools',
+                min_layer_points=None,
+                scratch_dir=None,
+                executor=None):
         '''Creates a pit-free Canopy Height Model from a lidar point cloud.
 
         This function chains together several LAStools command line tools to
         produce a pit-free Canopy Height Model (CHM) from a raw lidar point
-        cloud. A working subdirectory is created in the same folder where the
-        input lidar data file is located to hold intermediate files from the
-        process, which will be deleted (by default) upon completion of the CHM.
-        A GeoTiff of the CHM is output to the same folder as the inputfile named
-        {inputfile}_chm_pitfree.tif
+        cloud. A working subdirectory named work_{inputfile} is created in
+        scratch_dir (or in outdir, if scratch_dir is not given or cannot hold
+        them) to hold intermediate files from the process, which will be
+        deleted (by default) upon completion of the CHM. The CHM is written to
+        outdir as an ESRI BIL raster named {inputfile}_chm_pitfree.bil
 
         This method was first described by:
 
@@ -351,7 +553,13 @@ class useLAStools(LAStools_base):
 
         The method employed here varies from the blog post by using blast2dem to
         allow out-of-core processing of larger point clouds to avoid running out
-        of memory when calculating intermediate DEMs.
+        of memory when calculating intermediate DEMs. Rather than merging the
+        CHM layers with lasgrid once all of them are written, each layer is
+        folded into a memory-mapped maximum raster and deleted as soon as it
+        is produced, so only the layers in progress occupy scratch space.
+
+        Returns a tuple of the lasheight, ground DEM, lasthin and layer DEM
+        processes, and the path to the CHM.
 
         Parameters
         ----------
@@ -361,10 +569,17 @@ class useLAStools(LAStools_base):
             Output directory where pit free CHM will be saved
         units: string (required)
             'm' for meters or 'ft' for feet
-        xy_res: numeric (optional)
+        xy_res: numeric or list-like of numerics (optional)
             Size of grid cells for Canopy Height Model, in same units as lidar
             data. Used in the `step` argument of las2dem. Default is 0.33333 if
-            units are in meters or 1.0 if units are in feet.
+            units are in meters or 1.0 if units are in feet. If several
+            resolutions are given, the normalized and splatted point clouds
+            are made once and shared by a CHM at each resolution, named
+            {inputfile}_chm_pitfree_{xy_res}.bil with any decimal point
+            replaced by 'p'. The splatted cloud is thinned again for each
+            resolution coarser than the finest. The ground DEM, lasthin and
+            layer processes and the CHM paths that are returned are lists
+            with an item for each resolution.
         z_res: numeric (optional)
             Height of vertical slices used to build CHM layers. Will always use
             layers from 0-2m and 2-5m, then will stack on layers z_res thick.
@@ -378,10 +593,13 @@ class useLAStools(LAStools_base):
             considered by las2dem in units of meters, and conversion to feet
             is handled by las2dem if the LAS header indicates units are in ft.
             Default is 1.0 meters.
-        blast: boolean (optional)
+        blast: boolean or 'auto' (optional)
             Whether or not to use BLAST commands from LAStools to handle larger
             files. If True, will employ blast2dem and rather than las2dem.
-            Defaults to False (i.e., to use las2dem).
+            If 'auto' (the default), las2dem is used unless the TINs it would
+            build for the normalized tile, as estimated by
+            `pyFIRS.chm.tin_memory`, do not fit in the memory available to
+            each worker.
         cleanup: boolean (optional)
             Whether or not to remove the temporary working directory and
             intermediate files produced. Defaults to True.
@@ -391,14 +609,60 @@ class useLAStools(LAStools_base):
         wine_prefix: integer or string (optional)
             If provided when run on a Linux OS, identifies a specific WINE
             server to use for executing the command. Defaults to None.
+        workers: int (optional)
+            Number of las2dem or blast2dem jobs to run at once when creating
+            the ground DEM and CHM layers. Defaults to the number of layers
+            plus one, up to the number of cores on this machine.
+        backend: string (optional)
+            'lastools' (default) to chain together LAStools command line tools,
+            or 'numpy' to use the native implementation in pyFIRS.chm, which
+            does not need wine or write intermediate files. It only uses
+            lasfile, outdir, units, xy_res, z_res, splat_radius,
+            max_TIN_edge and min_layer_points, ignoring the options of the
+            LAStools backend (blast, cleanup, echo, wine_prefix, workers,
+            scratch_dir and executor), and returns the path to the CHM. Like
+            the LAStools backend, a tile written by lastile is trimmed to its
+            tile bounding box.
+        min_layer_points: int (optional)
+            If provided, layers are chosen adaptively from a histogram of the
+            heights of the splatted points, and layers with fewer than this
+            many points in their height band are skipped, as described for
+            `pyFIRS.chm.select_layers`. By default, every layer is made.
+        scratch_dir: string, path to directory (optional)
+            Directory to hold the working subdirectory of intermediate files,
+            rather than outdir, such as a local SSD when outdir is on network
+            storage. If 'auto', RAM-backed /dev/shm or a local SSD is used if
+            found. The volume of intermediate files is estimated from the
+            input, and if it does not fit, outdir is used instead.
+        executor: TileExecutor or string (optional)
+            executor to run the ground DEM and layer jobs on, or the name of a
+            backend passed to `pyFIRS.executors.get_executor`. Defaults to a
+            pool of `workers` threads. An executor passed in must not be the
+            one running this call, or its jobs may wait on each other.
         '''
+        if backend == 'numpy':
+            return chm.pitfree(lasfile, outdir, units, xy_res=xy_res,
+                               z_res=z_res, splat_radius=splat_radius,
+                               max_TIN_edge=max_TIN_edge,
+                               min_layer_points=min_layer_points)
+        elif backend != 'lastools':
+            raise ValueError('{} is not a recognized backend'.format(backend))
+
         path_to_file = os.path.abspath(lasfile)
         path, fname = os.path.split(path_to_file)
         basename = fname.split('.')[0]
 
-        # make a temporary working directory
-        tmpdir = os.path.join(outdir, 'work_{}'.format(basename))
+        # make a temporary working directory, on fast local scratch if asked
+        if scratch_dir is None:
+            scratch_dir = outdir
+        else:
+            needed = pitfree_scratch_bytes(
+                [path_to_file], units, xy_res, workers or os.cpu_count() or 1)
+            scratch_dir = choose_scratch_dir(needed, scratch_dir,
+                                             fallback=outdir)
+        tmpdir = os.path.join(scratch_dir, 'work_{}'.format(basename))
         os.makedirs(tmpdir, exist_ok=True)
+        os.makedirs(outdir, exist_ok=True)
 
         # run lasheight to normalize point cloud
         odir = os.path.join(tmpdir, 'normalized')
@@ -410,134 +674,376 @@ class useLAStools(LAStools_base):
             keep_class=(1, 2, 5),
             drop_below=-0.1,  # drop points below the ground
             echo=echo,
-            wine_prefix=wine_prefix)
+            wine_prefix=wine_prefix,
+            upload=False)
 
         # get the minimum and maximum normalized heights
         # we'll use these later for creating layered canopy height models
         infile = os.path.join(tmpdir, 'normalized', '*.laz')
-        info_proc = self.lasinfo(i=infile, wine_prefix=wine_prefix)
-        lasinfo = info_proc.stderr.decode()
-        _, _, zmin, _, _, zmax = get_bounds(lasinfo)
-
-        # check to see if we need to use defaults
-        if units.lower() in ('m', 'meter', 'meters'):
-            if not xy_res:
-                xy_res = 0.33333
-            if not z_res:
-                z_res = 5.0
-            if not splat_radius:
-                splat_radius = 0.1
-            if not max_TIN_edge:
-                max_TIN_edge = 1.0
-            hts = [0.0, 2.0] + [x for x in np.arange(5.0, zmax, z_res)]
-        elif units.lower() in ('f', 'ft', 'feet'):
-            if not xy_res:
-                xy_res = 1.0
-            if not z_res:
-                z_res = 15.0
-            if not splat_radius:
-                splat_radius = 0.3
-            if not max_TIN_edge:
-                max_TIN_edge = 1.0  # blast2dem converts from meters to feet
-                # so we use the same value for meters or feet
-            hts = [0.0, 6.56168
-                   ] + [x for x in np.arange(16.4042, zmax, z_res).tolist()]
-        else:
-            raise ValueError('{} is not recognized units'.format(units))
-
-        # create DEM of ground for minimum value of pitfree CHM
-        infile = os.path.join(tmpdir, 'normalized', '*.laz')  # *_height.laz
-        odir = os.path.join(tmpdir, 'chm_layers')
-        odix = '_chm_ground'
-        if blast:
-            proc_dem1 = self.blast2dem(
-                i=infile,
-                odir=odir,
-                odix=odix,
-                obil=True,
-                drop_z_above=0.1,
-                step=xy_res,  # resolution of ground model
-                use_tile_bb=True,  # trim the tile buffers
-                echo=echo,
-                wine_prefix=wine_prefix)
-        else:
-            proc_dem1 = self.las2dem(
-                i=infile,
-                odir=odir,
-                odix=odix,
-                obil=True,
-                drop_z_above=0.1,
-                step=xy_res,  # resolution of ground model
-                use_tile_bb=True,  # trim the tile buffers
-                echo=echo,
-                wine_prefix=wine_prefix)
-        # "splat" and thin the lidar point cloud to get highest points using a
-        # finer resolution than our final CHM will be
-        infile = os.path.join(tmpdir, 'normalized', '*.laz')  # *_height.laz
-        odir = os.path.join(tmpdir, 'splatted')
-        proc_thin = self.lasthin(
-            i=infile,
-            odir=odir,
-            olaz=True,
-            highest=True,
-            subcircle=splat_radius,
-            step=xy_res / 2.0,
-            echo=echo,
-            wine_prefix=wine_prefix)
-
-        # using the "splatted" lidar point cloud, generate CHM layers above
-        # ground, above 2m, and then in 5m increments up to zmax...
-        # las2dem first makes a TIN and then rasterizes to grid
-        infile = os.path.join(tmpdir, 'splatted', '*.laz')
-
-        # loop through the layers
-        dem2_procs = []
-        for i, ht in enumerate(hts):
-            odix = '_chm_{:02d}_{:03d}'.format(i, int(ht))
+        zmax = get_bounds(infile)[5]
+
+        # check to see if we need to use defaults, for each resolution
+        resolutions = xy_res if listlike(xy_res) else [xy_res]
+        params = [pitfree_params(units, zmax, res, z_res, splat_radius,
+                                 max_TIN_edge) for res in resolutions]
+        resolutions = [res for res, _, _, _, _ in params]
+        _, z_res, splat_radius, max_TIN_edge, hts = params[0]
+
+        # each layer is folded into a running maximum as soon as it is made,
+        # over the extent to which use_tile_bb trims the layers
+        xmin, ymin, xmax, ymax = get_tile_bounds(infile)
+        compositors = []
+        for res in resolutions:
+            transform, shape = chm.make_grid(xmin, ymin, xmax, ymax, res)
+            compositors.append(chm.MaxCompositor(
+                os.path.join(tmpdir, 'chm_max_{}.dat'.format(
+                    chm.res_tag(res))), transform, shape))
+
+        # the ground DEM and each CHM layer are rasterized by independent
+        # las2dem/blast2dem jobs, which are run concurrently
+        if isinstance(executor, TileExecutor):
+            workers = executor.workers
+        elif workers is None:
+            workers = min(len(resolutions) * (len(hts) + 1),
+                          os.cpu_count() or 1)
+        if blast == 'auto':
+            normalized = glob.glob(os.path.join(tmpdir, 'normalized', '*.laz'))
+            points = sum(read_header(f).point_count for f in normalized)
+            blast = not chm.tin_fits(points, workers=workers)
+        dem = self.blast2dem if blast else self.las2dem
+        own_executor = not isinstance(executor, TileExecutor)
+        executor = get_executor(executor or 'threads', workers=workers)
+
+        try:
+            # create DEM of ground for minimum value of pitfree CHM
+            infile = os.path.join(tmpdir, 'normalized', '*.laz')
             odir = os.path.join(tmpdir, 'chm_layers')
-            if blast:
-                proc_dem2 = self.blast2dem(
+            layer_dir = odir
+            odixes = {}  # the suffix and compositor of each job's layer
+            dem1_jobs = []
+            for res, compositor in zip(resolutions, compositors):
+                tag = '_' + chm.res_tag(res) if len(resolutions) > 1 else ''
+                odix = '_chm{}_ground'.format(tag)
+                job = executor.submit(
+                    dem,
                     i=infile,
                     odir=odir,
                     odix=odix,
                     obil=True,
-                    drop_z_below=ht,  # specify layer height from ground
-                    kill=max_TIN_edge,  # trim edges in TIN > max_TIN_edge
-                    step=xy_res,  # resolution of layer DEM
-                    use_tile_bb=True,  # trim tile buffer
+                    drop_z_above=0.1,
+                    step=res,  # resolution of ground model
+                    use_tile_bb=True,  # trim the tile buffers
                     echo=echo,
-                    wine_prefix=wine_prefix)
-            else:
-                proc_dem2 = self.las2dem(
-                    i=infile,
-                    odir=odir,
-                    odix=odix,
-                    obil=True,
-                    drop_z_below=ht,  # specify layer height from ground
-                    kill=max_TIN_edge,  # trim edges in TIN > max_TIN_edge
-                    step=xy_res,  # resolution of layer DEM
-                    use_tile_bb=True,  # trim tile buffer
+                    wine_prefix=wine_prefix,
+                    upload=False)
+                odixes[job] = (odix, compositor)
+                dem1_jobs.append(job)
+
+            # while the ground DEM is made, "splat" and thin the lidar point
+            # cloud to get highest points using a finer resolution than our
+            # final CHM will be. The cloud is splatted once, for the finest
+            # resolution, and the splatted cloud is thinned again to half of
+            # each coarser resolution, as a run at that resolution would be.
+            infile = os.path.join(tmpdir, 'normalized', '*.laz')
+            odir = os.path.join(tmpdir, 'splatted')
+            proc_thin = [self.lasthin(
+                i=infile,
+                odir=odir,
+                olaz=True,
+                highest=True,
+                subcircle=splat_radius,
+                step=min(resolutions) / 2.0,
+                echo=echo,
+                wine_prefix=wine_prefix,
+                upload=False)]
+            splat_dirs = []
+            for res in resolutions:
+                if res == min(resolutions):
+                    splat_dirs.append(odir)
+                    continue
+                splat_dirs.append(os.path.join(
+                    tmpdir, 'splatted_' + chm.res_tag(res)))
+                proc_thin.append(self.lasthin(
+                    i=os.path.join(odir, '*.laz'),
+                    odir=splat_dirs[-1],
+                    olaz=True,
+                    highest=True,
+                    step=res / 2.0,
                     echo=echo,
-                    wine_prefix=wine_prefix)
-            dem2_procs.append(proc_dem2)
-
-        # merge the CHM layers into a single pit free CHM raster
-        infiles = os.path.join(tmpdir, 'chm_layers', '*.bil')
-        outfile = basename + '_chm_pitfree.bil'
-        proc_grid = self.lasgrid(
-            i=infiles,
-            merged=True,
-            o=outfile,
-            odir=outdir,
-            highest=True,
-            step=xy_res,  # resolution of pit-free CHM
+                    wine_prefix=wine_prefix,
+                    upload=False))
+
+            # using the "splatted" lidar point cloud, generate CHM layers
+            # above ground, above 2m, and then in 5m increments up to zmax...
+            # las2dem first makes a TIN and then rasterizes to grid
+            odir = os.path.join(tmpdir, 'chm_layers')
+            dem2_jobs = []
+            for res, compositor, splat_dir in zip(resolutions, compositors,
+                                                  splat_dirs):
+                tag = '_' + chm.res_tag(res) if len(resolutions) > 1 else ''
+                infile = os.path.join(splat_dir, '*.laz')
+                layer_hts = hts
+                if min_layer_points:
+                    z = np.concatenate([read_points(f, fields=['z']).z
+                                        for f in glob.glob(infile)])
+                    layer_hts = chm.select_layers(z, hts, min_layer_points)
+                res_jobs = []
+                for i, ht in enumerate(layer_hts):
+                    odix = '_chm{}_{:02d}_{:03d}'.format(tag, i, int(ht))
+                    job = executor.submit(
+                        dem,
+                        i=infile,
+                        odir=odir,
+                        odix=odix,
+                        obil=True,
+                        drop_z_below=ht,  # specify layer height from ground
+                        kill=max_TIN_edge,  # trim edges in TIN > max_TIN_edge
+                        step=res,  # resolution of layer DEM
+                        use_tile_bb=True,  # trim tile buffer
+                        echo=echo,
+                        wine_prefix=wine_prefix,
+                        upload=False)
+                    odixes[job] = (odix, compositor)
+                    res_jobs.append(job)
+                dem2_jobs.append(res_jobs)
+
+            # merge the CHM layers into a single pit free CHM raster, folding
+            # in and deleting each layer as soon as its job is done
+            for job in executor.as_completed(list(odixes)):
+                job.result()  # raises the error of a job that failed
+                odix, compositor = odixes[job]
+                pattern = os.path.join(glob.escape(layer_dir),
+                                       '*' + odix + '.bil')
+                for layer in glob.glob(pattern):
+                    compositor.fold_file(layer)
+
+            proc_dem1 = [job.result() for job in dem1_jobs]
+            dem2_procs = [[job.result() for job in res_jobs]
+                          for res_jobs in dem2_jobs]
+
+            outfile = []
+            for res, compositor in zip(resolutions, compositors):
+                suffix = '_' + chm.res_tag(res) if len(resolutions) > 1 else ''
+                outfile.append(os.path.join(
+                    outdir, basename + '_chm_pitfree{}.bil'.format(suffix)))
+            self._write_outputs(compositors, outfile)
+        finally:
+            if own_executor:
+                executor.shutdown(wait=True)
+            for compositor in compositors:
+                compositor.close()
+
+        if cleanup:
+            shutil.rmtree(tmpdir)
+
+        if not listlike(xy_res):
+            proc_dem1, proc_thin, dem2_procs, outfile = (
+                proc_dem1[0], proc_thin[0], dem2_procs[0], outfile[0])
+        return (proc_height, proc_dem1, proc_thin, dem2_procs, outfile)
+
+    def pitfree_batch(self,
+                      tiles,
+                      outdir,
+                      units,
+                      xy_res=None,
+                      z_res=None,
+                      splat_radius=None,
+                      max_TIN_edge=None,
+                      zmax=None,
+                      blast='auto',
+                      cleanup=True,
+                      echo=False,
+                      wine_prefix=None,
+                      cores=None,
+                      min_layer_points=None,
+                      scratch_dir=None,
+                      executor=None):
+        '''Creates pit-free Canopy Height Models for a set of lidar tiles.
+
+        Follows the same steps as `pitfree`, but runs each LAStools command
+        once over all the tiles using its `-cores` option, rather than once
+        per tile. The number of processes started grows with the number of
+        CHM layers rather than with the number of tiles times layers. The
+        layers are made at the same heights for every tile, so the CHMs of
+        adjacent tiles match along their edges.
+
+        Returns a tuple of the lasheight, ground DEM, lasthin and layer DEM
+        processes, and the paths to the CHMs, one for each tile named
+        {basename}_chm_pitfree.bil.
+
+        Parameters
+        ----------
+        tiles: string or list-like of strings (required)
+            paths to the lidar point cloud tiles to process, which may be a
+            wildcard such as 'tiles/*.laz'. Their outputs are named after
+            them, so no two tiles may share a file name.
+        outdir: string, path to directory (required)
+            Output directory where pit free CHMs will be saved
+        zmax: numeric (optional)
+            maximum normalized height used to choose the heights of CHM
+            layers. Defaults to the highest normalized point in any tile.
+        cores: int (optional)
+            number of cores each LAStools command uses, which processes as
+            many tiles at once. The ground DEMs are made while the tiles are
+            thinned, so those two commands share the cores between them.
+            Defaults to the number of cores on this machine.
+        units, xy_res, z_res, splat_radius, max_TIN_edge, blast, cleanup,
+        echo, wine_prefix, min_layer_points, scratch_dir, executor:
+            as described for `pitfree`. Layers are selected adaptively from
+            the heights of the splatted points of all the tiles together.
+        '''
+        if not listlike(tiles):
+            tiles = sorted(glob.glob(tiles))
+        if not tiles:
+            raise ValueError('No tiles to process')
+        tiles = [os.path.abspath(tile) for tile in tiles]
+        basenames = [os.path.basename(tile).split('.')[0] for tile in tiles]
+        # the outputs of every tile are named after it in shared directories
+        duplicates = sorted(set(
+            name for name in basenames if basenames.count(name) > 1))
+        if duplicates:
+            raise ValueError('Tiles must have unique names, but several are '
+                             'named {}'.format(', '.join(duplicates)))
+        cores = cores or os.cpu_count() or 1
+
+        if scratch_dir is None:
+            scratch_dir = outdir
+        else:
+            needed = pitfree_scratch_bytes(tiles, units, xy_res, workers=2)
+            scratch_dir = choose_scratch_dir(needed, scratch_dir,
+                                             fallback=outdir)
+        # each batch has its own working directory, so batches run at once
+        # on the same scratch disk do not pick up each other's layers
+        os.makedirs(scratch_dir, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix='work_batch_', dir=scratch_dir)
+        os.makedirs(outdir, exist_ok=True)
+        normalized = os.path.join(tmpdir, 'normalized')
+        splatted = os.path.join(tmpdir, 'splatted')
+        layer_dir = os.path.join(tmpdir, 'chm_layers')
+
+        # the tiles are passed in a list file, since a command line naming
+        # all of them may be too long
+        tile_list = os.path.join(tmpdir, 'tiles.txt')
+        with open(tile_list, 'w') as f:
+            f.write('\n'.join(tiles) + '\n')
+
+        # normalize every tile with a single lasheight command
+        proc_height = self.lasheight(
+            lof=tile_list,
+            odir=normalized,
+            olaz=True,
+            replace_z=True,
+            keep_class=(1, 2, 5),
+            drop_below=-0.1,  # drop points below the ground
+            cores=cores,
             echo=echo,
-            wine_prefix=wine_prefix)
+            wine_prefix=wine_prefix,
+            upload=False)
+
+        # heights of the layers are shared by all the tiles
+        if zmax is None:
+            zmax = get_bounds(os.path.join(normalized, '*.laz'))[5]
+        xy_res, z_res, splat_radius, max_TIN_edge, hts = pitfree_params(
+            units, zmax, xy_res, z_res, splat_radius, max_TIN_edge)
+
+        # each layer of each tile is folded into that tile's maximum raster,
+        # over the extent to which use_tile_bb trims the layers
+        compositors = {}
+        for basename in basenames:
+            bounds = get_tile_bounds(
+                os.path.join(normalized, basename + '.laz'))
+            transform, shape = chm.make_grid(*bounds, res=xy_res)
+            compositors[basename] = chm.MaxCompositor(
+                os.path.join(tmpdir, basename + '_chm_max.dat'), transform,
+                shape)
+
+        def fold(odix):
+            for basename, compositor in compositors.items():
+                layer = os.path.join(layer_dir, basename + odix + '.bil')
+                if os.path.exists(layer):
+                    compositor.fold_file(layer)
+
+        # each core triangulates one tile at a time
+        if blast == 'auto':
+            points = max(read_header(f).point_count for f in glob.glob(
+                os.path.join(normalized, '*.laz')))
+            blast = not chm.tin_fits(points, workers=cores)
+        dem = self.blast2dem if blast else self.las2dem
+        own_executor = not isinstance(executor, TileExecutor)
+        executor = get_executor(executor or 'threads', workers=1)
+        try:
+            # create DEMs of ground while the tiles are splatted and thinned,
+            # sharing the cores between the two commands
+            dem_cores = max(cores // 2, 1)
+            job_dem1 = executor.submit(
+                dem,
+                i=os.path.join(normalized, '*.laz'),
+                odir=layer_dir,
+                odix='_chm_ground',
+                obil=True,
+                drop_z_above=0.1,
+                step=xy_res,
+                use_tile_bb=True,
+                cores=dem_cores,
+                echo=echo,
+                wine_prefix=wine_prefix,
+                upload=False)
+            if cores < 2:  # no core to spare for thinning at the same time
+                job_dem1.result()
+
+            proc_thin = self.lasthin(
+                i=os.path.join(normalized, '*.laz'),
+                odir=splatted,
+                olaz=True,
+                highest=True,
+                subcircle=splat_radius,
+                step=xy_res / 2.0,
+                cores=max(cores - dem_cores, 1),
+                echo=echo,
+                wine_prefix=wine_prefix,
+                upload=False)
+
+            proc_dem1 = job_dem1.result()
+            fold('_chm_ground')
+
+            infile = os.path.join(splatted, '*.laz')
+            if min_layer_points:
+                z = np.concatenate([read_points(f, fields=['z']).z
+                                    for f in glob.glob(infile)])
+                hts = chm.select_layers(z, hts, min_layer_points)
+
+            # each layer is made for every tile with a single command
+            dem2_procs = []
+            for i, ht in enumerate(hts):
+                odix = '_chm_{:02d}_{:03d}'.format(i, int(ht))
+                dem2_procs.append(
+                    dem(i=infile,
+                        odir=layer_dir,
+                        odix=odix,
+                        obil=True,
+                        drop_z_below=ht,
+                        kill=max_TIN_edge,
+                        step=xy_res,
+                        use_tile_bb=True,
+                        cores=cores,
+                        echo=echo,
+                        wine_prefix=wine_prefix,
+                        upload=False))
+                fold(odix)
+
+            outfiles = [os.path.join(outdir, basename + '_chm_pitfree.bil')
+                        for basename in compositors]
+            self._write_outputs(compositors.values(), outfiles)
+        finally:
+            if own_executor:
+                executor.shutdown(wait=True)
+            for compositor in compositors.values():
+                compositor.close()
 
         if cleanup:
             shutil.rmtree(tmpdir)
 
-        return (proc_height, proc_dem1, proc_thin, dem2_procs, proc_grid)
+        return (proc_height, proc_dem1, proc_thin, dem2_procs, outfiles)
 
 
 # def clean_buffer_polys(poly_shp, tile_shp, odir, simp_tol=None, simp_topol=None):
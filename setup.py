@@ -8,5 +8,8 @@ setup(
     long_description=open('README.md').read(),
     author='David Diaz',
     author_email='ddiaz@ecotrust.org',
-    url='https://github.com/Ecotrust/pyFIRS'
+    url='https://github.com/Ecotrust/pyFIRS',
+    entry_points={
+        'console_scripts': ['pyfirs=pyFIRS.cli:main'],
+    }
 )